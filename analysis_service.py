@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sqlite3
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from dotenv import load_dotenv
+
+from batch_runner import BatchRunner, RepositoryJob, parse_question
+from model_config import ModelConfigParser
+from openai_client_factory import OpenAIClientFactory
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from result_store import query_answers
+from token_counter import create_token_counter
+
+"""
+A long running analysis service. The client factory (with its parsed model configurations and open connections), the
+request scheduler, the token counter and the response cache are created once and shared by all the jobs, so a job
+doesn't pay for them before its first request.
+
+The jobs are submitted over a local HTTP API, on a TCP port or a unix socket, queued by priority (the highest first,
+then in submission order) and run by a fixed number of workers with the BatchRunner:
+    POST   /jobs                  {"directory": "...", "questions": [...], "priority": 0, "name": "...", "max_concurrency": 8}
+    GET    /jobs                  the jobs and their status
+    GET    /jobs/<id>             the status of a job, and its summary once done
+    GET    /jobs/<id>/results     the answers stored so far, filtered by kind, model and question, after an answer id
+    GET    /jobs/<id>/results?stream=true
+                                  the answers as JSON lines, streamed as they are stored until the job is done
+    DELETE /jobs/<id>             cancels a queued or running job
+    GET    /health                the queue, the workers and the deployments
+
+    python analysis_service.py --port 8780
+    python analysis_service.py --unix-socket /tmp/code-analysis.sock
+    curl -X POST localhost:8780/jobs -d '{"directory": "./repos/service-a", "questions": [{"text": "What does it do?", "enabled": true}]}'
+"""
+
+STATUS_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 500: "Internal Server Error"}
+
+
+class AnalysisJob:
+    def __init__(self, repository_job: RepositoryJob, priority: int = 0):
+        self.id = repository_job.output_dir.name
+        self.repository_job = repository_job
+        self.priority = priority
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.summary = None
+        self.task: asyncio.Task = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id, "name": self.repository_job.name, "directory": self.repository_job.directory, "priority": self.priority,
+            "status": self.status, "submitted_at": self.submitted_at, "started_at": self.started_at, "finished_at": self.finished_at,
+            "summary": self.summary,
+        }
+
+
+class AnalysisService:
+    def __init__(self, batch_runner: BatchRunner, output_dir="./output/service", workers: int = 2):
+        self.batch_runner = batch_runner
+        self.output_dir = Path(output_dir)
+        self.workers = workers
+        self.jobs: dict[str, AnalysisJob] = {}
+        self._queue = asyncio.PriorityQueue()
+        self._sequence = itertools.count()
+        self._worker_tasks = []
+
+    def submit(self, request: dict) -> AnalysisJob:
+        if not request.get("directory"):
+            raise ValueError("The job needs the directory of the repository")
+        if not request.get("questions"):
+            raise ValueError("The job needs at least one question")
+
+        job_id = uuid.uuid4().hex[:12]
+        questions = [parse_question(question) for question in request["questions"]]
+        repository_job = RepositoryJob(request["directory"], self.output_dir / job_id, questions, name=request.get("name"), max_concurrency=request.get("max_concurrency"))
+        job = AnalysisJob(repository_job, priority=int(request.get("priority", 0)))
+
+        self.jobs[job.id] = job
+        self._queue.put_nowait((-job.priority, next(self._sequence), job.id))
+        return job
+
+    def cancel(self, job: AnalysisJob):
+        if job.done:
+            raise ValueError(f"The job {job.id} is already {job.status}")
+
+        if job.task:
+            job.task.cancel()
+        else:
+            # The worker skips it when it's dequeued
+            job.status = "cancelled"
+            job.finished_at = time.time()
+
+    def position(self, job: AnalysisJob) -> int:
+        queued = [other for other in self.jobs.values() if other.status == "queued"]
+        return sum(1 for other in queued if (-other.priority, other.submitted_at) < (-job.priority, job.submitted_at))
+
+    async def _work(self):
+        while True:
+            _, _, job_id = await self._queue.get()
+            job = self.jobs[job_id]
+
+            if job.status != "queued":
+                continue
+
+            job.status = "running"
+            job.started_at = time.time()
+            job.task = asyncio.create_task(self.batch_runner.run_repository(job.repository_job))
+            await asyncio.wait({job.task})
+
+            if job.task.cancelled():
+                job.status = "cancelled"
+            elif job.task.exception():
+                job.status = "failed"
+                job.summary = {"error": f"{type(job.task.exception()).__name__}: {job.task.exception()}"}
+            else:
+                job.summary = job.task.result()
+                job.status = "done" if job.summary["status"] == "ok" else "failed"
+
+            job.finished_at = time.time()
+            print(f"Job {job.id} ({job.repository_job.name}) {job.status}")
+
+    def _results(self, job: AnalysisJob, query: dict, after_id: int = None) -> list[dict]:
+        path = job.repository_job.output_dir / "results.sqlite"
+        if not path.exists():
+            return []
+
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            return query_answers(connection, kind=query.get("kind"), model=query.get("model"), question=query.get("question"), after_id=after_id)
+        finally:
+            connection.close()
+
+    async def _write_json(self, writer: asyncio.StreamWriter, status: int, body):
+        content = json.dumps(body, default=str).encode()
+        writer.write(f"HTTP/1.1 {status} {STATUS_REASONS[status]}\r\nContent-Type: application/json\r\nContent-Length: {len(content)}\r\nConnection: close\r\n\r\n".encode() + content)
+        await writer.drain()
+
+    async def _stream_results(self, writer: asyncio.StreamWriter, job: AnalysisJob, query: dict):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        after_id = int(query["after"]) if query.get("after") else None
+
+        while True:
+            finished = job.done
+            answers = await asyncio.to_thread(self._results, job, query, after_id)
+
+            if answers:
+                after_id = answers[-1]["id"]
+                content = "".join(json.dumps(answer) + "\n" for answer in answers).encode()
+                writer.write(f"{len(content):x}\r\n".encode() + content + b"\r\n")
+                await writer.drain()
+
+            # The answers stored before the job finished have all been read once it's seen finished
+            if finished:
+                break
+            await asyncio.sleep(0.5)
+
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _route(self, writer: asyncio.StreamWriter, method: str, target: str, body: bytes):
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["health"] and method == "GET":
+            await self._write_json(writer, 200, {
+                "queued": sum(1 for job in self.jobs.values() if job.status == "queued"),
+                "running": sum(1 for job in self.jobs.values() if job.status == "running"),
+                "workers": self.workers,
+                "deployments": self.batch_runner.openai_client_factory.stats(),
+                "transports": self.batch_runner.openai_client_factory.transport_stats(),
+                "scheduler": self.batch_runner.request_scheduler.stats(),
+            })
+        elif parts == ["jobs"] and method == "POST":
+            try:
+                job = self.submit(json.loads(body or b"{}"))
+            except (ValueError, TypeError, KeyError) as e:
+                await self._write_json(writer, 400, {"error": str(e)})
+                return
+            await self._write_json(writer, 202, {**job.as_dict(), "position": self.position(job)})
+        elif parts == ["jobs"] and method == "GET":
+            await self._write_json(writer, 200, [job.as_dict() for job in self.jobs.values()])
+        elif len(parts) >= 2 and parts[0] == "jobs":
+            job = self.jobs.get(parts[1])
+
+            if job is None:
+                await self._write_json(writer, 404, {"error": f"No job {parts[1]}"})
+            elif len(parts) == 2 and method == "GET":
+                await self._write_json(writer, 200, {**job.as_dict(), "position": self.position(job) if job.status == "queued" else None})
+            elif len(parts) == 2 and method == "DELETE":
+                try:
+                    self.cancel(job)
+                except ValueError as e:
+                    await self._write_json(writer, 409, {"error": str(e)})
+                    return
+                await self._write_json(writer, 202, job.as_dict())
+            elif parts[2:] == ["results"] and method == "GET":
+                if query.get("stream", "false").lower() == "true":
+                    await self._stream_results(writer, job, query)
+                else:
+                    after_id = int(query["after"]) if query.get("after") else None
+                    await self._write_json(writer, 200, await asyncio.to_thread(self._results, job, query, after_id))
+            else:
+                await self._write_json(writer, 405, {"error": f"{method} {url.path} isn't supported"})
+        else:
+            await self._write_json(writer, 404, {"error": f"No route {url.path}"})
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+
+            method, target, _ = request_line.decode().split(" ", 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            await self._route(writer, method, target, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            print(f"Error handling a request: {e}")
+            try:
+                await self._write_json(writer, 500, {"error": str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8780, unix_socket: str = None):
+        models = await self.batch_runner.openai_client_factory.warm_up()
+        print(f"Clients ready for the models {models}")
+
+        self._worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+        if unix_socket:
+            server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+            print(f"Analysis service listening on {unix_socket}", flush=True)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            print(f"Analysis service listening on http://{host}:{port}", flush=True)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in self._worker_tasks:
+                task.cancel()
+            for job in self.jobs.values():
+                if job.task and not job.task.done():
+                    job.task.cancel()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Runs the analysis jobs submitted over a local HTTP API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8780)
+    parser.add_argument("--unix-socket", help="Listens on a unix socket instead of a TCP port")
+    parser.add_argument("--workers", type=int, default=2, help="The jobs run at a time")
+    parser.add_argument("--output-dir", default="./output/service")
+    parser.add_argument("--model-config", help="The model configuration file, MODELS_CONFIGURATION_PATH by default")
+    args = parser.parse_args()
+
+    openAIClientFactory = OpenAIClientFactory(model_config_parser=ModelConfigParser(args.model_config))
+    responseCache = ResponseCache(str(Path(args.output_dir) / "response_cache.sqlite"), max_age_seconds=7 * 24 * 3600, bypass=os.getenv("RESPONSE_CACHE_BYPASS", "false").lower() == "true")
+    batchRunner = BatchRunner(openAIClientFactory, RequestScheduler(openai_client_factory=openAIClientFactory), response_cache=responseCache,
+                              token_counter=create_token_counter(), code_output=os.getenv("CODE_OUTPUT", "mirror"),
+                              conflict_policy=os.getenv("CODE_CONFLICT_POLICY", "markers"), batch_questions=os.getenv("QUESTION_BATCHING", "false").lower() == "true",
+                              deduplication=os.getenv("FILE_DEDUPLICATION", "exact"))
+    service = AnalysisService(batchRunner, output_dir=args.output_dir, workers=args.workers)
+
+    try:
+        await service.serve(args.host, args.port, args.unix_socket)
+    finally:
+        responseCache.close()
+        await openAIClientFactory.close()
+
+
+if __name__ == "__main__":
+    load_dotenv(".env")
+    asyncio.run(main())
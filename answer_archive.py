@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List, Tuple
+import aiofiles
+
+from common_models import Chunk, ModelAnswer, Question
+
+"""
+Keeps the per-file chunk answers of the previous runs, so the incremental mode can feed the answers of the unchanged
+files into the refine step without asking the models again.
+
+The answers are stored per question and model, each one with the source files of the chunk it was given. An answer
+is only reused when all of its source files are unchanged.
+"""
+
+class AnswerArchive:
+    def __init__(self, output_dir="./output", filename="answers.json"):
+        self.path = Path(output_dir) / filename
+        self._answers: dict[str, dict[str, list[dict]]] = {}
+
+    def _question_key(self, question: Question) -> str:
+        return hashlib.sha256(f"{question.system_prompt}\n{question.text}".encode('utf-8')).hexdigest()
+
+    async def load(self):
+        if not self.path.exists():
+            self._answers = {}
+            return
+
+        try:
+            async with aiofiles.open(self.path, 'r', encoding='utf-8') as f:
+                self._answers = json.loads(await f.read())
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error reading answer archive {self.path}, no answers will be reused: {e}")
+            self._answers = {}
+
+    def reusable(self, question: Question, unchanged_paths: set[str]) -> Tuple[List[ModelAnswer], set[str]]:
+        """Returns the archived answers that can be reused for the question, and the files they cover for all of its models."""
+        question_answers = self._answers.get(self._question_key(question), {})
+        covered_per_model = []
+
+        for model in question.models:
+            covered = set()
+            for entry in question_answers.get(model, []):
+                if entry["files"] and set(entry["files"]) <= unchanged_paths:
+                    covered.update(entry["files"])
+            covered_per_model.append(covered)
+
+        covered = set.intersection(*covered_per_model) if covered_per_model else set()
+        answers = []
+
+        for model in question.models:
+            for entry in question_answers.get(model, []):
+                if entry["files"] and set(entry["files"]) <= covered:
+                    answers.append(ModelAnswer(model=model, answer=entry["answer"], content=Chunk.from_source_files(entry["files"]), ignore=entry["ignore"]))
+
+        return answers, covered
+
+    def update(self, question: Question, answers: List[ModelAnswer], stale_paths: set[str]):
+        """Replaces the archived answers of the stale files and of the files that were just answered again."""
+        question_answers = self._answers.setdefault(self._question_key(question), {})
+        answered_paths = {path for answer in answers for path in getattr(answer.content, "source_files", ())}
+        invalid_paths = stale_paths | answered_paths
+
+        for model in list(question_answers.keys()):
+            question_answers[model] = [entry for entry in question_answers[model] if not invalid_paths.intersection(entry["files"])]
+
+        for answer in answers:
+            source_files = getattr(answer.content, "source_files", ())
+            if answer.error or not source_files:
+                continue
+            question_answers.setdefault(answer.model, []).append({"files": list(source_files), "answer": answer.answer, "ignore": answer.ignore})
+
+    async def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+
+        async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+            await f.write(json.dumps(self._answers))
+
+        os.replace(tmp_path, self.path)
@@ -1,27 +1,177 @@
+import asyncio
+import difflib
 import json
-from typing import List
+from pathlib import Path
+from typing import List, Optional
 
-from code_saver import SaveStrategy,CodeSaver
+from code_saver import SaveStrategy
 from common_models import QuestionAnswer
 from response_formats.code_refactoring import CodeChange
 
+"""
+Saves the code changes of the structured answers. The changes of a file are merged with the changes already saved to
+it in the run, against the original file: the changes to different lines are both kept, the changes to the same
+lines are a conflict. A conflict is written with conflict markers (conflict_policy="markers") or resolved by keeping
+the change saved first (conflict_policy="keep-first"), and is reported in both cases. The files are saved
+concurrently, the changes of a same file one after the other.
+
+The code of an answer about a part of a file split by the chunker is the code of that part only, it's put in place of
+the part in the original file before being merged. The code of a chunk holding parts of a file that don't follow each
+other, or holding parts of files other than the one the change is for, can't be put in place: it isn't saved and is
+reported in unsaved instead.
+"""
+
+CONFLICT_POLICIES = ("markers", "keep-first")
+
+
+def _with_newline(lines: List[str]) -> List[str]:
+    return lines[:-1] + [lines[-1] + "\n"] if lines and not lines[-1].endswith("\n") else lines
+
+
+def merge_changes(original: str, current: str, incoming: str, label: str = "incoming", conflict_policy: str = "markers") -> tuple[str, int]:
+    """Merges the current and incoming versions of the original text, and returns the merged text with its number of conflicts."""
+    base = original.splitlines(keepends=True)
+    sides = {"current": current.splitlines(keepends=True), "incoming": incoming.splitlines(keepends=True)}
+    edits = sorted(
+        (start, end, side, lines[side_start:side_end])
+        for side, lines in sides.items()
+        for tag, start, end, side_start, side_end in difflib.SequenceMatcher(None, base, lines, autojunk=False).get_opcodes() if tag != "equal"
+    )
+
+    # The edits touching or overlapping each other are merged as one region of the original
+    regions = []
+    for edit in edits:
+        if regions and edit[0] <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], edit[1])
+            regions[-1][2].append(edit)
+        else:
+            regions.append([edit[0], edit[1], [edit]])
+
+    def version(start: int, end: int, region_edits: list, side: str) -> List[str]:
+        lines, position = [], start
+        for edit_start, edit_end, edit_side, edit_lines in region_edits:
+            if edit_side == side:
+                lines += base[position:edit_start] + edit_lines
+                position = edit_end
+        return lines + base[position:end]
+
+    merged, position, conflicts = [], 0, 0
+
+    for start, end, region_edits in regions:
+        merged += base[position:start]
+        position = end
+        current_lines = version(start, end, region_edits, "current")
+        incoming_lines = version(start, end, region_edits, "incoming")
+
+        if current_lines == incoming_lines or all(edit[2] == "current" for edit in region_edits):
+            merged += current_lines
+        elif all(edit[2] == "incoming" for edit in region_edits):
+            merged += incoming_lines
+        else:
+            conflicts += 1
+            if conflict_policy == "keep-first":
+                merged += current_lines
+            else:
+                merged += ["<<<<<<< current\n"] + _with_newline(current_lines) + ["=======\n"] + _with_newline(incoming_lines) + [f">>>>>>> {label}\n"]
+
+    return "".join(merged + base[position:]), conflicts
+
+
 class BatchCodeSaver:
-    def __init__(self, save_strategy: SaveStrategy):
+    def __init__(self, save_strategy: SaveStrategy, max_concurrency: int = 16, conflict_policy: str = "markers"):
+        if conflict_policy not in CONFLICT_POLICIES:
+            raise ValueError(f"Unknown conflict policy {conflict_policy}, expected one of {CONFLICT_POLICIES}")
+
         self.save_strategy = save_strategy
+        self.conflict_policy = conflict_policy
+        self.conflicts: List[dict] = []
+        self.unsaved: List[dict] = []
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._file_locks: dict[str, asyncio.Lock] = {}
+        # The original and last saved content of each file saved in the run
+        self._files: dict[str, tuple[str, str]] = {}
+
+    def _changes(self, question_answer: QuestionAnswer) -> List[CodeChange]:
+        # The answers parsed by the structured output are reused, the cached answers are parsed from their JSON
+        if question_answer.parsed is not None:
+            return list(question_answer.parsed.changes)
+
+        try:
+            content_dict = json.loads(question_answer.answer)
+            return [CodeChange(**change) for change in content_dict.get('changes', [])]
+        except (json.JSONDecodeError, TypeError, ValueError) as e:
+            print(f"Error parsing content: {e}")
+            return []
+
+    async def _read_original(self, file_path: str) -> str:
+        try:
+            return await asyncio.to_thread(Path(file_path).read_text, encoding='utf-8', errors='replace')
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def _part(self, chunk, file_path: str) -> Optional[tuple[int, Optional[int]]]:
+        """
+        The range of the file the chunk holds when it holds only a part of it. Raises a ValueError when the code of
+        the change can't be put in place of the parts of the chunk.
+        """
+        all_pieces = getattr(chunk, "pieces", ())
+        pieces = sorted((piece for piece in all_pieces if Path(str(piece.file.filepath)).resolve() == Path(file_path).resolve()), key=lambda piece: piece.start)
+
+        if not pieces:
+            if any(piece.start or piece.end is not None for piece in all_pieces):
+                raise ValueError("the chunk holds parts of split files, not the file of the change")
+            return None
+        if not any(piece.start or piece.end is not None for piece in pieces):
+            return None
+        if any(piece.end != following.start for piece, following in zip(pieces, pieces[1:])):
+            raise ValueError(f"the chunk holds parts of the file that don't follow each other: {[(piece.start, piece.end) for piece in pieces]}")
+        return pieces[0].start, pieces[-1].end
+
+    def _in_place(self, original: str, code: str, part: Optional[tuple[int, Optional[int]]]) -> str:
+        if part is None or original is None:
+            return code
+        start, end = part
+        replaced = original[start:end]
+        if replaced.endswith("\n") and not code.endswith("\n"):
+            code += "\n"
+        return original[:start] + code + (original[end:] if end is not None else "")
+
+    async def _save_file(self, file_path: str, changes: List[tuple[str, CodeChange, Optional[tuple[int, Optional[int]]]]]):
+        async with self._file_locks.setdefault(file_path, asyncio.Lock()), self._semaphore:
+            if file_path in self._files:
+                original, current = self._files[file_path]
+            else:
+                original, current = await self._read_original(file_path), None
+
+            for model, code_change, part in changes:
+                code = self._in_place(original, code_change.code, part)
+
+                if current is None or current == code:
+                    current = code
+                    continue
+
+                current, conflicts = merge_changes(original or "", current, code, label=model, conflict_policy=self.conflict_policy)
+
+                if conflicts:
+                    self.conflicts.append({"file": file_path, "model": model, "conflicts": conflicts})
+                    print(f"{conflicts} conflicting changes of model {model} to {file_path}, {'kept the first change' if self.conflict_policy == 'keep-first' else 'written with conflict markers'}")
+
+            self._files[file_path] = (original, current)
+            await self.save_strategy.save(file_path, current, original)
 
     async def save(self, result: List[List[QuestionAnswer]]):
+        file_changes: dict[str, List[tuple[str, CodeChange, Optional[tuple[int, Optional[int]]]]]] = {}
+
         for question_model_answers in result:
             for question_answer in question_model_answers:
-                try:
-                    # print(f"answer to be saved as code: {question_answer.answer}")
-                    content_dict = json.loads(question_answer.answer)
-                    changes = [CodeChange(**change) for change in content_dict.get('changes', [])]
-                except (json.JSONDecodeError, TypeError, ValueError) as e:
-                    print(f"Error parsing content: {e}")
-                    changes = []
-                
-                print(f"changes to save: {len(changes)}")
-                for code_change in changes:
-                    # print(f"saving code: {code_change.code} at {code_change.destination_file_name}")
-                    code_saver = CodeSaver(code_change, self.save_strategy)
-                    await code_saver.save_code_to_file()
\ No newline at end of file
+                for code_change in self._changes(question_answer):
+                    try:
+                        part = self._part(question_answer.content, code_change.source_file)
+                    except ValueError as e:
+                        self.unsaved.append({"file": code_change.source_file, "model": question_answer.model, "reason": str(e)})
+                        print(f"Not saving the change of model {question_answer.model} to {code_change.source_file}, {e}")
+                        continue
+                    file_changes.setdefault(code_change.source_file, []).append((question_answer.model, code_change, part))
+
+        print(f"changes to save: {sum(len(changes) for changes in file_changes.values())} in {len(file_changes)} files")
+        await asyncio.gather(*[self._save_file(file_path, changes) for file_path, changes in file_changes.items()])
@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+from typing import List
+
+from dotenv import load_dotenv
+
+from batch_code_saver import BatchCodeSaver
+from checkpoint_journal import CheckpointJournal
+from chunker import ChunkPerFile
+from code_saver import DiffSaveStrategy, FileSaveStrategy
+from common_models import FileType, Question, RetrievalMode
+from file_deduplicator import FileDeduplicator
+from file_processor import FileProcessor
+from model_config import ModelConfigParser
+from openai_client_factory import OpenAIClientFactory
+from output_persistor import OutputPersistor
+from pipeline import Pipeline
+from repository_copilot import RepositoryCoPilot
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from response_formats.code_refactoring import CodeRefactoringResponseFormat
+from result_store import ResultStore
+from retrieval_index import BM25Index
+from token_counter import TokenCounter, create_token_counter
+
+"""
+Analyses many repositories in one process: the pipelines of the repositories share one OpenAIClientFactory (and its
+connection pools, deployments and circuit breakers), one RequestScheduler (so the rate limits of the models hold for
+all of them together) and one response cache. At most max_repositories pipelines run at a time, and each repository
+can cap its own requests in flight with max_concurrency so a large repository doesn't take all the quota.
+
+Each repository gets its own output directory (with its answers, result store, journal and retrieval index), and a
+summary of all the repositories is written to batch_summary.json in the output directory.
+
+    python batch_runner.py batch_config.json [--resume]
+
+The configuration file:
+    {
+        "output_dir": "./output/batch",
+        "max_repositories": 4,
+        "streaming": false,
+        "code_output": "mirror",
+        "deduplication": "near",
+        "questions": [{"text": "What are the cloud services used in this project?", "enabled": true, "models": ["gpt-4o"]}],
+        "repositories": [
+            {"directory": "./repos/service-a"},
+            {"directory": "./repos/service-b", "name": "b", "max_concurrency": 8, "questions": [...]}
+        ]
+    }
+A question takes the arguments of Question, with the file types, retrieval mode and response format (one of
+RESPONSE_FORMATS) by name. The questions of a repository replace the shared ones.
+"""
+
+RESPONSE_FORMATS = {"code_refactoring": CodeRefactoringResponseFormat}
+
+
+def parse_question(entry: dict) -> Question:
+    entry = dict(entry)
+
+    if "allowed_file_types" in entry:
+        entry["allowed_file_types"] = [FileType(file_type) for file_type in entry["allowed_file_types"]]
+    if "retrieval_mode" in entry:
+        entry["retrieval_mode"] = RetrievalMode(entry["retrieval_mode"])
+    if "response_format" in entry:
+        if entry["response_format"] not in RESPONSE_FORMATS:
+            raise ValueError(f"Unknown response format {entry['response_format']}, expected one of {list(RESPONSE_FORMATS)}")
+        entry["response_format"] = RESPONSE_FORMATS[entry["response_format"]]
+
+    return Question(**entry)
+
+
+class RepositoryJob:
+    def __init__(self, directory: str, output_dir: str, questions: List[Question], name: str = None, max_concurrency: int = None):
+        self.directory = directory
+        self.name = name if name else Path(directory).resolve().name
+        self.output_dir = Path(output_dir)
+        self.questions = questions
+        self.max_concurrency = max_concurrency
+
+
+def parse_config(path: str) -> tuple[dict, List[RepositoryJob]]:
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    output_dir = Path(config.get("output_dir", "./output/batch"))
+    questions = [parse_question(question) for question in config.get("questions", [])]
+    jobs = []
+
+    for repository in config["repositories"]:
+        name = repository.get("name") or Path(repository["directory"]).resolve().name
+        repository_questions = [parse_question(question) for question in repository["questions"]] if "questions" in repository else questions
+        jobs.append(RepositoryJob(repository["directory"], output_dir / name, repository_questions, name=name, max_concurrency=repository.get("max_concurrency")))
+
+    if len({job.name for job in jobs}) < len(jobs):
+        raise ValueError("The repositories must have distinct names, set the name of the ones sharing a directory name")
+
+    return config, jobs
+
+
+class BatchRunner:
+    def __init__(self, openai_client_factory: OpenAIClientFactory, request_scheduler: RequestScheduler, response_cache: ResponseCache = None,
+                 token_counter: TokenCounter = None, max_repositories: int = 4, streaming: bool = False, resume: bool = False,
+                 code_output: str = "in-place", conflict_policy: str = "markers", batch_questions: bool = False,
+                 deduplication: str = "exact"):
+        self.openai_client_factory = openai_client_factory
+        self.request_scheduler = request_scheduler
+        self.response_cache = response_cache
+        self.token_counter = token_counter if token_counter else create_token_counter()
+        self.max_repositories = max_repositories
+        self.streaming = streaming
+        self.resume = resume
+        self.code_output = code_output
+        self.conflict_policy = conflict_policy
+        self.batch_questions = batch_questions
+        self.deduplication = deduplication
+
+    def _save_strategy(self, job: RepositoryJob):
+        if self.code_output == "diff":
+            return DiffSaveStrategy(diff_path=str(job.output_dir / "changes.diff"), root=job.directory)
+        if self.code_output == "mirror":
+            return FileSaveStrategy(output_dir=str(job.output_dir / "code"), root=job.directory)
+        return FileSaveStrategy()
+
+    async def run_repository(self, job: RepositoryJob) -> dict:
+        job.output_dir.mkdir(parents=True, exist_ok=True)
+        journal = CheckpointJournal(str(job.output_dir / "journal.jsonl"), resume=self.resume)
+        resultStore = ResultStore(str(job.output_dir / "results.sqlite"))
+        retrievalIndex = BM25Index(str(job.output_dir / "retrieval_index.sqlite"))
+        batchCodeSaver = BatchCodeSaver(save_strategy=self._save_strategy(job), conflict_policy=self.conflict_policy)
+        fileDeduplicator = FileDeduplicator(near_duplicates=self.deduplication == "near") if self.deduplication != "off" else None
+        outputPersistor = OutputPersistor(str(job.output_dir))
+        repoCoPilot = RepositoryCoPilot(openai_client_factory=self.openai_client_factory, request_scheduler=self.request_scheduler, response_cache=self.response_cache,
+                                        token_counter=self.token_counter, batch_questions=self.batch_questions, result_store=resultStore, journal=journal,
+                                        max_concurrency=job.max_concurrency, output_persistor=outputPersistor)
+        pipeline = Pipeline(job.questions, FileProcessor(directory=job.directory), repoCoPilot, ChunkPerFile(token_counter=self.token_counter),
+                            outputPersistor, batchCodeSaver, retrievalIndex=retrievalIndex, resultStore=resultStore,
+                            fileDeduplicator=fileDeduplicator)
+
+        summary = {"repository": job.name, "directory": job.directory, "status": "ok", "error": None}
+        start_time = time.perf_counter()
+
+        try:
+            if not Path(job.directory).is_dir():
+                raise FileNotFoundError(f"The repository directory {job.directory} doesn't exist")
+            result = await (pipeline.run_streaming() if self.streaming else pipeline.run())
+            summary["answers"] = sum(len(question_answers) for question_answers in result)
+        except Exception as e:
+            print(f"Analysis of repository {job.name} failed: {e}")
+            summary.update(status="failed", error=f"{type(e).__name__}: {e}")
+        finally:
+            journal.close()
+            resultStore.close()
+            retrievalIndex.close()
+
+        summary.update(seconds=round(time.perf_counter() - start_time, 1), usage=repoCoPilot.usage_stats(), stored_answers=resultStore.written,
+                       resumed_answers=journal.resumed_answers, code_conflicts=len(batchCodeSaver.conflicts),
+                       unsaved_code_changes=len(batchCodeSaver.unsaved), duplicates=fileDeduplicator.stats() if fileDeduplicator else None)
+        print(f"Repository {job.name}: {summary['status']} in {summary['seconds']}s, {summary['usage']['requests']} requests")
+        return summary
+
+    async def run(self, jobs: List[RepositoryJob]) -> dict:
+        semaphore = asyncio.Semaphore(self.max_repositories)
+
+        async def run_limited(job: RepositoryJob) -> dict:
+            async with semaphore:
+                return await self.run_repository(job)
+
+        start_time = time.perf_counter()
+        repositories = await asyncio.gather(*[run_limited(job) for job in jobs])
+
+        return {
+            "repositories": repositories,
+            "succeeded": sum(1 for repository in repositories if repository["status"] == "ok"),
+            "failed": sum(1 for repository in repositories if repository["status"] != "ok"),
+            "seconds": round(time.perf_counter() - start_time, 1),
+            "requests": sum(repository["usage"]["requests"] for repository in repositories),
+            "prompt_tokens": sum(repository["usage"]["prompt_tokens"] for repository in repositories),
+            "completion_tokens": sum(repository["usage"]["completion_tokens"] for repository in repositories),
+            "deployments": self.openai_client_factory.stats(),
+            "transports": self.openai_client_factory.transport_stats(),
+            "response_cache": self.response_cache.stats() if self.response_cache else None,
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Analyses a list of repositories in one process")
+    parser.add_argument("config", help="The batch configuration file")
+    parser.add_argument("--resume", action="store_true", help="Resumes each repository from its journal")
+    args = parser.parse_args()
+
+    config, jobs = parse_config(args.config)
+    output_dir = Path(config.get("output_dir", "./output/batch"))
+    openAIClientFactory = OpenAIClientFactory(model_config_parser=ModelConfigParser(config.get("model_config")))
+    responseCache = ResponseCache(str(output_dir / "response_cache.sqlite"), max_age_seconds=7 * 24 * 3600, bypass=os.getenv("RESPONSE_CACHE_BYPASS", "false").lower() == "true")
+    batchRunner = BatchRunner(openAIClientFactory, RequestScheduler(openai_client_factory=openAIClientFactory), response_cache=responseCache,
+                              max_repositories=config.get("max_repositories", 4), streaming=config.get("streaming", False), resume=args.resume,
+                              code_output=config.get("code_output", "in-place"), conflict_policy=config.get("conflict_policy", "markers"),
+                              batch_questions=config.get("batch_questions", False), deduplication=config.get("deduplication", "exact"))
+
+    try:
+        summary = await batchRunner.run(jobs)
+    finally:
+        responseCache.close()
+        await openAIClientFactory.close()
+
+    summary_path = output_dir / "batch_summary.json"
+    summary_path.write_text(json.dumps(summary, indent=2))
+    print(f"{summary['succeeded']} repositories analysed, {summary['failed']} failed in {summary['seconds']}s with {summary['requests']} requests, "
+          f"{summary['prompt_tokens']} prompt and {summary['completion_tokens']} completion tokens. Summary written to {summary_path}")
+
+
+if __name__ == "__main__":
+    load_dotenv(".env")
+    asyncio.run(main())
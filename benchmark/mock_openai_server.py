@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+"""
+A local stand-in for an OpenAI compatible endpoint, to benchmark the pipeline without spending any quota.
+
+It answers POST .../chat/completions (the OpenAI and the Azure deployment routes), with or without streaming, and
+with a JSON answer matching the schema of the request when a structured output is asked. The behaviour is set with:
+    - latency_mean / latency_stddev: the seconds before the first token, drawn from a normal distribution.
+    - rate_limit_ratio: the share of the requests answered with a 429 and a Retry-After header.
+    - tokens_per_second / output_tokens: the generation speed and the length of the answers.
+GET /stats returns the number of requests, 429s and tokens served so far.
+
+    python -m benchmark.mock_openai_server --port 8765 --latency-mean 0.8 --rate-limit-ratio 0.05
+"""
+
+
+class MockOpenAIServer:
+    def __init__(self, host="127.0.0.1", port=8765, latency_mean=0.5, latency_stddev=0.2, rate_limit_ratio=0.0, retry_after=1.0,
+                 tokens_per_second=100.0, output_tokens=200, seed=None):
+        self.host = host
+        self.port = port
+        self.latency_mean = latency_mean
+        self.latency_stddev = latency_stddev
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self._random = random.Random(seed)
+        self.stats = {"requests": 0, "rate_limited": 0, "streamed": 0, "prompt_tokens": 0, "completion_tokens": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def _latency(self) -> float:
+        return max(0.0, self._random.gauss(self.latency_mean, self.latency_stddev))
+
+    def _example(self, schema: dict, definitions: dict):
+        """A value matching the JSON schema, with one item in the arrays."""
+        if "$ref" in schema:
+            return self._example(definitions[schema["$ref"].split("/")[-1]], definitions)
+        if "anyOf" in schema:
+            return self._example(schema["anyOf"][0], definitions)
+
+        schema_type = schema.get("type")
+        if schema_type == "object":
+            return {name: self._example(value, definitions) for name, value in schema.get("properties", {}).items()}
+        if schema_type == "array":
+            return [self._example(schema.get("items", {}), definitions)]
+        if schema_type == "integer":
+            return 1
+        if schema_type == "number":
+            return 1.0
+        if schema_type == "boolean":
+            return False
+        if schema_type == "null":
+            return None
+        return "lorem ipsum"
+
+    def _answer(self, body: dict) -> str:
+        response_format = body.get("response_format") or {}
+
+        if response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            return json.dumps(self._example(schema, schema.get("$defs", {})))
+
+        tokens = min(self.output_tokens, body.get("max_tokens") or self.output_tokens)
+        return " ".join(f"token{index}" for index in range(tokens))
+
+    async def _write_response(self, writer: asyncio.StreamWriter, status: str, body: bytes, headers: dict = None):
+        head = [f"HTTP/1.1 {status}", "Content-Type: application/json", f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def _chat_completion(self, writer: asyncio.StreamWriter, body: dict):
+        self.stats["requests"] += 1
+
+        if self._random.random() < self.rate_limit_ratio:
+            self.stats["rate_limited"] += 1
+            error = json.dumps({"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded", "code": "429"}}).encode()
+            await self._write_response(writer, "429 Too Many Requests", error, {"Retry-After": self.retry_after})
+            return
+
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in body.get("messages", [])) // 4
+        answer = self._answer(body)
+        words = answer.split(" ")
+        completion_tokens = len(words)
+        model = body.get("model", "mock")
+        created = int(time.time())
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+
+        await asyncio.sleep(self._latency())
+
+        if not body.get("stream"):
+            await asyncio.sleep(completion_tokens / self.tokens_per_second)
+            response = {
+                "id": f"chatcmpl-{self.stats['requests']}", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+            await self._write_response(writer, "200 OK", json.dumps(response).encode())
+            return
+
+        self.stats["streamed"] += 1
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+
+        def event(choices, usage=None) -> bytes:
+            chunk = {"id": f"chatcmpl-{self.stats['requests']}", "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices, "usage": usage}
+            return f"data: {json.dumps(chunk)}\n\n".encode()
+
+        for index, word in enumerate(words):
+            content = word if index == 0 else " " + word
+            writer.write(event([{"index": 0, "delta": {"role": "assistant", "content": content} if index == 0 else {"content": content}, "finish_reason": None}]))
+            await writer.drain()
+            await asyncio.sleep(1 / self.tokens_per_second)
+
+        writer.write(event([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            writer.write(event([], usage))
+        writer.write(b"data: [DONE]\n\n")
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = path.split("?")[0]
+
+                if method == "GET" and path.endswith("/stats"):
+                    await self._write_response(writer, "200 OK", json.dumps(self.stats).encode())
+                elif method == "POST" and path.endswith("/chat/completions"):
+                    self.stats["in_flight"] += 1
+                    self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+                    try:
+                        request = json.loads(body or b"{}")
+                        await self._chat_completion(writer, request)
+                    finally:
+                        self.stats["in_flight"] -= 1
+                    if request.get("stream"):
+                        break
+                else:
+                    await self._write_response(writer, "404 Not Found", b'{"error": {"message": "Not found"}}')
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Mock OpenAI server listening on http://{self.host}:{self.port}/v1", flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="A local OpenAI compatible endpoint for the benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-mean", type=float, default=0.5)
+    parser.add_argument("--latency-stddev", type=float, default=0.2)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--output-tokens", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.host, args.port, args.latency_mean, args.latency_stddev, args.rate_limit_ratio, args.retry_after,
+                              args.tokens_per_second, args.output_tokens, args.seed)
+    asyncio.run(server.serve())
+
+
+if __name__ == "__main__":
+    main()
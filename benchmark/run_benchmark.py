@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import functools
+import inspect
+import json
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from batch_code_saver import BatchCodeSaver
+from benchmark.synthetic_repository import generate_repository
+from chunker import ChunkPerFile, MaxSizeChunker
+from code_saver import FileSaveStrategy
+from common_models import Question
+from file_processor import FileProcessor
+from model_config import ModelConfigParser
+from openai_client_factory import OpenAIClientFactory
+from output_persistor import OutputPersistor
+from pipeline import Pipeline
+from repository_copilot import RepositoryCoPilot
+from request_scheduler import RequestScheduler
+from token_counter import create_token_counter
+
+"""
+Runs the pipeline end to end against the mock OpenAI server on a synthetic repository, and writes the results as JSON
+to ./output/benchmarks so the runs of different versions can be compared.
+
+The results hold the wall time, the requests per second, the peak RSS of the process, the mock server counters and
+the timings of the FileProcessor, Chunker and RepositoryCoPilot stages: the number of calls, the time spent in them
+(summed over the concurrent calls) and the wall time from the first call to the end of the last one.
+
+    python -m benchmark.run_benchmark --files 500 --questions 3 --latency-mean 0.3 --rate-limit-ratio 0.05
+    python -m benchmark.run_benchmark --compare output/benchmarks/<previous run>.json
+"""
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages: dict[str, dict] = {}
+
+    def _record(self, stage: str, start: float, end: float):
+        timing = self.stages.setdefault(stage, {"calls": 0, "busy_seconds": 0.0, "first_start": start, "last_end": end})
+        timing["calls"] += 1
+        timing["busy_seconds"] += end - start
+        timing["first_start"] = min(timing["first_start"], start)
+        timing["last_end"] = max(timing["last_end"], end)
+
+    def wrap(self, stage: str, instance, method_name: str):
+        method = getattr(instance, method_name)
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    self._record(stage, start, time.perf_counter())
+        else:
+            @functools.wraps(method)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self._record(stage, start, time.perf_counter())
+
+        setattr(instance, method_name, timed)
+
+    def results(self) -> dict[str, dict]:
+        return {
+            stage: {"calls": timing["calls"], "busy_seconds": round(timing["busy_seconds"], 3), "wall_seconds": round(timing["last_end"] - timing["first_start"], 3)}
+            for stage, timing in self.stages.items()
+        }
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(args, port: int) -> subprocess.Popen:
+    server = subprocess.Popen([
+        sys.executable, "-m", "benchmark.mock_openai_server", "--port", str(port),
+        "--latency-mean", str(args.latency_mean), "--latency-stddev", str(args.latency_stddev),
+        "--rate-limit-ratio", str(args.rate_limit_ratio), "--retry-after", str(args.retry_after),
+        "--tokens-per-second", str(args.tokens_per_second), "--output-tokens", str(args.output_tokens), "--seed", str(args.seed),
+    ], cwd=ROOT)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return server
+        except OSError:
+            time.sleep(0.05)
+
+    server.kill()
+    raise RuntimeError(f"The mock server didn't start on port {port}")
+
+
+def _server_stats(port: int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/v1/stats", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(args) -> dict:
+    # The generated repository, the model configuration and the outputs of the run, removed once it's measured
+    work_dir = Path(tempfile.mkdtemp(prefix="code-analysis-benchmark-"))
+    server = None
+
+    try:
+        repository = generate_repository(work_dir / "repository", files=args.files, mean_file_size=args.mean_file_size, seed=args.seed)
+        port = _free_port()
+        models = [f"mock-model-{index}" for index in range(args.models)]
+
+        model_config_path = work_dir / "model_config.json"
+        model_config_path.write_text(json.dumps([{
+            "model_name": models, "platform": "openai", "model_endpoint": f"http://127.0.0.1:{port}/v1", "api_key": "benchmark",
+            "retries": args.retries, "max_concurrency": args.max_concurrency, "context_window": args.context_window, "max_output_tokens": args.output_tokens * 2,
+        }]))
+
+        questions = [Question(text=f"Benchmark question {index}: what does this code do?", enabled=True, models=models) for index in range(args.questions)]
+        timer = StageTimer()
+        server = _start_server(args, port)
+
+        openAIClientFactory = OpenAIClientFactory(model_config_parser=ModelConfigParser(str(model_config_path)))
+        tokenCounter = create_token_counter()
+        requestScheduler = RequestScheduler(openai_client_factory=openAIClientFactory)
+        outputPersistor = OutputPersistor(str(work_dir / "output"))
+        repoCoPilot = RepositoryCoPilot(openai_client_factory=openAIClientFactory, request_scheduler=requestScheduler, token_counter=tokenCounter,
+                                        batch_questions=args.batch_questions, stream_completions=args.stream_completions, output_persistor=outputPersistor)
+        chunker = MaxSizeChunker(token_counter=tokenCounter) if args.chunker == "max-size" else ChunkPerFile(token_counter=tokenCounter)
+        fileProcessor = FileProcessor(directory=str(repository))
+
+        timer.wrap("FileProcessor.read_batch", fileProcessor, "_read_batch")
+        timer.wrap("Chunker.chunk_files", chunker, "chunk_files")
+        timer.wrap("Chunker.chunk_file", chunker, "chunk_file")
+        timer.wrap("RepositoryCoPilot.ask_chunk", repoCoPilot, "ask_chunk")
+        timer.wrap("RepositoryCoPilot.refine_group", repoCoPilot, "refine_group")
+
+        pipeline = Pipeline(questions, fileProcessor, repoCoPilot, chunker, outputPersistor, BatchCodeSaver(save_strategy=FileSaveStrategy()))
+
+        start_time = time.perf_counter()
+        if args.streaming:
+            await pipeline.run_streaming()
+        else:
+            await pipeline.run()
+        wall_time = time.perf_counter() - start_time
+
+        server_stats = _server_stats(port)
+        await openAIClientFactory.close()
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "label": args.label,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("compare", "output_dir")},
+        "wall_seconds": round(wall_time, 3),
+        "requests": server_stats["requests"],
+        "requests_per_second": round(server_stats["requests"] / wall_time, 2) if wall_time else None,
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "server": server_stats,
+        "stages": timer.results(),
+        "scheduler": requestScheduler.stats(),
+        "deployments": openAIClientFactory.stats(),
+        "transports": openAIClientFactory.transport_stats(),
+        "stream": repoCoPilot.stream_stats(),
+    }
+
+
+def compare(current: dict, previous: dict):
+    print(f"{'metric':<40}{'previous':>14}{'current':>14}{'change':>10}")
+    metrics = [("wall_seconds", previous.get("wall_seconds"), current.get("wall_seconds")),
+               ("requests", previous.get("requests"), current.get("requests")),
+               ("requests_per_second", previous.get("requests_per_second"), current.get("requests_per_second")),
+               ("peak_rss_mb", previous.get("peak_rss_mb"), current.get("peak_rss_mb"))]
+    metrics += [(f"{stage}.wall_seconds", previous.get("stages", {}).get(stage, {}).get("wall_seconds"), timing["wall_seconds"]) for stage, timing in current["stages"].items()]
+
+    for name, before, after in metrics:
+        change = f"{(after - before) / before:+.1%}" if before and after is not None else ""
+        print(f"{name:<40}{str(before):>14}{str(after):>14}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline against a local mock of the OpenAI API")
+    parser.add_argument("--label", default="benchmark")
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--mean-file-size", type=int, default=4000)
+    parser.add_argument("--questions", type=int, default=2)
+    parser.add_argument("--models", type=int, default=1)
+    parser.add_argument("--chunker", choices=["per-file", "max-size"], default="per-file")
+    parser.add_argument("--streaming", action="store_true", help="Run the streaming pipeline")
+    parser.add_argument("--batch-questions", action="store_true")
+    parser.add_argument("--stream-completions", action="store_true")
+    parser.add_argument("--max-concurrency", type=int, default=64)
+    parser.add_argument("--context-window", type=int, default=128000)
+    parser.add_argument("--retries", type=int, default=4)
+    parser.add_argument("--latency-mean", type=float, default=0.2)
+    parser.add_argument("--latency-stddev", type=float, default=0.05)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--output-tokens", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "benchmarks"))
+    parser.add_argument("--compare", help="A previous results file to compare the run with")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results_path = output_dir / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{args.label}.json"
+    results_path.write_text(json.dumps(results, indent=2))
+
+    print(json.dumps({key: results[key] for key in ("wall_seconds", "requests", "requests_per_second", "peak_rss_mb", "stages")}, indent=2))
+    print(f"Results written to {results_path}")
+
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text()))
+
+
+if __name__ == "__main__":
+    main()
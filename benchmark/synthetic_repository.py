@@ -0,0 +1,100 @@
+import random
+from pathlib import Path
+
+"""
+Generates synthetic repositories for the benchmarks, with a given number of files, mix of file types and file size.
+The files look like source code (classes, functions, imports, some AWS SDK calls) so the chunkers, the token counter
+and the retrieval index see realistic text. The same seed always generates the same repository.
+"""
+
+DEFAULT_FILE_MIX = {".py": 0.35, ".java": 0.3, ".ts": 0.15, ".md": 0.1, ".json": 0.1}
+
+WORDS = ["order", "customer", "invoice", "payment", "queue", "bucket", "report", "user", "account", "event", "message",
+         "storage", "config", "client", "service", "handler", "cache", "record", "batch", "token"]
+
+CLOUD_CALLS = ["s3.put_object", "sqs.send_message", "sns.publish", "dynamodb.put_item", "lambda_client.invoke"]
+
+
+def _name(rng: random.Random, parts=2) -> str:
+    return "_".join(rng.choice(WORDS) for _ in range(parts))
+
+
+def _camel(name: str) -> str:
+    return "".join(part.capitalize() for part in name.split("_"))
+
+
+def _python(rng: random.Random, size: int) -> str:
+    lines = ["import boto3", "import json", ""]
+    while sum(len(line) + 1 for line in lines) < size:
+        name = _name(rng)
+        lines += [f"class {_camel(name)}:", f"    def __init__(self, {name}_id):", f"        self.{name}_id = {name}_id", ""]
+        for _ in range(rng.randint(1, 4)):
+            function = _name(rng)
+            call = rng.choice(CLOUD_CALLS) if rng.random() < 0.2 else f"self.{_name(rng)}"
+            lines += [f"    def {function}(self, value):", f"        result = {call}(value)", f"        return json.dumps(result)", ""]
+    return "\n".join(lines)
+
+
+def _java(rng: random.Random, size: int) -> str:
+    lines = ["package com.example.benchmark;", "", "import java.util.List;", ""]
+    while sum(len(line) + 1 for line in lines) < size:
+        name = _camel(_name(rng))
+        lines += [f"public class {name} {{", f"    private final String id;", ""]
+        for _ in range(rng.randint(1, 4)):
+            method = _camel(_name(rng))
+            lines += [f"    public List<String> get{method}(String value) {{", f"        return List.of(value, id);", "    }", ""]
+        lines += ["}", ""]
+    return "\n".join(lines)
+
+
+def _typescript(rng: random.Random, size: int) -> str:
+    lines = ["import { Injectable } from './core';", ""]
+    while sum(len(line) + 1 for line in lines) < size:
+        name = _camel(_name(rng))
+        lines += [f"export class {name} {{"]
+        for _ in range(rng.randint(1, 4)):
+            lines += [f"  async {_camel(_name(rng)).lower()}(value: string): Promise<string> {{", "    return value.trim();", "  }"]
+        lines += ["}", ""]
+    return "\n".join(lines)
+
+
+def _markdown(rng: random.Random, size: int) -> str:
+    lines = [f"# {_camel(_name(rng))}", ""]
+    while sum(len(line) + 1 for line in lines) < size:
+        lines += [f"## {_camel(_name(rng))}", " ".join(rng.choice(WORDS) for _ in range(40)), ""]
+    return "\n".join(lines)
+
+
+def _json(rng: random.Random, size: int) -> str:
+    entries = []
+    while sum(len(entry) + 2 for entry in entries) < size:
+        entries.append(f'  "{_name(rng)}": "{_name(rng, 3)}"')
+    return "{\n" + ",\n".join(entries) + "\n}\n"
+
+
+GENERATORS = {".py": _python, ".java": _java, ".ts": _typescript, ".md": _markdown, ".json": _json}
+
+
+def generate_repository(directory, files=200, file_mix: dict[str, float] = None, mean_file_size=4000, max_depth=4, seed=0) -> Path:
+    """Writes the repository to directory (removing the files of a previous generation) and returns its path."""
+    directory = Path(directory)
+    file_mix = file_mix or DEFAULT_FILE_MIX
+    rng = random.Random(seed)
+    suffixes = list(file_mix.keys())
+    weights = list(file_mix.values())
+
+    if directory.exists():
+        for path in sorted(directory.rglob("*"), reverse=True):
+            if path.is_dir():
+                path.rmdir()
+            else:
+                path.unlink()
+
+    for index in range(files):
+        suffix = rng.choices(suffixes, weights)[0]
+        folder = directory.joinpath(*[rng.choice(WORDS) for _ in range(rng.randint(0, max_depth))])
+        folder.mkdir(parents=True, exist_ok=True)
+        size = max(100, int(rng.expovariate(1 / mean_file_size)))
+        (folder / f"{_name(rng)}_{index}{suffix}").write_text(GENERATORS.get(suffix, _markdown)(rng, size), encoding="utf-8")
+
+    return directory
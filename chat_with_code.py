@@ -1,12 +1,15 @@
+import argparse
 import asyncio
-from threading import Lock
 import threading
 from openai import AsyncAzureOpenAI
 import os
 import os
 
+from answer_archive import AnswerArchive
 from chunker import ChunkPerFile, Chunker
-from common_models import FileType, PipelineSteps, Question
+from common_models import FileType, PipelineSteps, Question, RetrievalMode
+from file_deduplicator import FileDeduplicator
+from file_manifest import FileManifest
 from file_processor import FileProcessor
 from model_config import ModelConfigParser
 from openai_client_factory import OpenAIClientFactory
@@ -14,16 +17,23 @@ from output_persistor import OutputPersistor
 from pipeline import Pipeline
 from progress_reporter import ProgressReporter
 from repository_copilot import RepositoryCoPilot
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from result_store import ResultStore
+from retrieval_index import BM25Index
+from token_counter import create_token_counter
+from tracing import Tracer
 from dotenv import load_dotenv
 from response_formats.code_refactoring import CodeRefactoringResponseFormat
 from batch_code_saver import BatchCodeSaver
-from code_saver import FileSaveStrategy
+from checkpoint_journal import CheckpointJournal
+from code_saver import DiffSaveStrategy, FileSaveStrategy
 
 
 # Load environment variables from .env file
 load_dotenv(".env")
 
-async def main():
+async def main(resume: bool = False):
     # You can change this to any directory you want to analyze
 
     questions = [
@@ -45,7 +55,10 @@ async def main():
         Question(
             text="What are the cloud services used in this project?", 
             enabled=False,
-            models=["gpt-4o", "gpt-4o-mini"]
+            models=["gpt-4o", "gpt-4o-mini"],
+            retrieval_mode=RetrievalMode.TOP_K,
+            retrieval_top_k=50,
+            retrieval_query="cloud aws azure gcp s3 sqs sns dynamodb lambda blob storage queue bucket region credentials endpoint"
         ),
         Question(
             text="Provide a brief overview of the architecture of this project?", 
@@ -114,34 +127,79 @@ async def main():
     ]
 
     directory = "./repos/mmf-java-consume-cost-change"
-    lock = Lock()
-    
     stop_event = threading.Event()
     
-    progress_reporter = ProgressReporter(lock=lock, steps=[
+    progress_reporter = ProgressReporter(steps=[
         PipelineSteps.READING_FILES,
         PipelineSteps.CHUNKING,
         PipelineSteps.ANSWERING_QUESTIONS,
         PipelineSteps.REFINING_ANSWERS,
         PipelineSteps.GENERATING_OUTPUT
-    ], stop_event=stop_event)
+    ], stop_event=stop_event, mode=os.getenv("PROGRESS_MODE", "auto"))
 
     progress_reporter_thread = threading.Thread(target=progress_reporter.report, daemon=True)
     progress_reporter_thread.start()
     
     fileProcessor = FileProcessor(directory=directory, progress_reporter=progress_reporter)
+    tracer = Tracer(enabled=os.getenv("TRACING", "false").lower() == "true")
     openAIClientFactory = OpenAIClientFactory(model_config_parser=ModelConfigParser())
-    repoCoPilot = RepositoryCoPilot(openai_client_factory=openAIClientFactory, progress_reporter=progress_reporter)
-    chunker = ChunkPerFile(progress_reporter=progress_reporter)
+    tokenCounter = create_token_counter()
+    requestScheduler = RequestScheduler(openai_client_factory=openAIClientFactory)
+    responseCache = ResponseCache(max_age_seconds=7 * 24 * 3600, bypass=os.getenv("RESPONSE_CACHE_BYPASS", "false").lower() == "true")
     outputPersistor = OutputPersistor()
-    batchCodeSaver = BatchCodeSaver(save_strategy=FileSaveStrategy())
+    journal = CheckpointJournal(resume=resume)
+    resultStore = ResultStore(synchronous=os.getenv("RESULT_STORE_SYNCHRONOUS", "NORMAL"))
+    repoCoPilot = RepositoryCoPilot(openai_client_factory=openAIClientFactory, progress_reporter=progress_reporter, request_scheduler=requestScheduler, response_cache=responseCache, token_counter=tokenCounter, batch_questions=os.getenv("QUESTION_BATCHING", "false").lower() == "true",
+                                    stream_completions=os.getenv("STREAM_COMPLETIONS", "false").lower() == "true", output_persistor=outputPersistor, tracer=tracer, result_store=resultStore, journal=journal)
+    chunker = ChunkPerFile(progress_reporter=progress_reporter, token_counter=tokenCounter)
+    codeOutput = os.getenv("CODE_OUTPUT", "in-place")
+    saveStrategy = DiffSaveStrategy() if codeOutput == "diff" else FileSaveStrategy(output_dir="./output/code" if codeOutput == "mirror" else None)
+    batchCodeSaver = BatchCodeSaver(save_strategy=saveStrategy, conflict_policy=os.getenv("CODE_CONFLICT_POLICY", "markers"))
+
+    incremental = os.getenv("INCREMENTAL_ANALYSIS", "false").lower() == "true"
+    fileManifest = FileManifest() if incremental else None
+    answerArchive = AnswerArchive() if incremental else None
+    retrievalIndex = BM25Index()
+    deduplication = os.getenv("FILE_DEDUPLICATION", "exact")
+    fileDeduplicator = FileDeduplicator(near_duplicates=deduplication == "near") if deduplication != "off" else None
 
     pipeline = Pipeline(questions, fileProcessor,
-                        repoCoPilot, chunker, outputPersistor, batchCodeSaver)
+                        repoCoPilot, chunker, outputPersistor, batchCodeSaver,
+                        fileManifest=fileManifest, answerArchive=answerArchive, retrievalIndex=retrievalIndex, tracer=tracer, resultStore=resultStore, fileDeduplicator=fileDeduplicator)
     
-    await pipeline.run()
+    try:
+        if os.getenv("STREAMING_PIPELINE", "false").lower() == "true":
+            await pipeline.run_streaming()
+        else:
+            await pipeline.run()
+    finally:
+        # The journal is kept when the run fails or is stopped, so it can be resumed with --resume
+        journal.close()
     
     stop_event.set()
+    progress_reporter_thread.join()
+    
+    print(f"Deployments: {openAIClientFactory.stats()}")
+    print(f"Connections: {openAIClientFactory.transport_stats()}")
+    await openAIClientFactory.close()
+    print(f"Streamed completions: {repoCoPilot.stream_stats()}")
+    print(f"Response cache: {responseCache.stats()}")
+    responseCache.close()
+    retrievalIndex.close()
+    print(f"Result store: {resultStore.stats()}")
+    print(f"Journal: {journal.stats()}")
+    if batchCodeSaver.conflicts:
+        print(f"Conflicting code changes: {batchCodeSaver.conflicts}")
+    if batchCodeSaver.unsaved:
+        print(f"Code changes not saved: {batchCodeSaver.unsaved}")
+    resultStore.close()
+    
+    if tracer.enabled:
+        tracer.print_summary()
+        tracer.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Asks the questions about the repository")
+    parser.add_argument("--resume", action="store_true", help="Resumes the previous run from its journal, skipping the work it completed")
+    args = parser.parse_args()
+    asyncio.run(main(resume=args.resume))
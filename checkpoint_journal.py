@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import queue
+import threading
+from typing import List, Optional, Tuple
+
+from common_models import Chunk, ModelAnswer, Question
+
+"""
+A write-ahead journal of the work done by a run, so a run that crashed or was stopped can be resumed without asking
+the models again for what was already answered.
+
+Each answered (question, model, chunk) and each finished refine level of a (question, model) is appended to the
+journal as a JSON line as soon as it's done. The lines are written by a writer thread so the event loop doesn't wait
+on the disk: they are flushed to the operating system as soon as the thread gets them (they survive a crash of the
+process) and fsynced every fsync_every lines (to survive a power failure).
+
+When resuming, the journal of the previous run is loaded: the chunks are matched by a hash of their text, so a chunk
+whose files changed since is asked again, and a refine restarts from its last journaled level when it's given the
+same answers as before. Without resume, the journal is started over.
+"""
+
+
+class CheckpointJournal:
+    def __init__(self, path="./output/journal.jsonl", resume: bool = False, fsync_every: int = 64):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync_every = fsync_every
+        self.resumed_answers = 0
+        self.resumed_refines = 0
+        self._answers: dict[tuple, dict] = {}
+        self._refines: dict[tuple, dict] = {}
+        self._unsynced = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+
+        if resume:
+            self._load()
+            self._file = open(self.path, 'a', encoding='utf-8')
+        else:
+            self._file = open(self.path, 'w', encoding='utf-8')
+
+        self._writer = threading.Thread(target=self._write, name="journal-writer", daemon=True)
+        self._writer.start()
+
+    def _question_key(self, question: Question) -> str:
+        return hashlib.sha256(f"{question.system_prompt}\n{question.text}".encode('utf-8')).hexdigest()[:16]
+
+    def _chunk_key(self, chunk_text: str) -> str:
+        return hashlib.sha256(chunk_text.encode('utf-8')).hexdigest()[:32]
+
+    def inputs_key(self, answers: List[ModelAnswer]) -> str:
+        """A key of the answers given to a refine, whatever their order."""
+        digest = hashlib.sha256()
+        for answer in sorted(answer.answer for answer in answers):
+            digest.update(hashlib.sha256(answer.encode('utf-8')).digest())
+        return digest.hexdigest()[:32]
+
+    def _load(self):
+        if not self.path.exists():
+            return
+
+        valid_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    # A line cut by the crash, the lines after it can't be trusted
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid_bytes += len(line)
+
+                if record["type"] == "answer":
+                    self._answers[(record["question"], record["model"], record["chunk"])] = record
+                elif record["type"] == "refine":
+                    self._refines[(record["question"], record["model"], record["inputs"])] = record
+
+        if valid_bytes < self.path.stat().st_size:
+            print(f"Dropping the incomplete end of the journal {self.path}")
+            os.truncate(self.path, valid_bytes)
+
+        print(f"Resuming from {self.path}: {len(self._answers)} chunk answers and {len(self._refines)} refines journaled")
+
+    def _append(self, record: dict):
+        self._queue.put(json.dumps(record) + "\n")
+
+    def _write(self):
+        while True:
+            lines = [self._queue.get()]
+            while True:
+                try:
+                    lines.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None tells the writer the journal is closed
+            records = [line for line in lines if line is not None]
+            if records:
+                self._file.write("".join(records))
+                self._file.flush()
+                self._unsynced += len(records)
+
+                if self._unsynced >= self.fsync_every:
+                    os.fsync(self._file.fileno())
+                    self._unsynced = 0
+
+            if len(records) < len(lines):
+                return
+
+    def answer(self, question: Question, model: str, chunk_text: str) -> Optional[Tuple[str, bool]]:
+        """The journaled answer and ignore flag of the chunk, or None when it wasn't answered."""
+        record = self._answers.get((self._question_key(question), model, self._chunk_key(chunk_text)))
+        if record is None:
+            return None
+        self.resumed_answers += 1
+        return record["answer"], record["ignore"]
+
+    def record_answer(self, question: Question, model: str, chunk_text: str, answer: ModelAnswer):
+        if answer.error:
+            return
+        record = {"type": "answer", "question": self._question_key(question), "model": model, "chunk": self._chunk_key(chunk_text),
+                  "answer": answer.answer, "ignore": bool(answer.ignore)}
+        self._answers[(record["question"], model, record["chunk"])] = record
+        self._append(record)
+
+    def refine_level(self, question: Question, model: str, inputs_key: str) -> Optional[Tuple[int, List[ModelAnswer]]]:
+        """The last journaled level of the refine of these inputs and the answers it left, or None."""
+        record = self._refines.get((self._question_key(question), model, inputs_key))
+        if record is None:
+            return None
+        self.resumed_refines += 1
+        answers = [
+            ModelAnswer(model=model, answer=entry["answer"], content=Chunk.from_source_files(entry["files"]) if entry["files"] else "", ignore=False)
+            for entry in record["answers"]
+        ]
+        return record["level"], answers
+
+    def record_refine(self, question: Question, model: str, inputs_key: str, level: int, answers: List[ModelAnswer]):
+        record = {
+            "type": "refine", "question": self._question_key(question), "model": model, "inputs": inputs_key, "level": level,
+            "answers": [{"answer": answer.answer, "files": list(getattr(answer.content, "source_files", ()))} for answer in answers],
+        }
+        self._refines[(record["question"], model, inputs_key)] = record
+        self._append(record)
+
+    def stats(self) -> dict:
+        return {"answers": len(self._answers), "refines": len(self._refines), "resumed_answers": self.resumed_answers, "resumed_refines": self.resumed_refines}
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
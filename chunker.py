@@ -1,31 +1,99 @@
 from abc import ABC
+from pathlib import Path
 import time
 
+from code_splitter import split_source
 from file_processor import FileContent
 from progress_reporter import ProgressReporter
+from token_counter import TokenCounter, create_token_counter, first_fit_decreasing
 """
 A class used to chunk files into smaller pieces based on a maximum chunk size. A chunk can have a max of one file.
-Any file that exceeds the maximum chunk size will be moved to a new chunk.
+Any file that exceeds the maximum chunk size will be moved to a new chunk. A file larger than the maximum chunk size
+is split into parts at its classes and functions (see code_splitter.py), each part being a piece of its own.
 
 Attributes
 ----------
 max_chunk_size : int
-    The maximum size of each chunk. Default is 2000.
+    The maximum number of tokens of each chunk. When not set, the pipeline sets it to the smallest prompt budget of
+    the models it asks, and 2000 is used outside of the pipeline.
+token_counter : TokenCounter
+    The counter used to measure the chunks. Default is create_token_counter().
 Methods
 -------
 chunk_files(files_content)
     Add files to chunks based on the maximum chunk size.
 """
-from common_models import FileType, PipelineSteps
+from common_models import Chunk, ChunkPiece, FileType, PipelineSteps
+
+DEFAULT_MAX_CHUNK_SIZE = 2000
 
 class Chunker(ABC):
-    def __init__(self, max_chunk_size=2000, progress_reporter: ProgressReporter=None):
+    def __init__(self, max_chunk_size=None, progress_reporter: ProgressReporter=None, token_counter: TokenCounter=None):
         self.max_chunk_size = max_chunk_size
         self.progress_reporter = progress_reporter
+        self._token_counter = token_counter
+
+    @property
+    def token_counter(self) -> TokenCounter:
+        if self._token_counter is None:
+            self._token_counter = create_token_counter()
+        return self._token_counter
+    
+    @property
+    def chunk_budget(self) -> int:
+        return self.max_chunk_size or DEFAULT_MAX_CHUNK_SIZE
+
+    def _pieces(self, file_content: FileContent, description: str, footer: str = "", count: bool = False) -> list[tuple[ChunkPiece, int]]:
+        """The piece of the file with its token count (when counted), or the pieces of its parts when it doesn't fit in a chunk."""
+        text = file_content.content
+        piece = ChunkPiece(file_content, header=f"{description}, content:\n", footer=footer)
+
+        # A token is at least a character, a file with less characters than the budget fits without counting
+        if len(text) <= self.chunk_budget:
+            return [(piece, self.token_counter.count(f"{piece.header}{text}{footer}") if count else None)]
+
+        tokens = self.token_counter.count(f"{piece.header}{text}{footer}")
+        if tokens <= self.chunk_budget:
+            return [(piece, tokens)]
+
+        overhead = self.token_counter.count(f"{description}, part 9999 of 9999 (lines 999999-999999, only this part of the file is shown), context:\n\ncontent:\n{footer}")
+        parts = split_source(text, Path(str(file_content.filepath)).suffix.lower(), self.token_counter.count, self.chunk_budget - overhead)
+        print(f"Split {file_content.filepath} ({tokens} tokens) into {len(parts)} parts")
+
+        pieces = []
+        for index, part in enumerate(parts):
+            header = f"{description}, part {index + 1} of {len(parts)} (lines {part.start_line}-{part.end_line}, only this part of the file is shown), context:\n{part.context}\ncontent:\n"
+            part_text = text[part.start:part.end]
+            pieces.append((ChunkPiece(file_content, part.start, part.end, header=header, footer=footer, text=part_text),
+                           self.token_counter.count(header) + self.token_counter.count(part_text) + self.token_counter.count(footer)))
+        return pieces
+
+    def _chunk_files(self, files_content: dict[str, list[FileContent]]):
+        chunks = {FileType.CODE: [], FileType.TEXT: [], FileType.IMAGE: [], FileType.OTHER: []}
+        
+        for file_type in files_content.keys():
+            print(f"Going to chunk {file_type} {len(files_content[file_type])} files")
+
+            start_time = time.time()
+
+            for file_content in  files_content[file_type]:
+                chunks[file_type].extend(self.chunk_file(file_content))
+
+            for flushed_type, flushed_chunks in self.flush().items():
+                chunks[flushed_type].extend(flushed_chunks)
+
+            print(f"Chunked {len(files_content[file_type])} files into {len(chunks[file_type])} chunks in {time.time() - start_time:.2f} seconds")
 
-    def _chunk_files(self, _: dict[str, list[FileContent]]):
+        return chunks
+    
+    def chunk_file(self, file_content: FileContent) -> list[Chunk]:
+        """Adds a single file and returns the chunks that are complete, the streaming pipeline feeds the files one by one."""
         pass
     
+    def flush(self) -> dict[FileType, list[Chunk]]:
+        """Returns the chunks that are still being filled."""
+        return {}
+    
     def report_progress(self, files_content: dict[str, list[FileContent]]):
         if(self.progress_reporter):
             totals = 0
@@ -39,9 +107,13 @@ class Chunker(ABC):
 
 
 class MaxSizeChunker(Chunker):
-    def __init__(self, max_chunk_size=2000, progress_reporter: ProgressReporter=None):
-        self.max_chunk_size = max_chunk_size
-        self.progress_reporter = progress_reporter
+    def __init__(self, max_chunk_size=None, progress_reporter: ProgressReporter=None, token_counter: TokenCounter=None):
+        super().__init__(max_chunk_size, progress_reporter=progress_reporter, token_counter=token_counter)
+        self._pending: dict[FileType, tuple[list[ChunkPiece], int]] = {}
+
+    def _file_pieces(self, file_content: FileContent) -> list[tuple[ChunkPiece, int]]:
+        description = f"### source_file:{file_content.filepath} file_name:{file_content.filename}, file_type: {file_content.filetype}"
+        return self._pieces(file_content, description, footer="\n\n", count=True)
 
     def _chunk_files(self, files_content: dict[str, list[FileContent]]):
         chunks = {FileType.CODE: [], FileType.TEXT: [], FileType.IMAGE: [], FileType.OTHER: []}
@@ -50,45 +122,56 @@ class MaxSizeChunker(Chunker):
             print(f"Going to chunk {file_type} {len(files_content[file_type])} files")
 
             start_time = time.time()
-            
-            current_chunk = ""
+            pieces = []
 
             for file_content in  files_content[file_type]:
                 if(self.progress_reporter):
                     self.progress_reporter.update(PipelineSteps.CHUNKING)
-                                    
-                if len(current_chunk) + len(file_content.content) + len(file_content.filename) + len(file_type) + len("file_name,") + len("file_type,") + len("content") > self.max_chunk_size:
-                    chunks[file_type].append(current_chunk)
-                    current_chunk = ""
-                current_chunk += f"### source_file:{file_content.filepath} file_name:{file_content.filename}, file_type: {file_content.file_type}, content:\n{file_content.content}\n\n"
+                
+                pieces.extend(self._file_pieces(file_content))
 
-            if current_chunk:
-                chunks[file_type].append(current_chunk)
+            # First-fit-decreasing keeps the number of chunks, hence the number of calls, to a minimum
+            for packed in first_fit_decreasing(pieces, lambda piece: piece[1], self.chunk_budget):
+                chunks[file_type].append(Chunk([piece for piece, _ in packed], token_count=sum(tokens for _, tokens in packed)))
 
             print(f"Chunked {len(files_content[file_type])} files into {len(chunks[file_type])} chunks in {time.time() - start_time:.2f} seconds")
 
         return chunks
-    
 
-class ChunkPerFile(Chunker):
-    def __init__(self, max_chunk_size=2000, progress_reporter: ProgressReporter=None):
-        super().__init__(max_chunk_size, progress_reporter=progress_reporter)
-    
-    
-    def _chunk_files(self, files_content):
-        chunks = {FileType.CODE: [], FileType.TEXT: [], FileType.IMAGE: [], FileType.OTHER: []}
+    def chunk_file(self, file_content: FileContent) -> list[Chunk]:
+        if(self.progress_reporter):
+            self.progress_reporter.update(PipelineSteps.CHUNKING)
         
-        for file_type in files_content.keys():
-            print(f"Going to chunk {file_type} {len(files_content[file_type])} files")
+        # The files of a stream can't be sorted upfront, so they are packed next-fit
+        file_type = file_content.filetype
+        current_pieces, current_tokens = self._pending.get(file_type, ([], 0))
+        chunks = []
 
-            start_time = time.time()
+        for piece, tokens in self._file_pieces(file_content):
+            if current_pieces and current_tokens + tokens > self.chunk_budget:
+                chunks.append(Chunk(current_pieces, token_count=current_tokens))
+                current_pieces, current_tokens = [], 0
 
-            for file_content in  files_content[file_type]:
-                if(self.progress_reporter):
-                    self.progress_reporter.update(PipelineSteps.CHUNKING)
-                
-                chunks[file_type].append(f"### source_file:{file_content.filepath} file_name:{file_content.filepath}, file_type: {file_type}, content:\n{file_content.content}")
+            current_pieces.append(piece)
+            current_tokens += tokens
 
-            print(f"Chunked {len(files_content[file_type])} files into {len(chunks[file_type])} chunks in {time.time() - start_time:.2f} seconds")
+        self._pending[file_type] = (current_pieces, current_tokens)
+        return chunks
+    
+    def flush(self) -> dict[FileType, list[Chunk]]:
+        chunks = {file_type: [Chunk(current_pieces, token_count=current_tokens)] for file_type, (current_pieces, current_tokens) in self._pending.items() if current_pieces}
+        self._pending = {}
+        return chunks
+    
 
-        return chunks
\ No newline at end of file
+class ChunkPerFile(Chunker):
+    def __init__(self, max_chunk_size=None, progress_reporter: ProgressReporter=None, token_counter: TokenCounter=None):
+        super().__init__(max_chunk_size, progress_reporter=progress_reporter, token_counter=token_counter)
+    
+    
+    def chunk_file(self, file_content: FileContent) -> list[Chunk]:
+        if(self.progress_reporter):
+            self.progress_reporter.update(PipelineSteps.CHUNKING)
+        
+        description = f"### source_file:{file_content.filepath} file_name:{file_content.filepath}, file_type: {file_content.filetype}"
+        return [Chunk([piece], token_count=tokens) for piece, tokens in self._pieces(file_content, description)]
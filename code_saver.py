@@ -1,19 +1,85 @@
 from abc import ABC, abstractmethod
-import aiofiles
+import asyncio
+import difflib
+import os
+from pathlib import Path
+import stat
+import tempfile
 
 from response_formats.code_refactoring import CodeChange
 
+
+def write_atomic(file_path: Path, content: str):
+    """Writes the content to a temporary file next to file_path and renames it over file_path, so a reader never sees a partial file."""
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            file.write(content)
+        if file_path.exists():
+            os.chmod(temp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 class SaveStrategy(ABC):
     @abstractmethod
-    def save(self, file_path: str, code_content: str):
+    def save(self, file_path: str, code_content: str, original_content: str = None):
         pass
 
 class FileSaveStrategy(SaveStrategy):
-    async def save(self, file_path: str, code_content: str):
-        # Write the code content to the file asynchronously
-        async with aiofiles.open(file_path, 'w') as file:
-            await file.write(code_content)
-        print(f"Code saved to {file_path}")
+    """
+    Writes the code over the source file, or into a mirror of the repository tree under output_dir so the source
+    repository isn't touched. The files are written to a temporary file first and renamed.
+    """
+    def __init__(self, output_dir: str = None, root: str = "."):
+        self.output_dir = Path(output_dir) if output_dir else None
+        self.root = Path(root).resolve()
+
+    def destination(self, file_path: str) -> Path:
+        if not self.output_dir:
+            return Path(file_path)
+
+        resolved = Path(file_path).resolve()
+        relative = resolved.relative_to(self.root) if resolved.is_relative_to(self.root) else Path(*resolved.parts[1:])
+        return self.output_dir / relative
+
+    async def save(self, file_path: str, code_content: str, original_content: str = None):
+        destination = self.destination(file_path)
+        await asyncio.to_thread(write_atomic, destination, code_content)
+        print(f"Code saved to {destination}")
+
+class DiffSaveStrategy(SaveStrategy):
+    """Leaves the source files as they are and writes the changes as one unified diff, rewritten as the files change."""
+    def __init__(self, diff_path: str = "./output/changes.diff", root: str = "."):
+        self.diff_path = Path(diff_path)
+        self.root = Path(root).resolve()
+        self._diffs: dict[str, str] = {}
+        self._lock = asyncio.Lock()
+
+    def _relative(self, file_path: str) -> str:
+        resolved = Path(file_path).resolve()
+        return (resolved.relative_to(self.root) if resolved.is_relative_to(self.root) else Path(file_path)).as_posix()
+
+    async def save(self, file_path: str, code_content: str, original_content: str = None):
+        relative = self._relative(file_path)
+        diff = difflib.unified_diff((original_content or "").splitlines(keepends=True), code_content.splitlines(keepends=True),
+                                    fromfile=f"a/{relative}" if original_content is not None else "/dev/null", tofile=f"b/{relative}")
+        # A diff line without its line ending would run into the next one
+        text = "".join(line if line.endswith("\n") else line + "\n\\ No newline at end of file\n" for line in diff)
+
+        async with self._lock:
+            self._diffs[relative] = text
+            content = "".join(self._diffs[path] for path in sorted(self._diffs))
+            await asyncio.to_thread(write_atomic, self.diff_path, content)
+        print(f"Diff of {relative} saved to {self.diff_path}")
 
 class CodeSaver:
     def __init__(self, code_change: CodeChange, save_strategy: SaveStrategy):
@@ -23,4 +89,4 @@ class CodeSaver:
     async def save_code_to_file(self):
         file_path = self.code_change.source_file
         code_content = self.code_change.code
-        await self.save_strategy.save(file_path, code_content)
\ No newline at end of file
+        await self.save_strategy.save(file_path, code_content)
@@ -0,0 +1,231 @@
+import ast
+import bisect
+import re
+from typing import Callable, Iterator, List, Optional
+
+"""
+Splits the text of a file too large for a chunk into parts that fit, at the boundaries of its classes and functions.
+
+The file is split into units: the top level statements (imports, classes, functions, ...) of a Python file parsed with
+ast, or the top level declarations of a Java, C#, TypeScript, JavaScript or Go file found by following its braces
+(skipping the strings and comments). The consecutive units are packed into parts up to the budget. A unit too large
+for a part is split the same way into its own units (the methods of a class, the statements of a function), down to
+single lines for a unit that can't be split further, so no text of the file is left out.
+
+Each part comes with its context: the imports and package declarations of the file, and the declarations of the
+classes and functions it starts in, so a part can be understood on its own. A part ends where its first declaration
+does, so all of its lines are read in that context.
+"""
+
+PYTHON_SUFFIXES = {".py", ".pyi"}
+BRACE_SUFFIXES = {".java", ".cs", ".ts", ".tsx", ".js", ".jsx", ".mjs", ".go", ".kt", ".scala"}
+
+# The strings and comments, whose braces don't count, and the braces
+BRACE_TOKENS = re.compile(r'//[^\n]*|/\*.*?\*/|"""(?:.|\n)*?"""|@"(?:[^"]|"")*"|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`|[{}]', re.DOTALL)
+HEADER_LINE = re.compile(r"^\s*(package|import|using|namespace\s+[\w.]+\s*;|export\s+\*\s+from)\b")
+
+
+class SourcePart:
+    """A range of lines of the file text (start/end are offsets in the text) with the context it's read in."""
+    __slots__ = ('start', 'end', 'start_line', 'end_line', 'context')
+
+    def __init__(self, start: int, end: int, start_line: int, end_line: int, context: str):
+        self.start = start
+        self.end = end
+        self.start_line = start_line
+        self.end_line = end_line
+        self.context = context
+
+
+class _Unit:
+    __slots__ = ('start', 'end', 'context', 'expand')
+
+    def __init__(self, start: int, end: int, context: str, expand: Callable[[], Optional[List["_Unit"]]] = None):
+        self.start = start
+        self.end = end
+        self.context = context
+        self.expand = expand
+
+
+def _context(parent: str, declaration: str) -> str:
+    return f"{parent}\n{declaration}" if parent else declaration
+
+
+def _nested(context: str, outer: str) -> bool:
+    return not outer or context == outer or context.startswith(f"{outer}\n")
+
+
+class _PythonUnits:
+    def __init__(self, text: str, lines: List[str]):
+        self.lines = lines
+        self.tree = ast.parse(text)
+
+    def header(self) -> str:
+        imports = [node for node in self.tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+        return "".join("".join(self.lines[node.lineno - 1:node.end_lineno]) for node in imports).strip()
+
+    def _start(self, node: ast.stmt) -> int:
+        start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, "decorator_list", [])]) - 1
+        # The comments right above a statement go with it
+        while start > 0 and self.lines[start - 1].lstrip().startswith("#"):
+            start -= 1
+        return start
+
+    def units(self, nodes: List[ast.stmt], start: int, end: int, context: str) -> List[_Unit]:
+        boundaries = [start] + [max(self._start(node), start) for node in nodes[1:]] + [end]
+        return [_Unit(boundaries[index], boundaries[index + 1], context, self._expander(node, boundaries[index], boundaries[index + 1], context))
+                for index, node in enumerate(nodes)]
+
+    def _expander(self, node: ast.stmt, start: int, end: int, context: str):
+        if not isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+            return None
+
+        def expand() -> List[_Unit]:
+            declaration = "".join(self.lines[node.lineno - 1:node.body[0].lineno - 1]).strip() or self.lines[node.lineno - 1].strip()
+            units = self.units(node.body, start, end, _context(context, declaration))
+            # The first unit holds the declaration itself
+            units[0].context = context
+            return units
+
+        return expand
+
+
+class _BraceUnits:
+    def __init__(self, text: str, lines: List[str], offsets: List[int]):
+        self.lines = lines
+        self.start_depth = [0] * len(lines)
+        self.end_depth = [0] * len(lines)
+        # The lines starting inside a string or a comment
+        self.inside = [False] * len(lines)
+
+        changes = [0] * (len(lines) + 1)
+        for match in BRACE_TOKENS.finditer(text):
+            token = match.group()
+            line = bisect.bisect_right(offsets, match.start()) - 1
+            if token == "{":
+                changes[line] += 1
+            elif token == "}":
+                changes[line] -= 1
+            elif "\n" in token:
+                for inner in range(line + 1, bisect.bisect_right(offsets, match.end() - 1)):
+                    self.inside[inner] = True
+
+        depth = 0
+        for index in range(len(lines)):
+            self.start_depth[index] = depth
+            depth = max(depth + changes[index], 0)
+            self.end_depth[index] = depth
+
+    def header(self) -> str:
+        header, index = [], 0
+        while index < len(self.lines):
+            line = self.lines[index]
+            if self.start_depth[index] == 0 and not self.inside[index] and HEADER_LINE.match(line):
+                header.append(line.rstrip())
+                # The import blocks of Go and the multiline imports of TypeScript
+                closing = ")" if "(" in line and ")" not in line else "}" if line.lstrip().startswith("import") and "{" in line and "}" not in line else None
+                while closing and index + 1 < len(self.lines):
+                    index += 1
+                    header.append(self.lines[index].rstrip())
+                    if closing in self.lines[index]:
+                        break
+            index += 1
+        return "\n".join(line.rstrip("{ ") for line in header).strip()
+
+    def _boundary(self, index: int, depth: int) -> bool:
+        if self.inside[index] or self.start_depth[index] != depth or self.end_depth[index - 1] != depth:
+            return False
+        previous = self.lines[index - 1].strip()
+        # Not between an annotation or attribute and what it annotates, nor in the middle of a statement
+        return not previous or (previous[-1] in "};)" and previous[0] not in "@[")
+
+    def units(self, start: int, end: int, depth: int, context: str) -> List[_Unit]:
+        boundaries = [start] + [index for index in range(start + 1, end) if self._boundary(index, depth)] + [end]
+        return [_Unit(boundaries[index], boundaries[index + 1], context, self._expander(boundaries[index], boundaries[index + 1], depth, context))
+                for index in range(len(boundaries) - 1)]
+
+    def _expander(self, start: int, end: int, depth: int, context: str):
+        opening = next((index for index in range(start, end) if self.end_depth[index] > depth), None)
+        if opening is None or opening + 1 >= end:
+            return None
+
+        def expand() -> List[_Unit]:
+            declaration = self.lines[opening].strip()
+            # The declarations with their brace on the next line
+            if declaration == "{" and opening > start:
+                declaration = self.lines[opening - 1].strip() + " {"
+            units = self.units(opening + 1, end, depth + 1, _context(context, declaration))
+            units[0].start = start
+            units[0].context = context
+            return units
+
+        return expand
+
+
+def _line_units(start: int, end: int, context: str) -> List[_Unit]:
+    return [_Unit(index, index + 1, context) for index in range(start, end)]
+
+
+def split_source(text: str, suffix: str, count_tokens: Callable[[str], int], budget: int) -> List[SourcePart]:
+    """Splits the text into parts of at most budget tokens (context included), except for single lines larger than the budget."""
+    lines = text.splitlines(keepends=True)
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    header, units = "", None
+    try:
+        if suffix in PYTHON_SUFFIXES:
+            python_units = _PythonUnits(text, lines)
+            header = python_units.header()
+            units = python_units.units(python_units.tree.body, 0, len(lines), "") if python_units.tree.body else None
+        elif suffix in BRACE_SUFFIXES:
+            brace_units = _BraceUnits(text, lines, offsets)
+            header = brace_units.header()
+            units = brace_units.units(0, len(lines), 0, "")
+    except (SyntaxError, ValueError, RecursionError) as e:
+        print(f"Splitting the {suffix} file by lines, it couldn't be parsed: {e}")
+
+    if header and count_tokens(header) > budget // 4:
+        header = ""
+    if units is None:
+        units = _line_units(0, len(lines), "")
+
+    context_tokens = {}
+
+    def context_budget(context: str) -> int:
+        if context not in context_tokens:
+            context_tokens[context] = count_tokens(_context(header, context)) if header or context else 0
+        return budget - context_tokens[context]
+
+    def leaves(units: List[_Unit]) -> Iterator[tuple[_Unit, int]]:
+        """The units that fit in a part, the ones too large being replaced by their own units."""
+        for unit in units:
+            unit_tokens = count_tokens("".join(lines[unit.start:unit.end]))
+            if unit_tokens <= context_budget(unit.context) or unit.end - unit.start == 1:
+                yield unit, unit_tokens
+            else:
+                yield from leaves((unit.expand() if unit.expand else None) or _line_units(unit.start, unit.end, unit.context))
+
+    parts: List[SourcePart] = []
+    current, tokens = None, 0
+
+    def add(part: _Unit):
+        # The part holding the start of the file has its header already
+        context = part.context if part.start == 0 else _context(header, part.context)
+        parts.append(SourcePart(offsets[part.start], offsets[part.end], part.start + 1, part.end, context))
+
+    for unit, unit_tokens in leaves(units):
+        # A part doesn't leave the declaration it starts in, the declarations it enters are read from its own lines
+        if current and (tokens + unit_tokens > context_budget(current.context) or not _nested(unit.context, current.context)):
+            add(current)
+            current, tokens = None, 0
+
+        if current is None:
+            current = _Unit(unit.start, unit.end, unit.context)
+        current.end = unit.end
+        tokens += unit_tokens
+
+    if current:
+        add(current)
+    return parts
@@ -1,12 +1,96 @@
+import asyncio
 from collections import namedtuple
+from contextlib import asynccontextmanager
 from enum import Enum, StrEnum
+import hashlib
 from typing import Any
 
 
-ModelAnswer = namedtuple('ModelAnswer', ['model', 'answer', 'content', 'ignore'])
+ModelAnswer = namedtuple('ModelAnswer', ['model', 'answer', 'content', 'ignore', 'error', 'parsed'], defaults=[False, False, None])
+
+class SourceFile:
+    """A reference to a source file whose content is no longer needed, like the files of the archived answers."""
+    __slots__ = ('filepath',)
+    content = ""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+class ChunkPiece:
+    """
+    A range of a file's content (start/end are offsets in its decoded text) along with the header and footer that
+    frame it in a chunk. The piece of a whole file doesn't hold the file text, it's rendered from the file when the
+    chunk is sent. The parts of a split file hold their text, taken from the single read the file is split from.
+    """
+    __slots__ = ('file', 'start', 'end', 'header', 'footer', 'text')
+
+    def __init__(self, file, start: int = 0, end: int = None, header: str = "", footer: str = "", text: str = None):
+        self.file = file
+        self.start = start
+        self.end = end
+        self.header = header
+        self.footer = footer
+        self.text = text
+
+    def render(self) -> str:
+        content = self.text
+        if content is None:
+            content = self.file.content
+            if self.start or self.end is not None:
+                content = content[self.start:self.end]
+        return f"{self.header}{content}{self.footer}"
+
+class Chunk:
+    """The context sent to a model, as references to the pieces of the files it's made of."""
+    __slots__ = ('pieces', 'token_count', '_loading', '_users')
+
+    def __init__(self, pieces=(), token_count: int = None):
+        self.pieces = tuple(pieces)
+        self.token_count = token_count
+        self._loading = None
+        self._users = 0
+
+    @staticmethod
+    def from_source_files(source_files) -> "Chunk":
+        return Chunk([ChunkPiece(SourceFile(path)) for path in source_files])
+
+    @property
+    def source_files(self) -> tuple:
+        return tuple(dict.fromkeys(str(piece.file.filepath) for piece in self.pieces))
+
+    @property
+    def id(self) -> str:
+        """A stable id of the chunk that doesn't need its text."""
+        key = "|".join(f"{piece.file.filepath}:{piece.start}:{piece.end}" for piece in self.pieces)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+    @property
+    def text(self) -> str:
+        return "".join(piece.render() for piece in self.pieces)
+
+    def __str__(self):
+        return self.text
+
+    @asynccontextmanager
+    async def loaded(self):
+        """
+        The chunk text, rendered in a worker thread by the first of the requests sending the chunk and shared by the
+        ones running at the same time, then let go with the last of them.
+        """
+        self._users += 1
+        try:
+            if self._loading is None:
+                self._loading = asyncio.ensure_future(asyncio.to_thread(lambda: self.text))
+            yield await asyncio.shield(self._loading)
+        finally:
+            self._users -= 1
+            if not self._users:
+                self._loading = None
 
 class QuestionAnswer:
-    def __init__(self, model: str, question: str, answer: str, time_taken, start_time, end_time, content: str):
+    __slots__ = ('model', 'question', 'answer', 'time_taken', 'start_time', 'end_time', 'content', 'parsed')
+
+    def __init__(self, model: str, question: str, answer: str, time_taken, start_time, end_time, content: str, parsed=None):
         self.model = model
         self.question = question
         self.answer = answer
@@ -14,6 +98,7 @@ class QuestionAnswer:
         self.start_time = start_time
         self.end_time = end_time
         self.content = content
+        self.parsed = parsed
 
 class FileType(StrEnum):
     CODE = "Code"
@@ -22,6 +107,11 @@ class FileType(StrEnum):
     OTHER = "Other"
     ALL = "All"
 
+class RetrievalMode(StrEnum):
+    ALL = "All"
+    TOP_K = "TopK"
+    THRESHOLD = "Threshold"
+
 class Question:
     def __init__(self, 
                  text: str, 
@@ -30,7 +120,12 @@ class Question:
                  models=["gpt-4o"], 
                  allowed_file_types=[FileType.ALL],
                  structured_output: bool=False,
-                 response_format: Any=None):
+                 response_format: Any=None,
+                 retrieval_mode: RetrievalMode=RetrievalMode.ALL,
+                 retrieval_top_k: int=20,
+                 retrieval_score_threshold: float=1.0,
+                 retrieval_query: str=None,
+                 max_output_tokens: int=None):
         
         self.text = text
         self.enabled = enabled
@@ -39,6 +134,11 @@ class Question:
         self.allowed_file_types = allowed_file_types
         self.structured_output = structured_output
         self.response_format = response_format
+        self.retrieval_mode = retrieval_mode
+        self.retrieval_top_k = retrieval_top_k
+        self.retrieval_score_threshold = retrieval_score_threshold
+        self.retrieval_query = retrieval_query
+        self.max_output_tokens = max_output_tokens
 
     @staticmethod
     def from_dict(data):
@@ -0,0 +1,173 @@
+import threading
+import time
+from typing import Awaitable, Callable, List
+
+"""
+Streamed completions, used by the RepositoryCoPilot when streaming is enabled.
+
+The answer is read as it's generated, which gives the time to the first token and the generation speed of each
+model, lets the partial answer be written while it's generated, and lets a runaway answer be cut off once it
+reaches the output token cap of the question. Every streamed delta is counted as one token, the usage reported at
+the end of the stream replaces the count when the stream isn't cut off.
+
+The streamed responses are returned with the shape of the non-streamed ones (choices[0].message.content/parsed and
+usage), so the callers don't need to know how the answer was received.
+"""
+
+
+class OutputCapExceeded(Exception):
+    pass
+
+
+class StreamedUsage:
+    def __init__(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class StreamedMessage:
+    def __init__(self, content: str, parsed=None):
+        self.content = content
+        self.parsed = parsed
+
+
+class StreamedChoice:
+    def __init__(self, message: StreamedMessage, finish_reason: str):
+        self.message = message
+        self.finish_reason = finish_reason
+
+
+class StreamedResponse:
+    def __init__(self, content: str, finish_reason: str, usage: StreamedUsage):
+        self.choices = [StreamedChoice(StreamedMessage(content), finish_reason)]
+        self.usage = usage
+
+
+class StreamMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: dict[str, dict] = {}
+
+    def record(self, model: str, time_to_first_token: float, tokens: int, generation_time: float, cut_off: bool):
+        with self._lock:
+            metrics = self._models.setdefault(model, {"requests": 0, "time_to_first_token": 0.0, "tokens": 0, "generation_time": 0.0, "cut_off": 0})
+            metrics["requests"] += 1
+            metrics["time_to_first_token"] += time_to_first_token or 0.0
+            metrics["tokens"] += tokens
+            metrics["generation_time"] += generation_time
+            metrics["cut_off"] += int(cut_off)
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                model: {
+                    "requests": metrics["requests"],
+                    "avg_time_to_first_token": round(metrics["time_to_first_token"] / metrics["requests"], 3),
+                    "tokens_per_second": round(metrics["tokens"] / metrics["generation_time"], 1) if metrics["generation_time"] else None,
+                    "cut_off": metrics["cut_off"],
+                }
+                for model, metrics in self._models.items()
+            }
+
+
+class _StreamReader:
+    def __init__(self, max_output_tokens: int, on_delta: Callable[[str], Awaitable[None]]):
+        self.max_output_tokens = max_output_tokens
+        self.on_delta = on_delta
+        self.parts: List[str] = []
+        self.tokens = 0
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.cut_off = False
+
+    async def add(self, delta: str) -> bool:
+        """Adds the delta to the answer, and returns False once the answer reached the output token cap."""
+        if not delta:
+            return True
+
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+        self.parts.append(delta)
+        self.tokens += 1
+
+        if self.on_delta:
+            await self.on_delta(delta)
+
+        if self.max_output_tokens and self.tokens >= self.max_output_tokens:
+            self.cut_off = True
+            return False
+
+        return True
+
+    def record(self, metrics: StreamMetrics, model: str, tokens: int):
+        if not metrics:
+            return
+        time_to_first_token = self.first_token_at - self.started if self.first_token_at else None
+        generation_time = time.monotonic() - self.first_token_at if self.first_token_at else 0.0
+        metrics.record(model, time_to_first_token, tokens, generation_time, self.cut_off)
+
+
+async def stream_completion(client, model: str, messages: list, prompt_tokens: int, max_output_tokens: int = None,
+                            on_delta: Callable[[str], Awaitable[None]] = None, metrics: StreamMetrics = None, metrics_key: str = None) -> StreamedResponse:
+    reader = _StreamReader(max_output_tokens, on_delta)
+    finish_reason = None
+    usage = None
+    options = {"max_tokens": max_output_tokens} if max_output_tokens else {}
+
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
+        stream=True,
+        stream_options={"include_usage": True},
+        **options
+    )
+
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                usage = StreamedUsage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+
+            if not chunk.choices:
+                continue
+
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+
+            if not await reader.add(chunk.choices[0].delta.content):
+                finish_reason = "length"
+                break
+    finally:
+        await stream.close()
+
+    usage = usage if usage and not reader.cut_off else StreamedUsage(prompt_tokens, reader.tokens)
+    reader.record(metrics, metrics_key or model, usage.completion_tokens)
+    return StreamedResponse("".join(reader.parts), finish_reason, usage)
+
+
+async def stream_parsed_completion(client, model: str, messages: list, response_format, max_output_tokens: int = None,
+                                   on_delta: Callable[[str], Awaitable[None]] = None, metrics: StreamMetrics = None, metrics_key: str = None):
+    """Streams a structured output, a cut off answer can't be parsed so it raises OutputCapExceeded."""
+    reader = _StreamReader(max_output_tokens, on_delta)
+    options = {"max_tokens": max_output_tokens} if max_output_tokens else {}
+
+    async with client.beta.chat.completions.stream(
+        model=model,
+        messages=messages,
+        temperature=0,
+        response_format=response_format,
+        **options
+    ) as stream:
+        async for event in stream:
+            if event.type == "content.delta" and not await reader.add(event.delta):
+                reader.record(metrics, metrics_key or model, reader.tokens)
+                raise OutputCapExceeded(f"The answer of model {model} was cut off at {reader.tokens} tokens")
+
+        completion = await stream.get_final_completion()
+
+    reader.record(metrics, metrics_key or model, completion.usage.completion_tokens if completion.usage else reader.tokens)
+    return completion
@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import re
+import zlib
+from typing import List, Optional
+
+from common_models import Chunk, FileType, ModelAnswer, Question
+from file_processor import FileContent
+
+"""
+Finds the files that are copies of others (vendored libraries, generated clients, copy-pasted modules), so only one
+file of each group of copies is sent to the models and its answers are fanned out to the others.
+
+The exact copies are found by the hash of their content. The near copies are found with MinHash: the shingles (runs of
+shingle_size tokens) of a file are hashed once and spread over num_perm bins by their hash, the smallest hash of each
+bin making its signature (one permutation hashing, the empty bins take the value of the next bin), and the share of
+equal values between two signatures estimates how much of their shingles the files share. The signatures are bucketed
+by bands (locality sensitive hashing) so a file is only compared to the files sharing a band with it, and it's a near
+copy of the most similar one at or above threshold.
+
+Hashing reads and tokenizes the files, deduplicate runs it in a worker thread so it doesn't hold up the event loop.
+
+The files are added one by one: the first file of a group is its representative, the files added after it are its
+duplicates. The files larger than max_near_duplicate_size are only checked for exact copies.
+"""
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+class FileDeduplicator:
+    def __init__(self, near_duplicates: bool = True, threshold: float = 0.85, num_perm: int = 64, bands: int = 16, shingle_size: int = 5,
+                 max_near_duplicate_size: int = 512 * 1024):
+        if num_perm % bands:
+            raise ValueError(f"The number of permutations {num_perm} must be a multiple of the number of bands {bands}")
+
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.max_near_duplicate_size = max_near_duplicate_size
+        # The representative of each content hash, with the similarity of the content to it
+        self._hashes: dict[tuple[FileType, str], tuple[str, float]] = {}
+        self._buckets: dict[tuple, List[str]] = {}
+        self._signatures: dict[str, tuple] = {}
+        # The duplicates of each representative, with their estimated similarity
+        self._duplicates: dict[str, List[tuple[str, float]]] = {}
+        self.files = 0
+        self.exact_duplicates = 0
+        self.near_duplicate_files = 0
+        self.fanned_out_answers = 0
+        self.calls_saved = 0
+        self._duplicate_types: dict[FileType, int] = {}
+
+    def _signature(self, text: str) -> Optional[tuple]:
+        tokens = TOKEN_PATTERN.findall(text)
+        if len(tokens) < self.shingle_size:
+            return None
+
+        shingles = {zlib.crc32(" ".join(tokens[index:index + self.shingle_size]).encode('utf-8')) for index in range(len(tokens) - self.shingle_size + 1)}
+        # The hashes are walked from the largest down, the smallest of each bin is the one left
+        bins = {shingle % self.num_perm: shingle // self.num_perm for shingle in sorted(shingles, reverse=True)}
+
+        signature, value = [None] * self.num_perm, None
+        for index in range(2 * self.num_perm - 1, -1, -1):
+            value = bins.get(index % self.num_perm, value)
+            if index < self.num_perm:
+                signature[index] = value
+        return tuple(signature)
+
+    def _band_keys(self, file_type: FileType, signature: tuple) -> List[tuple]:
+        rows = self.num_perm // self.bands
+        return [(file_type, band, signature[band * rows:(band + 1) * rows]) for band in range(self.bands)]
+
+    def _similarity(self, signature: tuple, other: tuple) -> float:
+        return sum(1 for value, other_value in zip(signature, other) if value == other_value) / self.num_perm
+
+    def add(self, file_content: FileContent) -> Optional[str]:
+        """Returns the path of the file the file is a copy of, or None when it's the first of its kind."""
+        representative = self._add(file_content)
+        if representative is not None:
+            self._duplicate_types[file_content.filetype] = self._duplicate_types.get(file_content.filetype, 0) + 1
+        return representative
+
+    def _add(self, file_content: FileContent) -> Optional[str]:
+        self.files += 1
+        path = str(file_content.filepath)
+        text = file_content.content
+        hash_key = (file_content.filetype, hashlib.sha256(text.encode('utf-8', errors='replace')).hexdigest())
+
+        if hash_key in self._hashes:
+            representative, similarity = self._hashes[hash_key]
+            self.exact_duplicates += 1
+            self._duplicates[representative].append((path, similarity))
+            return representative
+
+        self._hashes[hash_key] = (path, 1.0)
+        self._duplicates[path] = []
+
+        if not self.near_duplicates or len(text) > self.max_near_duplicate_size:
+            return None
+
+        signature = self._signature(text)
+        if signature is None:
+            return None
+
+        band_keys = self._band_keys(file_content.filetype, signature)
+        candidates = dict.fromkeys(candidate for key in band_keys for candidate in self._buckets.get(key, ()))
+        similarities = [(self._similarity(signature, self._signatures[candidate]), candidate) for candidate in candidates]
+        similarity, representative = max(similarities, default=(0.0, None))
+
+        if representative is not None and similarity >= self.threshold:
+            del self._duplicates[path]
+            # The exact copies of a near copy are copies of its representative too
+            self._hashes[hash_key] = (representative, similarity)
+            self.near_duplicate_files += 1
+            self._duplicates[representative].append((path, similarity))
+            return representative
+
+        self._signatures[path] = signature
+        for key in band_keys:
+            self._buckets.setdefault(key, []).append(path)
+        return None
+
+    async def deduplicate(self, files_content: dict[FileType, List[FileContent]]) -> dict[FileType, List[FileContent]]:
+        """Keeps the representative of each group of copies."""
+        return await asyncio.to_thread(self._deduplicate, files_content)
+
+    def _deduplicate(self, files_content: dict[FileType, List[FileContent]]) -> dict[FileType, List[FileContent]]:
+        return {file_type: [file_content for file_content in type_files if self.add(file_content) is None] for file_type, type_files in files_content.items()}
+
+    def fan_out(self, question: Question, answers: List[ModelAnswer]) -> List[ModelAnswer]:
+        """The answers of the representatives to the question, copied for each of their duplicates."""
+        # Each duplicate the question would have been asked about is a call saved per model
+        duplicates = sum(count for file_type, count in self._duplicate_types.items() if FileType.ALL in question.allowed_file_types or file_type in question.allowed_file_types)
+        self.calls_saved += duplicates * len(question.models)
+        copies = []
+
+        for answer in answers:
+            if answer.error or answer.ignore:
+                continue
+            for path in getattr(answer.content, "source_files", ()):
+                for duplicate, _ in self._duplicates.get(path, ()):
+                    # The code changes of an answer are only saved to the file they were made for
+                    copies.append(answer._replace(content=Chunk.from_source_files([duplicate]), parsed=None))
+
+        self.fanned_out_answers += len(copies)
+        return copies
+
+    def clusters(self) -> dict[str, List[dict]]:
+        return {representative: [{"path": path, "similarity": round(similarity, 3)} for path, similarity in duplicates]
+                for representative, duplicates in self._duplicates.items() if duplicates}
+
+    def stats(self) -> dict:
+        return {
+            "files": self.files,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicate_files,
+            "clusters": sum(1 for duplicates in self._duplicates.values() if duplicates),
+            "fanned_out_answers": self.fanned_out_answers,
+            "calls_saved": self.calls_saved,
+        }
@@ -0,0 +1,152 @@
+import asyncio
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import os
+from pathlib import Path
+import threading
+from typing import List, Optional, Tuple
+
+"""
+Loads the repository files from a bounded thread pool. Each worker thread reads a batch of files one after the other,
+so there are never more open files than worker threads, and a batch costs one thread hop instead of one per read.
+
+Before a file is fully read, its first sniff_size bytes are used to:
+    - detect the encoding from the byte order mark, or check the bytes decode as UTF-8.
+    - detect binary files (NUL bytes or mostly control characters), which are skipped.
+Files bigger than max_file_size are skipped, and files bigger than mmap_threshold are decoded from a memory map
+instead of being read into an intermediate buffer.
+"""
+
+DEFAULT_MAX_FILE_SIZE = 10 * 1024 * 1024
+DEFAULT_MMAP_THRESHOLD = 1024 * 1024
+
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+TEXT_CHARACTERS = bytes({7, 8, 9, 10, 11, 12, 13, 27} | set(range(0x20, 0x100)) - {0x7f})
+
+
+class LoaderStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded = 0
+        self.binary = 0
+        self.too_large = 0
+        self.memory_mapped = 0
+        self.errors = 0
+        self.bytes_read = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def as_dict(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+    def __repr__(self):
+        return f"LoaderStats({', '.join(f'{key}={value}' for key, value in self.as_dict().items())})"
+
+
+class FileLoader:
+    def __init__(self, max_open_files=32, batch_size=16, max_file_size=DEFAULT_MAX_FILE_SIZE, mmap_threshold=DEFAULT_MMAP_THRESHOLD, sniff_size=8192):
+        self.max_open_files = max_open_files
+        self.batch_size = batch_size
+        self.max_file_size = max_file_size
+        self.mmap_threshold = mmap_threshold
+        self.sniff_size = sniff_size
+        self.stats = LoaderStats()
+        self._executor = ThreadPoolExecutor(max_workers=max_open_files, thread_name_prefix="file-loader")
+
+    def _sniff_encoding(self, head: bytes, complete: bool) -> Optional[str]:
+        for byte_order_mark, encoding in BYTE_ORDER_MARKS:
+            if head.startswith(byte_order_mark):
+                return encoding
+
+        if b'\x00' in head:
+            return None
+
+        try:
+            # A multi-byte character cut at the end of the sniffed bytes is fine unless the file ends there
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=complete)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
+
+        if head and len(head.translate(None, TEXT_CHARACTERS)) / len(head) > 0.1:
+            return None
+
+        return 'latin-1'
+
+    def load(self, filepath: Path, lazy: bool = False) -> Optional[Tuple[str, int, Optional[str]]]:
+        """
+        Returns the encoding, size and text of the file, or None when it's binary, too large or can't be read.
+        A lazy load only sniffs the file, and its text is read later with read_text.
+        """
+        try:
+            with open(filepath, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+
+                if self.max_file_size is not None and size > self.max_file_size:
+                    self.stats.add(too_large=1)
+                    return None
+
+                head = file.read(self.sniff_size)
+                encoding = self._sniff_encoding(head, complete=len(head) >= size)
+
+                if encoding is None:
+                    self.stats.add(binary=1)
+                    return None
+
+                if lazy:
+                    self.stats.add(loaded=1)
+                    return encoding, size, None
+
+                if size >= self.mmap_threshold:
+                    self.stats.add(memory_mapped=1)
+
+                content = _decode(file, head, size, encoding, self.mmap_threshold)
+                self.stats.add(loaded=1, bytes_read=size)
+                return encoding, size, content
+        except (OSError, ValueError) as e:
+            print(f"Error reading {filepath}: {e}")
+            self.stats.add(errors=1)
+            return None
+
+    def load_batch(self, filepaths: List[Path], lazy: bool = False) -> List[Tuple[Path, Optional[Tuple[str, int, Optional[str]]]]]:
+        return [(filepath, self.load(filepath, lazy)) for filepath in filepaths]
+
+    async def load_batch_async(self, filepaths: List[Path], lazy: bool = False) -> List[Tuple[Path, Optional[Tuple[str, int, Optional[str]]]]]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.load_batch, filepaths, lazy)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def _decode(file, head: bytes, size: int, encoding: str, mmap_threshold: int) -> str:
+    if len(head) >= size:
+        content = str(head, encoding, errors='replace')
+    elif size >= mmap_threshold:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            content = str(mapped, encoding, errors='replace')
+    else:
+        content = str(head + file.read(), encoding, errors='replace')
+
+    # Same newlines as a file opened in text mode
+    if '\r' in content:
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+
+    return content
+
+
+def read_text(filepath: Path, encoding: str, mmap_threshold=DEFAULT_MMAP_THRESHOLD) -> str:
+    """Reads the text of a file that was sniffed by a lazy load."""
+    with open(filepath, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        return _decode(file, b"", size, encoding, mmap_threshold) if size else ""
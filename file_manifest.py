@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import aiofiles
+
+from file_processor import FileContent
+
+"""
+A manifest of the files analysed by the previous run (path, size, mtime and content hash), stored next to the output.
+It's used by the incremental mode to tell which files were added, changed or removed since the last run.
+"""
+
+class FileManifest:
+    def __init__(self, output_dir="./output", filename="manifest.json"):
+        self.path = Path(output_dir) / filename
+        self._previous: dict[str, dict] = {}
+        self._current: dict[str, dict] = {}
+        self.changed_paths: set[str] = set()
+        self.unchanged_paths: set[str] = set()
+
+    async def load(self):
+        if not self.path.exists():
+            self._previous = {}
+            return
+
+        try:
+            async with aiofiles.open(self.path, 'r', encoding='utf-8') as f:
+                self._previous = json.loads(await f.read())
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error reading manifest {self.path}, running a full analysis: {e}")
+            self._previous = {}
+
+    def track(self, file_content: FileContent) -> bool:
+        """Records the file in the new manifest and returns whether it was added or changed since the last run."""
+        path = str(file_content.filepath)
+        stat = os.stat(file_content.filepath)
+        previous = self._previous.get(path)
+
+        if previous and previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+            content_hash = previous["hash"]
+        else:
+            content_hash = hashlib.sha256(file_content.content.encode('utf-8')).hexdigest()
+
+        self._current[path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content_hash}
+        changed = not previous or previous["hash"] != content_hash
+
+        if changed:
+            self.changed_paths.add(path)
+        else:
+            self.unchanged_paths.add(path)
+
+        return changed
+
+    @property
+    def removed_paths(self) -> set[str]:
+        return set(self._previous.keys()) - set(self._current.keys())
+
+    async def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+
+        async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+            await f.write(json.dumps(self._current))
+
+        os.replace(tmp_path, self.path)
@@ -1,38 +1,61 @@
 import asyncio
+import itertools
 from pathlib import Path
-import aiofiles
 
 from common_models import FileType, PipelineSteps
+from file_loader import DEFAULT_MAX_FILE_SIZE, FileLoader, read_text
 from progress_reporter import ProgressReporter
+from repository_walker import RepositoryWalker
 
 class FileContent:
-    def __init__(self, filepath ,filename,filetype, content ):
+    """
+    A repository file. When it's created without content (lazy loading), the text is read from disk every time
+    it's needed and isn't kept, so only the chunks being sent hold file text in memory.
+    """
+    __slots__ = ('filename', 'filepath', 'filetype', 'encoding', 'size', '_content')
+
+    def __init__(self, filepath ,filename,filetype, content=None, encoding='utf-8', size=None):
         self.filename = filename
-        self.content = content
+        self._content = content
         self.filepath = filepath
         self.filetype = filetype
+        self.encoding = encoding
+        self.size = size
+
+    @property
+    def content(self) -> str:
+        if self._content is not None:
+            return self._content
+        return read_text(self.filepath, self.encoding)
 
 class FileProcessor:
     def __init__(self, 
                  directory, 
                  folders_to_ignore=[".git", ".github", ".vscode", "node_modules", "__pycache__", "gradle"], 
-                 files_to_ignore=['.css', '.js'], progress_reporter: ProgressReporter=None):
+                 files_to_ignore=['.css', '.js'], progress_reporter: ProgressReporter=None,
+                 max_depth: int=None, max_file_size: int=None, respect_gitignore: bool=True, file_loader: FileLoader=None,
+                 lazy_content: bool=True):
         
         self.directory = directory
         self.folders_to_ignore = folders_to_ignore
         self.files_to_ignore = files_to_ignore
         self.progress_reporter = progress_reporter
+        self.walker = RepositoryWalker(directory, folders_to_ignore=folders_to_ignore, files_to_ignore=files_to_ignore,
+                                       max_depth=max_depth, max_file_size=max_file_size, respect_gitignore=respect_gitignore)
+        self.file_loader = file_loader if file_loader else FileLoader(max_file_size=max_file_size if max_file_size is not None else DEFAULT_MAX_FILE_SIZE)
+        self.lazy_content = lazy_content
+
+    async def _read_batch(self, filepaths: list[Path]) -> list[FileContent]:
+        results = await self.file_loader.load_batch_async(filepaths, lazy=self.lazy_content)
+
+        if self.progress_reporter:
+            self.progress_reporter.update(PipelineSteps.READING_FILES, len(filepaths))
 
-    async def _read_file(self, filepath):
-        try:
-            async with aiofiles.open(filepath, 'r', encoding='utf-8') as file:
-                file_content = await file.read()
-                if self.progress_reporter:
-                    self.progress_reporter.update(PipelineSteps.READING_FILES, 1)
-                return FileContent(filepath,filepath.name,self._get_file_type(filepath=filepath), file_content) 
-        except Exception as e:
-            print(f"Error reading {filepath}: {e}")
-            return filepath.name, None, None
+        return [
+            FileContent(filepath, filepath.name, self._get_file_type(filepath=filepath), content, encoding=encoding, size=size)
+            for filepath, loaded in results if loaded is not None
+            for encoding, size, content in [loaded]
+        ]
 
     def _get_file_type(self, filepath):
         if filepath.suffix in ['.py', '.js', '.java', '.cpp', '.c', '.cs', '.rs', '.go', '.ts', '.php', '.html', '.css', '.scss', '.json', '.xml', '.yaml', '.yml', '.sh', '.bat', '.ps1', '.sql', '.rb', '.pl', '.swift', '.kt', '.groovy', '.scala', '.lua', '.m', '.h', '.hpp', '.hh', '.hxx']:
@@ -43,34 +66,51 @@ class FileProcessor:
             return  FileType.IMAGE
         return FileType.OTHER
 
+    async def _walk(self, batch_size=1024):
+        """Walks the directory in a worker thread, handing the paths over in batches of the loader size so the event loop isn't blocked."""
+        paths = self.walker.walk()
+
+        while walked := await asyncio.to_thread(lambda: list(itertools.islice(paths, batch_size))):
+            for index in range(0, len(walked), self.file_loader.batch_size):
+                yield walked[index:index + self.file_loader.batch_size]
+
+        print(f"Walked {self.directory}: {self.walker.stats}")
+
     async def read_files(self):
         files_content = {FileType.CODE: [], FileType.TEXT: [], FileType.IMAGE: [], FileType.OTHER: []}
         
-        directories = [self.directory]
-
-        while directories:
-            dir = directories.pop()
-            tasks = []
-
-            for filepath in Path(dir).rglob('*.*'):
-                if any(ignored_folder in filepath.parts for ignored_folder in self.folders_to_ignore):
-                    continue
-                
-                if filepath.suffix in self.files_to_ignore:
-                    print(f"\nIgnoring file {filepath}\n")
-                    continue
-                
-                if filepath.is_dir():
-                    directories.append(filepath)
-                    continue
-                tasks.append(self._read_file(filepath))
-
-            self.progress_reporter.init_step(PipelineSteps.READING_FILES, len(tasks))
-            
-            results = await asyncio.gather(*tasks)
-
-            for fileContent in results:
-                if fileContent.filetype is not None and fileContent.filetype is not None:
-                    files_content[fileContent.filetype].append(fileContent)
-
-        return files_content
\ No newline at end of file
+        batches = [batch async for batch in self._walk()]
+
+        if self.progress_reporter:
+            self.progress_reporter.init_step(PipelineSteps.READING_FILES, sum(len(batch) for batch in batches))
+        
+        results = await asyncio.gather(*[self._read_batch(batch) for batch in batches])
+
+        for batch in results:
+            for fileContent in batch:
+                files_content[fileContent.filetype].append(fileContent)
+
+        print(f"Loaded {self.directory}: {self.file_loader.stats}")
+        return files_content
+
+    async def iter_files(self):
+        """Yields the files as they are read, keeping at most one batch per loader thread in flight."""
+        pending = set()
+
+        async for batch in self._walk():
+            if self.progress_reporter:
+                self.progress_reporter.add_tasks(PipelineSteps.READING_FILES, len(batch))
+
+            pending.add(asyncio.create_task(self._read_batch(batch)))
+
+            if len(pending) >= self.file_loader.max_open_files:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for file_content in task.result():
+                        yield file_content
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                for file_content in task.result():
+                    yield file_content
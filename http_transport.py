@@ -0,0 +1,137 @@
+import time
+from typing import List
+
+import httpx
+
+from model_config import ModelConfig
+
+"""
+The HTTP connections to the model endpoints. All the clients of an endpoint (whatever their model or API version)
+share one httpx.AsyncClient, so they share its pool of open connections instead of each opening (and TLS handshaking)
+its own.
+
+The pool size, keep-alive, HTTP/2 and the connect and read timeouts are set per endpoint in model_config.json, on any
+of the models of the endpoint (the first model setting a value wins). By default the pool keeps alive all the
+connections it opens, so the connections opened at the peak concurrency are reused instead of being closed and
+opened again.
+
+Each request is traced with the httpcore trace extension to count the connections opened (and the time spent
+connecting and handshaking) against the requests sent, which is what stats() reports per endpoint.
+"""
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_KEEPALIVE_EXPIRY = 30.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 600.0
+
+
+class TransportSettings:
+    def __init__(self, max_connections: int = None, max_keepalive_connections: int = None, keepalive_expiry: float = None,
+                 http2: bool = None, connect_timeout: float = None, read_timeout: float = None):
+        self.max_connections = max_connections if max_connections else DEFAULT_MAX_CONNECTIONS
+        self.max_keepalive_connections = max_keepalive_connections if max_keepalive_connections is not None else self.max_connections
+        self.keepalive_expiry = keepalive_expiry if keepalive_expiry is not None else DEFAULT_KEEPALIVE_EXPIRY
+        self.http2 = bool(http2)
+        self.connect_timeout = connect_timeout if connect_timeout else DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout if read_timeout else DEFAULT_READ_TIMEOUT
+
+    @classmethod
+    def from_model_configs(cls, model_configs: List[ModelConfig]) -> "TransportSettings":
+        """The settings of an endpoint, from the configurations of the models it serves."""
+        def first(field: str):
+            return next((getattr(model_config, field) for model_config in model_configs if getattr(model_config, field) is not None), None)
+
+        return cls(max_connections=first("max_connections") or first("endpoint_max_concurrency"), max_keepalive_connections=first("max_keepalive_connections"),
+                   keepalive_expiry=first("keepalive_expiry"), http2=first("http2"), connect_timeout=first("connect_timeout"), read_timeout=first("read_timeout"))
+
+    def __repr__(self):
+        return f"TransportSettings(max_connections={self.max_connections}, max_keepalive_connections={self.max_keepalive_connections}, keepalive_expiry={self.keepalive_expiry}, http2={self.http2}, connect_timeout={self.connect_timeout}, read_timeout={self.read_timeout})"
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, settings: TransportSettings, **kwargs):
+        super().__init__(http2=settings.http2, limits=httpx.Limits(max_connections=settings.max_connections, max_keepalive_connections=settings.max_keepalive_connections,
+                                                                   keepalive_expiry=settings.keepalive_expiry), **kwargs)
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self.connect_seconds = 0.0
+        self.tls_seconds = 0.0
+        self.http_versions: dict[str, int] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = {}
+        outer_trace = request.extensions.get("trace")
+
+        async def trace(name: str, info: dict):
+            if name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                started[name] = time.perf_counter()
+            elif name == "connection.connect_tcp.complete":
+                self.connections += 1
+                self.connect_seconds += time.perf_counter() - started.pop("connection.connect_tcp.started", time.perf_counter())
+            elif name == "connection.start_tls.complete":
+                self.tls_seconds += time.perf_counter() - started.pop("connection.start_tls.started", time.perf_counter())
+
+            if outer_trace:
+                await outer_trace(name, info)
+
+        request.extensions = {**request.extensions, "trace": trace}
+
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            self.errors += 1
+            raise
+
+        self.requests += 1
+        http_version = response.extensions.get("http_version", b"HTTP/1.1").decode("ascii")
+        self.http_versions[http_version] = self.http_versions.get(http_version, 0) + 1
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "connections_opened": self.connections,
+            "reused": max(self.requests - self.connections, 0),
+            "reuse_ratio": round(max(self.requests - self.connections, 0) / self.requests, 3) if self.requests else None,
+            "connect_seconds": round(self.connect_seconds, 3),
+            "tls_seconds": round(self.tls_seconds, 3),
+            "http_versions": dict(self.http_versions),
+        }
+
+
+class HttpClientPool:
+    """The httpx.AsyncClient of each endpoint, created on first use."""
+
+    def __init__(self):
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, InstrumentedTransport] = {}
+        self._settings: dict[str, TransportSettings] = {}
+
+    def get(self, endpoint: str, settings: TransportSettings) -> httpx.AsyncClient:
+        if endpoint in self._clients:
+            return self._clients[endpoint]
+
+        if settings.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print(f"HTTP/2 is set for {endpoint} but the h2 package isn't installed, using HTTP/1.1")
+                settings.http2 = False
+
+        transport = InstrumentedTransport(settings)
+        self._transports[endpoint] = transport
+        self._settings[endpoint] = settings
+        self._clients[endpoint] = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(settings.read_timeout, connect=settings.connect_timeout),
+                                                    follow_redirects=True)
+        return self._clients[endpoint]
+
+    def stats(self) -> dict[str, dict]:
+        return {endpoint: {**transport.stats(), "http2": self._settings[endpoint].http2, "max_connections": self._settings[endpoint].max_connections}
+                for endpoint, transport in self._transports.items()}
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
@@ -26,6 +26,21 @@ class ModelConfig(BaseModel):
         platform (Platform): The platform on which the model is deployed (e.g., Azure, AWS).
         version (Optional[str]): The version of the model. Required for Azure models.
         api_key (Optional[str]): The API key for accessing the model. Required for Azure models.
+        retries (Optional[int]): The number of retries the client SDK performs on a failed request.
+        max_concurrency (Optional[int]): The max number of in-flight requests for this model/deployment.
+        endpoint_max_concurrency (Optional[int]): The max number of in-flight requests shared by all models on the same endpoint.
+        tokens_per_minute (Optional[int]): The token per minute quota of the model/deployment.
+        requests_per_minute (Optional[int]): The request per minute quota of the model/deployment.
+        context_window (Optional[int]): The max number of tokens (prompt and completion) the model accepts.
+        max_output_tokens (Optional[int]): The number of tokens of the context window reserved for the completion.
+        deployment_name (Optional[str]): The name of the deployment to call, when it differs from the model name.
+        weight (Optional[int]): The share of the requests routed to this deployment among the deployments of the model.
+        max_connections (Optional[int]): The max number of connections open to the endpoint, endpoint_max_concurrency or 100 by default.
+        max_keepalive_connections (Optional[int]): The max number of idle connections kept open to the endpoint, max_connections by default.
+        keepalive_expiry (Optional[float]): The seconds an idle connection to the endpoint is kept open.
+        http2 (Optional[bool]): Whether the requests to the endpoint are sent with HTTP/2 (requires the h2 package).
+        connect_timeout (Optional[float]): The seconds allowed to connect to the endpoint.
+        read_timeout (Optional[float]): The seconds allowed to wait for the response of the endpoint.
     Methods:
         required_if() -> Self:
             Validates that the `api_key` and `version` fields are provided when the platform is Azure.
@@ -40,6 +55,20 @@ class ModelConfig(BaseModel):
     version: Optional[str]
     api_key: Optional[str]
     retries: Optional[int] = 0
+    max_concurrency: Optional[int] = None
+    endpoint_max_concurrency: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    requests_per_minute: Optional[int] = None
+    context_window: Optional[int] = None
+    max_output_tokens: Optional[int] = None
+    deployment_name: Optional[str] = None
+    weight: Optional[int] = 1
+    max_connections: Optional[int] = None
+    max_keepalive_connections: Optional[int] = None
+    keepalive_expiry: Optional[float] = None
+    http2: Optional[bool] = None
+    connect_timeout: Optional[float] = None
+    read_timeout: Optional[float] = None
     
     @model_validator(mode="after")
     def required_if(self) -> Self:
@@ -52,7 +81,7 @@ class ModelConfig(BaseModel):
         return self
 
     def __repr__(self):
-        return f"ModelConfig(name={self.name}, version={self.version}, endpoint={self.endpoint}, api_key={self.api_key}, platform={self.platform.value}, retries={self.retries})"   
+        return f"ModelConfig(name={self.name}, version={self.version}, endpoint={self.endpoint}, api_key={self.api_key}, platform={self.platform.value}, retries={self.retries}, max_concurrency={self.max_concurrency}, endpoint_max_concurrency={self.endpoint_max_concurrency}, tokens_per_minute={self.tokens_per_minute}, requests_per_minute={self.requests_per_minute}, context_window={self.context_window}, max_output_tokens={self.max_output_tokens}, deployment_name={self.deployment_name}, weight={self.weight}, max_connections={self.max_connections}, max_keepalive_connections={self.max_keepalive_connections}, keepalive_expiry={self.keepalive_expiry}, http2={self.http2}, connect_timeout={self.connect_timeout}, read_timeout={self.read_timeout})"   
 
 class ModelConfigParser:
     
@@ -67,18 +96,29 @@ class ModelConfigParser:
             print(f"Error reading {filepath}: {e}")
             return filepath.name
 
-    async def parse(self) -> dict[str, ModelConfig]:
+    def _parse_model(self, name: str, model: dict) -> ModelConfig:
+        return ModelConfig(name=name, version=model.get('model_version'), endpoint=model.get('model_endpoint'), api_key=model.get('api_key'),
+                           platform=model.get('platform'), retries=model.get('retries', 0),
+                           max_concurrency=model.get('max_concurrency'), endpoint_max_concurrency=model.get('endpoint_max_concurrency'),
+                           tokens_per_minute=model.get('tokens_per_minute'), requests_per_minute=model.get('requests_per_minute'),
+                           context_window=model.get('context_window'), max_output_tokens=model.get('max_output_tokens'),
+                           deployment_name=model.get('deployment_name'), weight=model.get('weight', 1),
+                           max_connections=model.get('max_connections'), max_keepalive_connections=model.get('max_keepalive_connections'),
+                           keepalive_expiry=model.get('keepalive_expiry'), http2=model.get('http2'),
+                           connect_timeout=model.get('connect_timeout'), read_timeout=model.get('read_timeout'))
+
+    async def parse(self) -> dict[str, list[ModelConfig]]:
+        """
+        Returns the deployments of each model name. A model entry can list several deployments (e.g. one per region)
+        under "deployments", each one overriding the settings of the entry it belongs to.
+        """
         models_configuration_json = await self._read_file(self._models_configuration_path)
         models_configuration = json.loads(models_configuration_json)
         model_configs = {}
         for model in models_configuration:
+            deployments = [{**model, **deployment} for deployment in model.get("deployments", [])] or [model]
             for name in model.get("model_name"):
-                version = model.get('model_version')
-                endpoint = model.get('model_endpoint')
-                api_key = model.get('api_key')
-                platform = model.get('platform')
-                retries = model.get('retries', 0)
-                model_configs[name] = ModelConfig(name=name, version=version, endpoint=endpoint, api_key=api_key, platform=platform, retries=retries)
+                model_configs.setdefault(name, []).extend(self._parse_model(name, deployment) for deployment in deployments)
         return model_configs
 
 # Example usage
@@ -1,66 +1,224 @@
 import asyncio
+from contextlib import asynccontextmanager
 from enum import Enum
-from typing import Callable, Union
+import time
+from typing import Callable, List, Union
 from openai import AsyncAzureOpenAI, AsyncOpenAI
 from chunker import Chunker
+from http_transport import HttpClientPool, TransportSettings
 from model_config import ModelConfig, ModelConfigParser, Platform
+from resilience import CircuitBreaker, CircuitOpenError, is_failure, retry_after
+
+"""
+A model name can be served by several deployments (e.g. the same model in several regions, each with its own quota).
+The requests are routed to the deployment with the least outstanding requests relative to its weight.
+
+A throttled deployment (429) is taken out of rotation until its Retry-After, or for cooldown_seconds. The endpoints
+failing (5xx, connection errors) are taken out by their CircuitBreaker. When all the deployments of a model are out
+of rotation, route raises a CircuitOpenError telling when the first one comes back. With a RequestScheduler, the
+request is routed to the deployment the scheduler gave it room on.
+
+The clients don't retry on their own (max_retries=0), the retries are made by the RepositoryCoPilot with the
+RetryPolicy, so that each attempt is routed again. The clients of an endpoint send their requests through the shared
+connection pool of the endpoint (see http_transport.py).
+"""
+
+class Deployment:
+    def __init__(self, model_config: ModelConfig, client: Union[AsyncOpenAI, AsyncAzureOpenAI], breaker: CircuitBreaker):
+        self.model_config = model_config
+        self.client = client
+        self.breaker = breaker
+        self.weight = model_config.weight or 1
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.throttled_until = 0.0
+
+    @property
+    def model(self) -> str:
+        """The model/deployment name the requests are sent with."""
+        return self.model_config.deployment_name or self.model_config.name
+
+    def available(self, now: float) -> bool:
+        return now >= self.throttled_until and self.breaker.can_pass(now)
+
+    def available_in(self, now: float) -> float:
+        return max(self.throttled_until - now, self.breaker.retry_in(now), 0.0)
+
+    def load(self) -> float:
+        return (self.in_flight + 1) / self.weight
+
+    def stats(self) -> dict:
+        return {
+            "endpoint": self.model_config.endpoint,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "circuit": self.breaker.state.value,
+            "available": self.available(time.monotonic()),
+        }
 
 
 class OpenAIClientFactory:
-    def __init__(self, model_config_parser: ModelConfigParser, model_key_strategy : Callable[[ModelConfig], str]=  None):
+    def __init__(self, model_config_parser: ModelConfigParser, model_key_strategy : Callable[[ModelConfig], str]=  None, cooldown_seconds: float = 30, failure_threshold: int = 5, reset_timeout: float = 30,
+                 http_client_pool: HttpClientPool = None):
         self._model_config_parser = model_config_parser
         self._model_configs = None
         self._lock = asyncio.Lock()
         self._clients = {}
+        self._deployments: dict[str, List[Deployment]] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
         self._model_key_strategy = model_key_strategy if model_key_strategy else self._default_model_key_strategy
-        
-    
+        self._cooldown_seconds = cooldown_seconds
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._http_client_pool = http_client_pool if http_client_pool else HttpClientPool()
+
     def _default_model_key_strategy(self, model_config: ModelConfig) -> str:
         return f"{model_config.platform.value}_{model_config.endpoint}_{model_config.version}"
-    
-    async def get_client(self, model_name: str) -> Union[AsyncOpenAI, AsyncAzureOpenAI]:
-        if self._model_configs is None: 
+
+    async def _load_model_configs(self) -> dict[str, List[ModelConfig]]:
+        if self._model_configs is None:
             async with self._lock:
                 if self._model_configs is None:
                     self._model_configs = await self._model_config_parser.parse()
-        
-        model_config = self._model_configs.get(model_name)
-        
-        if not model_config:
+        return self._model_configs
+
+    async def get_model_configs(self, model_name: str) -> List[ModelConfig]:
+        model_configs = (await self._load_model_configs()).get(model_name)
+
+        if not model_configs:
             raise ValueError(f"No configuration found for model: {model_name}")
-        
+
+        return model_configs
+
+    async def get_model_config(self, model_name: str) -> ModelConfig:
+        """The configuration of the first deployment of the model, for the settings shared by its deployments."""
+        return (await self.get_model_configs(model_name))[0]
+
+    def _create_client(self, model_config: ModelConfig) -> Union[AsyncOpenAI, AsyncAzureOpenAI]:
         key = self._model_key_strategy(model_config)
 
         if key in self._clients:
             return self._clients[key]
-        
+
         client: Union[AsyncOpenAI, AsyncAzureOpenAI] = None
-        
+        endpoint_configs = [config for configs in self._model_configs.values() for config in configs if config.endpoint == model_config.endpoint]
+        http_client = self._http_client_pool.get(model_config.endpoint, TransportSettings.from_model_configs(endpoint_configs))
+
         if (model_config.platform == Platform.AZURE):
             client = AsyncAzureOpenAI(
                     azure_endpoint=model_config.endpoint,
                     api_key=model_config.api_key,
                     api_version=model_config.version,
-                    max_retries=model_config.retries,
+                    max_retries=0,
+                    http_client=http_client,
+                    timeout=http_client.timeout,
             )
         elif (model_config.platform == Platform.OLLAMA):
             client = AsyncOpenAI(
                  base_url=model_config.endpoint,
-                 api_key=model_name,
-                 max_retries=model_config.retries,
+                 api_key=model_config.name,
+                 max_retries=0,
+                 http_client=http_client,
+                 timeout=http_client.timeout,
             )
         elif (model_config.platform == Platform.OPENAI):
             client = AsyncOpenAI(
                  base_url=model_config.endpoint,
                  api_key=model_config.api_key,
-                 max_retries=model_config.retries,
+                 max_retries=0,
+                 http_client=http_client,
+                 timeout=http_client.timeout,
             )
-        else: 
+        else:
             raise ValueError(f"Unsupported platform: {model_config.platform}")
-        
-        async with self._lock:
-            self._clients[key] = client
-        
+
+        self._clients[key] = client
         return client
-        
-        
\ No newline at end of file
+
+    def _get_breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self._breakers:
+            self._breakers[endpoint] = CircuitBreaker(self._failure_threshold, self._reset_timeout)
+        return self._breakers[endpoint]
+
+    async def get_deployments(self, model_name: str) -> List[Deployment]:
+        deployments = self._deployments.get(model_name)
+
+        if deployments is None:
+            model_configs = await self.get_model_configs(model_name)
+            async with self._lock:
+                deployments = self._deployments.get(model_name)
+                if deployments is None:
+                    deployments = self._deployments[model_name] = [Deployment(model_config, self._create_client(model_config), self._get_breaker(model_config.endpoint)) for model_config in model_configs]
+
+        return deployments
+
+    async def warm_up(self) -> List[str]:
+        """Parses the model configurations and creates the clients of all the deployments upfront, and returns the model names."""
+        model_names = list(await self._load_model_configs())
+        for model_name in model_names:
+            await self.get_deployments(model_name)
+        return model_names
+
+    async def get_client(self, model_name: str) -> Union[AsyncOpenAI, AsyncAzureOpenAI]:
+        return (await self.get_deployments(model_name))[0].client
+
+    def _select(self, model_name: str, deployments: List[Deployment]) -> Deployment:
+        now = time.monotonic()
+        available = [deployment for deployment in deployments if deployment.available(now)]
+
+        if not available:
+            wait = min(deployment.available_in(now) for deployment in deployments)
+            raise CircuitOpenError(f"The deployments of model {model_name} the request can go to are out of rotation", retry_after=wait)
+
+        deployment = min(available, key=lambda deployment: deployment.load())
+        deployment.breaker.acquire(now)
+        return deployment
+
+    def _record_error(self, deployment: Deployment, error: Exception):
+        deployment.errors += 1
+
+        if is_failure(error):
+            deployment.breaker.record_failure(time.monotonic())
+            return
+
+        # The endpoint answered, even if with an error
+        deployment.breaker.record_success()
+
+        if getattr(error, "status_code", None) == 429:
+            requested = retry_after(error)
+            deployment.throttled += 1
+            deployment.throttled_until = time.monotonic() + (requested if requested is not None else self._cooldown_seconds)
+            print(f"Deployment {deployment.model} on {deployment.model_config.endpoint} is throttled, taken out of rotation")
+
+    @asynccontextmanager
+    async def route(self, model_name: str, deployment: Deployment = None):
+        """Yields the deployment the request is sent to (the one given by the RequestScheduler, if any), and records how the request went."""
+        deployment = self._select(model_name, [deployment] if deployment else await self.get_deployments(model_name))
+        deployment.in_flight += 1
+        deployment.requests += 1
+
+        try:
+            yield deployment
+            deployment.breaker.record_success()
+        except asyncio.CancelledError:
+            deployment.breaker.cancel_trial()
+            raise
+        except Exception as e:
+            self._record_error(deployment, e)
+            raise
+        finally:
+            deployment.in_flight -= 1
+
+    def stats(self) -> dict[str, list[dict]]:
+        return {model_name: [deployment.stats() for deployment in deployments] for model_name, deployments in self._deployments.items()}
+
+    def transport_stats(self) -> dict[str, dict]:
+        """The connections opened and reused by the requests to each endpoint."""
+        return self._http_client_pool.stats()
+
+    async def close(self):
+        await self._http_client_pool.close()
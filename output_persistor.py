@@ -1,4 +1,5 @@
 
+import os
 from pathlib import Path
 from typing import Callable, List
 import aiofiles
@@ -9,23 +10,51 @@ from common_models import QuestionAnswer
 class OutputPersistor:
     def __init__(self, output_dir="./output"):
         self.output_dir = Path(output_dir)
-        self.output_dir.mkdir(exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._written: dict[Path, int] = {}
         
     def _default_name_strategy(self, output_dir: Path, question_answer: QuestionAnswer) -> str:
         return output_dir / f"{question_answer.model}_question_{question_answer.question[:50]}.txt"
     
+    def _unique(self, filename) -> Path:
+        """Numbers the files sharing a name within the run, like the answers of a model that couldn't be refined into one."""
+        filename = Path(filename)
+        count = self._written.get(filename, 0)
+        self._written[filename] = count + 1
+        return filename if count == 0 else filename.with_name(f"{filename.stem}_{count + 1}{filename.suffix}")
+    
     async def persist(self, result: List[List[QuestionAnswer]], filename_strategy: Callable[[Path, QuestionAnswer], str] = None):
         for question_model_answers in result:
             for question_answer in question_model_answers:
-                filename =  filename_strategy(self.output_dir, question_answer) if filename_strategy else self._default_name_strategy(self.output_dir, question_answer)
+                filename = self._unique(filename_strategy(self.output_dir, question_answer) if filename_strategy else self._default_name_strategy(self.output_dir, question_answer))
+                text = (
+                    "---------------------Start Answer------------------------\n"
+                    f"LLM Model: {question_answer.model}\n\n"
+                    f"Content: {question_answer.content}\n\n"
+                    f"Question: {question_answer.question}\n\n"
+                    f"Answer: {question_answer.answer}\n\n"
+                    f"Time taken: {question_answer.time_taken:.2f} seconds\n\n"
+                    f"Start time: {question_answer.start_time}\n\n"
+                    f"End time: {question_answer.end_time}\n\n"
+                    "---------------------End Answer--------------------------\n"
+                )
 
                 async with aiofiles.open(filename, 'w', encoding='utf-8') as f:
-                    await f.write("---------------------Start Answer------------------------\n")
-                    await f.write(f"LLM Model: {question_answer.model}\n\n")
-                    await f.write(f"Content: {question_answer.content}\n\n")
-                    await f.write(f"Question: {question_answer.question}\n\n")
-                    await f.write(f"Answer: {question_answer.answer}\n\n")
-                    await f.write(f"Time taken: {question_answer.time_taken:.2f} seconds\n\n")
-                    await f.write(f"Start time: {question_answer.start_time}\n\n")
-                    await f.write(f"End time: {question_answer.end_time}\n\n")
-                    await f.write("---------------------End Answer--------------------------\n")
\ No newline at end of file
+                    await f.write(text)
+
+    def _partial_path(self, model: str, question: str, answer_id: str) -> Path:
+        return self.output_dir / "partial" / f"{model}_question_{question[:50]}_{answer_id}.txt"
+
+    async def persist_partial(self, model: str, question: str, answer_id: str, text: str, append: bool = True):
+        """Writes the answer while it's generated, the file is kept when the answer is cut off or fails."""
+        path = self._partial_path(model, question, answer_id)
+        path.parent.mkdir(exist_ok=True)
+
+        async with aiofiles.open(path, 'a' if append else 'w', encoding='utf-8') as f:
+            await f.write(text)
+
+    def remove_partial(self, model: str, question: str, answer_id: str):
+        try:
+            os.remove(self._partial_path(model, question, answer_id))
+        except FileNotFoundError:
+            pass
@@ -1,47 +1,304 @@
 import asyncio
+from pathlib import Path
 from threading import Event
 from typing import List
 import time
 
+from answer_archive import AnswerArchive
 from chunker import Chunker
-from common_models import FileType, Question, QuestionAnswer
+from common_models import Chunk, FileType, ModelAnswer, PipelineSteps, Question, QuestionAnswer, RetrievalMode
+from file_deduplicator import FileDeduplicator
+from file_manifest import FileManifest
 from file_processor import FileProcessor
 from output_persistor import OutputPersistor
 from repository_copilot import RepositoryCoPilot
+from result_store import ResultStore
+from retrieval_index import BM25Index
 from batch_code_saver import BatchCodeSaver
+from tracing import Tracer
 
 
 class Pipeline:
-    def __init__(self, questions, fileProcessor: FileProcessor, repoCoPilot: RepositoryCoPilot, chunker: Chunker, outputPersistor: OutputPersistor, batchCodeSaver: BatchCodeSaver):
+    def __init__(self, questions, fileProcessor: FileProcessor, repoCoPilot: RepositoryCoPilot, chunker: Chunker, outputPersistor: OutputPersistor, batchCodeSaver: BatchCodeSaver, fileManifest: FileManifest = None, answerArchive: AnswerArchive = None, retrievalIndex: BM25Index = None, tracer: Tracer = None, resultStore: ResultStore = None, fileDeduplicator: FileDeduplicator = None):
         self.questions = questions
         self.repoCoPilot = repoCoPilot
         self.fileProcessor = fileProcessor
         self.chunker = chunker
         self.outputPersistor = outputPersistor
         self.batchCodeSaver = batchCodeSaver
+        self.fileManifest = fileManifest
+        self.answerArchive = answerArchive
+        self.retrievalIndex = retrievalIndex
+        self.tracer = tracer if tracer else Tracer(enabled=False)
+        self.resultStore = resultStore
+        self.fileDeduplicator = fileDeduplicator
+
+    @property
+    def incremental(self) -> bool:
+        return self.fileManifest is not None and self.answerArchive is not None
 
     async def run(self) -> List[QuestionAnswer]:
-        files_content = await self.fileProcessor.read_files()
-        chunks = self.chunker.chunk_files(files_content)
-        tasks = [self._ask(question, chunks) for question in self.questions if question.enabled]
+        with self.tracer.span("pipeline", mode="batch"):
+            return await self._run()
+    
+    async def _run(self) -> List[QuestionAnswer]:
+        with self.tracer.span("read_files") as span:
+            files_content = await self.fileProcessor.read_files()
+            span.set(files=sum(len(type_files) for type_files in files_content.values()))
+        enabled_questions = [question for question in self.questions if question.enabled]
+        reused_answers = {question: [] for question in enabled_questions}
+        pending_paths = {question: None for question in enabled_questions}
+        
+        if self.incremental:
+            files_content = await self._select_pending_files(files_content, enabled_questions, reused_answers, pending_paths)
+        
+        if self.fileDeduplicator:
+            with self.tracer.span("deduplicate_files") as span:
+                files_content = await self.fileDeduplicator.deduplicate(files_content)
+                span.set(**self.fileDeduplicator.stats())
+        
+        await self._set_chunk_budget(enabled_questions)
+        with self.tracer.span("chunk_files") as span:
+            chunks = self.chunker.chunk_files(files_content)
+            span.set(chunks=sum(len(type_chunks) for type_chunks in chunks.values()))
+        
+        if self._uses_retrieval(enabled_questions):
+            # An incremental run only chunks the pending files, the chunks of the other files stay in the index
+            with self.tracer.span("index_chunks"):
+                await self.retrievalIndex.update([chunk for type_chunks in chunks.values() for chunk in type_chunks], prune=not self.incremental)
+        
+        start_time = time.time()
+        question_chunks = {question: await self._allowed_chunks(question, chunks, pending_paths[question]) for question in enabled_questions}
+        with self.tracer.span("ask_questions", questions=len(enabled_questions), chunks=sum(len(question_chunk) for question_chunk in question_chunks.values())):
+            chunks_answers = await self.repoCoPilot.ask_questions(question_chunks)
+        
+        duplicate_answers = {question: await self._fan_out(question, chunks_answers[question]) for question in enabled_questions}
+        
+        tasks = [self._answer(question, chunks_answers[question], reused_answers[question], duplicate_answers[question], start_time) for question in enabled_questions]
         result = await asyncio.gather(*tasks)
-        await self.outputPersistor.persist(result)
-        await self.batchCodeSaver.save(result)
         
+        with self.tracer.span("persist"):
+            await self.outputPersistor.persist(result)
+        with self.tracer.span("save_code"):
+            # The code changes are saved from the structured chunk answers, the refined answers are free text
+            await self.batchCodeSaver.save([self._code_answers(question, chunks_answers[question], start_time) for question in enabled_questions if question.structured_output])
+        
+        if self.resultStore:
+            await self.resultStore.flush()
+        
+        if self.incremental:
+            await self.answerArchive.save()
+            await self.fileManifest.save()
+        
+        self._report_duplicates()
         return result
+    
+    async def run_streaming(self, queue_size=256, workers=32) -> List[List[QuestionAnswer]]:
+        """
+        Runs the pipeline as a chain of stages connected by bounded queues: files flow into the chunker as they are read,
+        chunks flow to the model workers, and chunk answers flow to the persistor and the code saver as they arrive.
+        Only the chunk answers (without their context) are kept in memory until the final refine step.
+        """
+        with self.tracer.span("pipeline", mode="streaming", queue_size=queue_size, workers=workers):
+            return await self._run_streaming(queue_size, workers)
+    
+    async def _run_streaming(self, queue_size: int, workers: int) -> List[List[QuestionAnswer]]:
+        if self.incremental:
+            raise ValueError("The incremental analysis isn't supported by the streaming pipeline")
         
-
-    async def _ask(self, question: Question, chunks) -> List[QuestionAnswer]:
+        questions = [question for question in self.questions if question.enabled]
+        
+        if any(question.retrieval_mode != RetrievalMode.ALL for question in questions):
+            raise ValueError("The chunk retrieval isn't supported by the streaming pipeline, it needs all the chunks to be indexed first")
+        
+        progress_reporter = self.chunker.progress_reporter
+        files_queue = asyncio.Queue(maxsize=queue_size)
+        work_queue = asyncio.Queue(maxsize=queue_size)
+        answers_queue = asyncio.Queue(maxsize=queue_size)
+        chunk_answers = {question: [] for question in questions}
         start_time = time.time()
+        await self._set_chunk_budget(questions)
+        
+        async def read_files():
+            with self.tracer.span("read_files") as span:
+                async for file_content in self.fileProcessor.iter_files():
+                    # A copy of a file already read isn't chunked, the answers of its original are fanned out to it
+                    if self.fileDeduplicator and await asyncio.to_thread(self.fileDeduplicator.add, file_content) is not None:
+                        span.increment("duplicates")
+                        continue
+                    if progress_reporter:
+                        progress_reporter.add_tasks(PipelineSteps.CHUNKING, 1)
+                    span.increment("files")
+                    await files_queue.put(file_content)
+            await files_queue.put(None)
+        
+        async def dispatch(file_type: FileType, chunk: Chunk):
+            allowed_questions = [question for question in questions if self._is_allowed(question, file_type)]
+            for model in dict.fromkeys(model for question in allowed_questions for model in question.models):
+                for group in self.repoCoPilot.batch_groups([question for question in allowed_questions if model in question.models]):
+                    if progress_reporter:
+                        progress_reporter.add_tasks(PipelineSteps.ANSWERING_QUESTIONS, len(group))
+                    await work_queue.put((group, chunk, model))
+        
+        async def chunk_files():
+            while (file_content := await files_queue.get()) is not None:
+                with self.tracer.span("chunk_file", file=file_content.filepath) as span:
+                    file_chunks = self.chunker.chunk_file(file_content)
+                    span.set(chunks=len(file_chunks))
+                for chunk in file_chunks:
+                    await dispatch(file_content.filetype, chunk)
+            
+            for file_type, chunks in self.chunker.flush().items():
+                for chunk in chunks:
+                    await dispatch(file_type, chunk)
+            
+            for _ in range(workers):
+                await work_queue.put(None)
+        
+        async def answer_chunks():
+            while (item := await work_queue.get()) is not None:
+                group, chunk, model = item
+                for question, answer in zip(group, await self.repoCoPilot.ask_chunk_batch(group, chunk, model)):
+                    await answers_queue.put((question, answer))
+            await answers_queue.put(None)
         
+        async def save_answers():
+            finished_workers = 0
+            while finished_workers < workers:
+                item = await answers_queue.get()
+                if item is None:
+                    finished_workers += 1
+                    continue
+                question, answer = item
+                end_time = time.time()
+                question_answer = QuestionAnswer(model=answer.model, question=question.text, answer=answer.answer, 
+                                                 time_taken=end_time - start_time, start_time=start_time, end_time=end_time, 
+                                                 content=answer.content, parsed=answer.parsed)
+                
+                with self.tracer.span("persist", model=answer.model):
+                    await self.outputPersistor.persist([[question_answer]], filename_strategy=self._chunk_answer_name_strategy)
+                
+                if question.structured_output and not answer.ignore:
+                    with self.tracer.span("save_code", model=answer.model):
+                        await self.batchCodeSaver.save([[question_answer]])
+                
+                chunk_answers[question].append(answer._replace(content=Chunk.from_source_files(answer.content.source_files), parsed=None))
+        
+        stages = [asyncio.create_task(stage) for stage in (read_files(), chunk_files(), save_answers(), *[answer_chunks() for _ in range(workers)])]
+        
+        try:
+            # A failing stage stops the run, the stages feeding it or fed by it would wait on its queue forever
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+            for stage in done:
+                stage.result()
+        finally:
+            for stage in stages:
+                stage.cancel()
+        
+        for question in questions:
+            await self._fan_out(question, chunk_answers[question])
+        
+        result = await asyncio.gather(*[self._refine(question, chunk_answers[question], start_time) for question in questions])
+        with self.tracer.span("persist"):
+            await self.outputPersistor.persist(result)
+        
+        if self.resultStore:
+            await self.resultStore.flush()
+        
+        self._report_duplicates()
+        return result
+    
+    async def _fan_out(self, question: Question, answers: List[ModelAnswer]) -> List[ModelAnswer]:
+        """Copies the answers of the files that have duplicates to the duplicates, they are stored but not refined again."""
+        if not self.fileDeduplicator:
+            return []
+        
+        copies = self.fileDeduplicator.fan_out(question, answers)
+        await self._store("duplicate", question, copies)
+        return copies
+    
+    def _report_duplicates(self):
+        if self.fileDeduplicator:
+            stats = self.fileDeduplicator.stats()
+            print(f"Duplicate files: {stats['exact_duplicates']} exact and {stats['near_duplicates']} near copies in {stats['clusters']} groups, "
+                  f"{stats['calls_saved']} calls saved and {stats['fanned_out_answers']} chunk answers fanned out")
+    
+    def _code_answers(self, question: Question, answers: List[ModelAnswer], start_time: float) -> List[QuestionAnswer]:
+        end_time = time.time()
+        return [
+            QuestionAnswer(model=answer.model, question=question.text, answer=answer.answer, time_taken=end_time - start_time,
+                           start_time=start_time, end_time=end_time, content=answer.content, parsed=answer.parsed)
+            for answer in answers if not answer.ignore
+        ]
+    
+    async def _store(self, kind: str, question: Question, answers: List[ModelAnswer], start_time: float = None, end_time: float = None):
+        if self.resultStore:
+            await self.resultStore.add(kind, question, answers, start_time, end_time)
+    
+    async def _set_chunk_budget(self, questions: List[Question]):
+        if self.chunker.max_chunk_size is None and questions:
+            self.chunker.max_chunk_size = await self.repoCoPilot.chunk_budget(questions)
+    
+    def _chunk_answer_name_strategy(self, output_dir: Path, question_answer: QuestionAnswer) -> Path:
+        chunk_id = question_answer.content.id
+        return output_dir / f"{question_answer.model}_question_{question_answer.question[:50]}_chunk_{chunk_id}.txt"
+    
+    def _uses_retrieval(self, questions: List[Question]) -> bool:
+        if not any(question.retrieval_mode != RetrievalMode.ALL for question in questions):
+            return False
+        if self.retrievalIndex is None:
+            raise ValueError("A retrieval index is needed for the questions with a retrieval mode")
+        return True
+    
+    def _is_allowed(self, question: Question, file_type: FileType) -> bool:
+        return FileType.ALL in question.allowed_file_types or file_type in question.allowed_file_types
+    
+    async def _select_pending_files(self, files_content, questions: List[Question], reused_answers: dict, pending_paths: dict):
+        """Keeps the files that were added/changed, or that have no reusable answer for one of the questions."""
+        await self.fileManifest.load()
+        await self.answerArchive.load()
+        
+        for type_files in files_content.values():
+            for file_content in type_files:
+                self.fileManifest.track(file_content)
+        
+        for question in questions:
+            answers, covered_paths = self.answerArchive.reusable(question, self.fileManifest.unchanged_paths)
+            allowed_paths = {str(file_content.filepath) for file_type, type_files in files_content.items() if self._is_allowed(question, file_type) for file_content in type_files}
+            reused_answers[question] = answers
+            pending_paths[question] = allowed_paths - covered_paths
+        
+        all_pending_paths = set().union(*pending_paths.values()) if pending_paths else set()
+        
+        print(f"Incremental run: {len(self.fileManifest.changed_paths)} added/changed, {len(self.fileManifest.removed_paths)} removed, {len(all_pending_paths)} files to analyse")
+        
+        return {file_type: [file_content for file_content in type_files if str(file_content.filepath) in all_pending_paths] for file_type, type_files in files_content.items()}
+
+    async def _allowed_chunks(self, question: Question, chunks, pending_paths: set[str] = None) -> List[Chunk]:
         if(FileType.ALL not in question.allowed_file_types):
             allowed_chunks = [chunk for file_type, type_chunks in chunks.items() if file_type in question.allowed_file_types for chunk in type_chunks]
         else:
             allowed_chunks = [chunk for _, type_chunks in chunks.items() for chunk in type_chunks]
-            
-        chunks_answer = await self.repoCoPilot.ask(question, allowed_chunks)
-        refined_answers = await self.repoCoPilot.refine_answer(chunks_answer, question)
+        
+        if pending_paths is not None:
+            allowed_chunks = [chunk for chunk in allowed_chunks if pending_paths.intersection(chunk.source_files)]
+        
+        if question.retrieval_mode != RetrievalMode.ALL:
+            allowed_chunks = await self.retrievalIndex.select(question, allowed_chunks)
+        
+        return allowed_chunks
+    
+    async def _answer(self, question: Question, chunks_answer: List[ModelAnswer], reused_answers: List[ModelAnswer], duplicate_answers: List[ModelAnswer], start_time: float) -> List[QuestionAnswer]:
+        if self.incremental:
+            self.answerArchive.update(question, list(chunks_answer) + list(duplicate_answers), self.fileManifest.changed_paths | self.fileManifest.removed_paths)
+        
+        return await self._refine(question, list(reused_answers) + list(chunks_answer), start_time)
+    
+    async def _refine(self, question: Question, chunks_answer: List[ModelAnswer], start_time: float) -> List[QuestionAnswer]:
+        with self.tracer.span("refine", question=question.text[:50], answers=len(chunks_answer)):
+            refined_answers = await self.repoCoPilot.refine_answer(chunks_answer, question)
         end_time = time.time()
+        await self._store("final", question, refined_answers, start_time, end_time)
 
         result = []
 
@@ -1,62 +1,187 @@
+import json
 import sys
-import os
-from threading import Lock, Event
-from typing import List
+from collections import deque
+from threading import Event
+from typing import List, TextIO
 import time
-from threading import Thread
+
+"""
+The progress of the pipeline steps, rendered by a background thread.
+
+The counters are only written from the event loop thread and only read by the render thread, so they are plain
+integers without a lock: updating the progress never waits on the rendering. The render thread snapshots the
+counters every interval, computes the rates and the ETA of each step over a sliding window of the snapshots, and
+writes a frame:
+    - tty: the steps are redrawn in place with ANSI cursor moves.
+    - lines: one plain line per frame, for the CI logs, skipped when the progress didn't change.
+    - json: one JSON object per frame, for the log collectors, skipped when the progress didn't change.
+"""
+
+RATE_WINDOW_SECONDS = 10.0
+
 
 class PipelineReport():
     def __init__(self, pipeline_steps: List[str], ):
         self.steps: List[str] = pipeline_steps
         self.steps_current: dict = {step: 0 for step in pipeline_steps}
         self.steps_total: dict = {step: 0 for step in pipeline_steps}
-        
+        self.counters: dict = {}
+        self.metrics: dict = {}
+
+
+class _RateWindow:
+    def __init__(self, window_seconds: float = RATE_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self.samples = deque()
+
+    def add(self, now: float, value: int) -> float:
+        """Adds a sample and returns the rate per second over the window, or None before there are two samples."""
+        self.samples.append((now, value))
+        while len(self.samples) > 2 and now - self.samples[0][0] > self.window_seconds:
+            self.samples.popleft()
+
+        start, start_value = self.samples[0]
+        return (value - start_value) / (now - start) if now > start else None
+
 
 class ProgressReporter():
-    def __init__(self, lock: Lock, steps: List[str], stop_event: Event =  None):
+    def __init__(self, steps: List[str], stop_event: Event = None, mode: str = "auto", interval: float = None, stream: TextIO = None):
         self.pipeline_report = PipelineReport(steps)
-        self.lock = lock
-        self.stop_event = stop_event
-        
+        self.stop_event = stop_event if stop_event else Event()
+        self.stream = stream if stream else sys.stdout
+        self.mode = mode if mode != "auto" else "tty" if self.stream.isatty() else "lines"
+
+        if self.mode not in ("tty", "lines", "json"):
+            raise ValueError(f"Unknown progress mode {mode}")
+
+        self.interval = interval if interval else 0.25 if self.mode == "tty" else 5.0
+        self._rates: dict[str, _RateWindow] = {}
+        self._rendered_lines = 0
+        self._last_frame = None
+
     def init_step(self, step_name: str, total_tasks: int):
         if step_name not in self.pipeline_report.steps:
             raise ValueError(f"Step {step_name} not found in pipeline")
-        
+
         if total_tasks < 0:
             raise ValueError(f"Total tasks must be greater than 0")
-        
-        with self.lock:
-            self.pipeline_report.steps_total[step_name] = total_tasks
-            self.pipeline_report.steps_current[step_name] = total_tasks
-    
+
+        self.pipeline_report.steps_total[step_name] = total_tasks
+        self.pipeline_report.steps_current[step_name] = total_tasks
+
+    def add_tasks(self, step_name: str, tasks: int = 1):
+        """Grows the total of a step whose size isn't known upfront, like the steps of the streaming pipeline."""
+        if step_name not in self.pipeline_report.steps:
+            raise ValueError(f"Step {step_name} not found in pipeline")
+
+        if tasks < 0:
+            raise ValueError(f"Tasks must be greater than 0")
+
+        self.pipeline_report.steps_total[step_name] += tasks
+        self.pipeline_report.steps_current[step_name] += tasks
+
     def update(self, step_name: str, finished_tasks: int = 1):
-        with self.lock:
-            if step_name not in self.pipeline_report.steps:
-                raise ValueError(f"Step {step_name} not found in pipeline")
-            if finished_tasks < 0:
-                raise ValueError(f"Finished tasks must be greater than 0")
-            if finished_tasks > self.pipeline_report.steps_total[step_name]:
-                raise ValueError(f"Finished tasks must be less than total tasks")
-            if self.pipeline_report.steps_current[step_name] - finished_tasks  < 0:
-                raise ValueError(f"finished tasks cannot exceed total tasks")
-            
-            self.pipeline_report.steps_current[step_name] -= finished_tasks
-    
+        if step_name not in self.pipeline_report.steps:
+            raise ValueError(f"Step {step_name} not found in pipeline")
+        if finished_tasks < 0:
+            raise ValueError(f"Finished tasks must be greater than 0")
+        if finished_tasks > self.pipeline_report.steps_total[step_name]:
+            raise ValueError(f"Finished tasks must be less than total tasks")
+        if self.pipeline_report.steps_current[step_name] - finished_tasks  < 0:
+            raise ValueError(f"finished tasks cannot exceed total tasks")
+
+        self.pipeline_report.steps_current[step_name] -= finished_tasks
+
+    def increment(self, counter: str, value: int = 1):
+        """Counts a throughput, like the requests or the tokens, whose rate is shown next to the steps."""
+        self.pipeline_report.counters[counter] = self.pipeline_report.counters.get(counter, 0) + value
+
+    def set_metric(self, name: str, value):
+        self.pipeline_report.metrics[name] = value
+
+    def snapshot(self) -> dict:
+        """The done and total tasks of each step with their rate and ETA, the counters with their rate, and the metrics."""
+        now = time.monotonic()
+        report = self.pipeline_report
+        steps_total = dict(report.steps_total)
+        steps_current = dict(report.steps_current)
+        steps = {}
+
+        for step in report.steps:
+            total = steps_total[step]
+            done = total - steps_current[step]
+            rate = self._rate(f"step:{step}", now, done)
+            eta = (total - done) / rate if rate and total > done else 0 if total and total == done else None
+            steps[step] = {"done": done, "total": total, "rate": round(rate, 2) if rate is not None else None, "eta_seconds": round(eta) if eta is not None else None}
+
+        counters = {}
+        for name, value in dict(report.counters).items():
+            rate = self._rate(f"counter:{name}", now, value)
+            counters[name] = {"value": value, "rate": round(rate, 2) if rate is not None else None}
+
+        return {"steps": steps, "counters": counters, "metrics": dict(report.metrics)}
+
+    def _rate(self, key: str, now: float, value: int) -> float:
+        return self._rates.setdefault(key, _RateWindow()).add(now, value)
+
+    def _format_eta(self, seconds: int) -> str:
+        if seconds is None:
+            return "--:--"
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes:02}:{seconds:02}"
+
+    def _tty_lines(self, snapshot: dict) -> List[str]:
+        lines = []
+        for step, progress in snapshot["steps"].items():
+            filled = int((progress["done"] / progress["total"]) * 50) if progress["total"] > 0 else 0
+            progress_bar = '[' + '\033[92m' + '#' * filled + '\033[0m' + ' ' * (50 - filled) + ']'
+            rate = f"{progress['rate']:.1f}/s" if progress["rate"] is not None else ""
+            lines.append(f"{step:<20}: {progress_bar} {progress['done']}/{progress['total']} {rate:>10} ETA {self._format_eta(progress['eta_seconds'])}")
+
+        if snapshot["counters"]:
+            lines.append("  ".join(f"{name}: {counter['value']} ({counter['rate'] or 0:.1f}/s)" for name, counter in snapshot["counters"].items()))
+
+        for name, value in snapshot["metrics"].items():
+            lines.append(f"{name}: {value}")
+
+        return lines
+
+    def _line(self, snapshot: dict) -> str:
+        steps = [
+            f"{step} {progress['done']}/{progress['total']}" + (f" {progress['rate']:.1f}/s ETA {self._format_eta(progress['eta_seconds'])}" if progress["rate"] else "")
+            for step, progress in snapshot["steps"].items() if progress["total"]
+        ]
+        counters = [f"{name} {counter['value']}" + (f" {counter['rate']:.1f}/s" if counter["rate"] else "") for name, counter in snapshot["counters"].items()]
+        return "[progress] " + " | ".join(steps + counters)
+
+    def render(self):
+        snapshot = self.snapshot()
+        # The rates change on every frame, a frame is only written when the progress itself changed
+        frame = ({step: (progress["done"], progress["total"]) for step, progress in snapshot["steps"].items()},
+                 {name: counter["value"] for name, counter in snapshot["counters"].items()}, snapshot["metrics"])
+
+        if self.mode != "tty" and frame == self._last_frame:
+            return
+        self._last_frame = frame
+
+        if self.mode == "json":
+            self.stream.write(json.dumps({"time": time.time(), **snapshot}, default=str) + "\n")
+        elif self.mode == "lines":
+            self.stream.write(self._line(snapshot) + "\n")
+        else:
+            lines = self._tty_lines(snapshot)
+            # Moves back to the first line of the previous frame, and clears each line before writing it again
+            cursor_up = f"\033[{self._rendered_lines}F" if self._rendered_lines else ""
+            self.stream.write(cursor_up + "".join(f"\033[2K{line}\n" for line in lines))
+            if len(lines) < self._rendered_lines:
+                self.stream.write("\033[J")
+            self._rendered_lines = len(lines)
+
+        self.stream.flush()
+
     def report(self):
-        while True:
-            with self.lock:
-                os.system('cls' if os.name == 'nt' else 'clear')
-                for step in self.pipeline_report.steps:
-                    current = self.pipeline_report.steps_total[step] - self.pipeline_report.steps_current[step]
-                    total = self.pipeline_report.steps_total[step]
-                    progress = int((current / total) * 50) if total > 0 else 0
-                    progress_bar = '[' + '\033[92m' + '#' * progress + '\033[0m' + ' ' * (50 - progress) + ']'
-                    sys.stdout.write(f'{step:<20}: {progress_bar} {current}/{total}\n')
-                
-                sys.stdout.flush()
-            
-            if self.stop_event and self.stop_event.is_set():
-                break
-                
-            time.sleep(0.25)
-           
\ No newline at end of file
+        while not self.stop_event.wait(self.interval):
+            self.render()
+
+        self.render()
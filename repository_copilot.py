@@ -1,88 +1,530 @@
 import asyncio
+from contextlib import nullcontext
+import hashlib
+import json
+from pathlib import Path
+import time
 from typing import List
 
 import aiofiles
 from openai import AsyncOpenAI
+from checkpoint_journal import CheckpointJournal
 from chunker import Chunker
+from completion_stream import StreamMetrics, stream_completion, stream_parsed_completion
 from common_models import Question, ModelAnswer
 from model_config import ModelConfigParser
 from openai_client_factory import OpenAIClientFactory
+from output_persistor import OutputPersistor
 from progress_reporter import ProgressReporter
 from common_models import PipelineSteps
+from request_scheduler import RequestScheduler
+from response_cache import ResponseCache
+from result_store import ResultStore
+from response_formats.batched_answers import BatchedAnswersResponseFormat
+from resilience import CircuitOpenError, RetryPolicy
+from token_counter import TokenCounter, create_token_counter, first_fit_decreasing
+from tracing import Tracer
+
+# Tokens of the chat message framing and the context fences added around the prompts
+PROMPT_OVERHEAD_TOKENS = 64
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+# A reduction that doesn't converge (answers too big to be grouped) stops after this many levels
+MAX_REFINE_LEVELS = 8
 
 class RepositoryCoPilot:
-    def __init__(self, max_chunk_size=2000, openai_client_factory: OpenAIClientFactory = None, max_tokens=128000, progress_reporter: ProgressReporter = None):
+    def __init__(self, max_chunk_size=2000, openai_client_factory: OpenAIClientFactory = None, max_tokens=128000, progress_reporter: ProgressReporter = None, request_scheduler: RequestScheduler = None, response_cache: ResponseCache = None, token_counter: TokenCounter = None, refine_fan_in: int = 8, batch_questions: bool = False, max_batch_questions: int = 4, retry_policy: RetryPolicy = None, refine_retries: int = 2, stream_completions: bool = False, output_persistor: OutputPersistor = None, partial_flush_chars: int = 1024, tracer: Tracer = None, result_store: ResultStore = None, journal: CheckpointJournal = None, max_concurrency: int = None):
         self._chunker = Chunker(max_chunk_size)
         self._openai_client_factory = openai_client_factory
         self._default_system_prompt = "You're an AI assistant that helps people to have more understanding about their source code repositories. Make sure your answers are based on the content of the repository. Another task you can do is by helping in migrating code from one cloud provider libraries to another. In-case of migrating code, make sure to validate the approach of the migration by writing unit tests for the change before and after the migration to validate the change."
         self._max_tokens = max_tokens
         self._progress_reporter = progress_reporter
+        self._request_scheduler = request_scheduler
+        self._response_cache = response_cache
+        self._token_counter = token_counter if token_counter else create_token_counter()
+        self._refine_fan_in = refine_fan_in
+        self._batch_questions = batch_questions
+        self._max_batch_questions = max_batch_questions
+        self._retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self._refine_retries = refine_retries
+        self._stream_completions = stream_completions
+        self._output_persistor = output_persistor
+        self._partial_flush_chars = partial_flush_chars
+        self._stream_metrics = StreamMetrics()
+        # Caps the requests in flight of this copilot, below the limits of the scheduler it may share with others
+        self._concurrency = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self._usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._tracer = tracer if tracer else Tracer(enabled=False)
+        self._result_store = result_store
+        self._journal = journal
+    
+    def _system_prompt(self, question: Question) -> str:
+        return question.system_prompt if question.system_prompt else self._default_system_prompt
+    
+    async def prompt_budget(self, question: Question, model: str) -> int:
+        """The number of tokens left for the context (chunk or answers) once the prompts and the completion are accounted for."""
+        model_config = await self._openai_client_factory.get_model_config(model)
+        context_window = model_config.context_window or self._max_tokens
+        max_output_tokens = model_config.max_output_tokens or DEFAULT_MAX_OUTPUT_TOKENS
         
-    async def ask(self, question: Question, chunks) -> List[ModelAnswer]:
-        async def get_response(chunk, model) -> ModelAnswer:
-            system_prompt = question.system_prompt if question.system_prompt else self._default_system_prompt
-            max_completion_tokens = self._max_tokens - len(system_prompt.split()) - len(question.text.split()) - len(chunk.split())
+        return context_window - max_output_tokens - PROMPT_OVERHEAD_TOKENS - self._token_counter.count(self._system_prompt(question)) - self._token_counter.count(question.text)
+    
+    async def chunk_budget(self, questions: List[Question]) -> int:
+        """The biggest chunk every model of the questions can take."""
+        return min([await self.prompt_budget(question, model) for question in questions for model in question.models], default=self._max_tokens)
+    
+    def _reserve(self, model: str, tokens: int, question: Question):
+        if not self._request_scheduler:
+            return nullcontext()
+        return self._request_scheduler.reserve(model, tokens, fairness_key=question.text)
+    
+    async def _cache_key(self, kind: str, question: Question, model: str, system_prompt: str, content: str) -> str:
+        if not self._response_cache:
+            return None
+        model_config = await self._openai_client_factory.get_model_config(model)
+        return self._response_cache.key(kind, model, model_config.version, system_prompt, question.text, question.response_format, content)
+    
+    def stream_stats(self) -> dict[str, dict]:
+        """The time to first token, tokens per second and cut off answers of each model, when streaming."""
+        return self._stream_metrics.stats()
+    
+    def usage_stats(self) -> dict[str, int]:
+        """The requests sent by this copilot and the tokens they used."""
+        return dict(self._usage)
+    
+    def _partial_writer(self, question: Question, model: str, messages: list):
+        if not self._output_persistor:
+            return None, None
+        
+        answer_id = hashlib.sha1(json.dumps(messages).encode('utf-8')).hexdigest()[:12]
+        buffer = []
+        written = False
+        
+        async def write(delta: str = None, final: bool = False):
+            nonlocal written
+            if delta:
+                buffer.append(delta)
+            if buffer and (final or sum(len(part) for part in buffer) >= self._partial_flush_chars):
+                text = "".join(buffer)
+                buffer.clear()
+                # A retried request starts the file over
+                await self._output_persistor.persist_partial(model, question.text, answer_id, text, append=written)
+                written = True
+        
+        return write, answer_id
+    
+    async def _complete(self, question: Question, model: str, messages: list, prompt_tokens: int, response_format=None, max_output_tokens: int = None):
+        """Sends the request, retrying the transient failures as told by the retry policy and the model retries."""
+        model_config = await self._openai_client_factory.get_model_config(model)
+        attempt = 0
+        
+        with self._tracer.span("llm_call", model=model, prompt_tokens=prompt_tokens, streamed=self._stream_completions, retries=0) as span:
+            while True:
+                try:
+                    return await self._complete_once(question, model, messages, prompt_tokens, response_format, max_output_tokens)
+                except CircuitOpenError as e:
+                    # All the deployments are out of rotation, the request waits for one to come back without using a retry
+                    span.increment("unavailable_waits")
+                    await asyncio.sleep(self._retry_policy.unavailable_delay(e))
+                except Exception as e:
+                    delay = self._retry_policy.delay(attempt, e, model_config.retries)
+                    
+                    if delay is None:
+                        raise
+                    
+                    print(f"Request to model {model} failed, retry {attempt + 1} of {model_config.retries} in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    span.set(retries=attempt)
+    
+    async def _complete_once(self, question: Question, model: str, messages: list, prompt_tokens: int, response_format=None, max_output_tokens: int = None):
+        response_format = response_format or (question.response_format if question.structured_output else None)
+        max_output_tokens = max_output_tokens or question.max_output_tokens
+        options = {"max_tokens": max_output_tokens} if max_output_tokens else {}
+        
+        async with self._concurrency or nullcontext(), self._reserve(model, prompt_tokens, question) as reservation, self._openai_client_factory.route(model, reservation.deployment if reservation else None) as deployment:
+            client = deployment.client
+            span = self._tracer.current()
+            span.set(endpoint=deployment.model_config.endpoint, deployment=deployment.model)
             
-            try:
-                if(max_completion_tokens <= 0):
-                    print(f"Skipping chunk {chunk} for model {model} as it exceeds the token limit")
-                    return ModelAnswer(model=model, answer="skipped due to max token limit", content=chunk)
-                
-                client = await self._openai_client_factory.get_client(model)
+            if(self._stream_completions):
+                write_partial, answer_id = self._partial_writer(question, model, messages)
                 
-                messages = [
-                    {"role": "system", "content": f"{system_prompt} \n```Content Structure: file_name, file_type, content```\n ```\nContext:\n" + chunk + "\n```"},
-                    {"role": "user", "content": question.text}
-                ]
-                
-                ignore_answer = False
-                
-                if(not question.structured_output):
-                    response = await client.chat.completions.create(
-                        model=model,
-                        messages=messages,
-                        temperature=0,
-                        stream=False
-                    )
+                if(not response_format):
+                    response = await stream_completion(client, deployment.model, messages, prompt_tokens, max_output_tokens, write_partial, self._stream_metrics, model)
                 else:
-                    response = await client.beta.chat.completions.parse(
-                        model=model,
-                        messages=messages,
-                        temperature=0,
-                        response_format=question.response_format
-                    )
-                    
-                    ignore_answer = not any(code_change.is_refactored for code_change in response.choices[0].message.parsed.changes)
+                    response = await stream_parsed_completion(client, deployment.model, messages, response_format, max_output_tokens, write_partial, self._stream_metrics, model)
                 
-                return ModelAnswer(model=model, answer=response.choices[0].message.content.strip(), content=chunk, ignore=ignore_answer)
-                
-            except Exception as e:
-                print(f"Question: {question.text} for model: {model}, had a skipped chunk due to {e}")
-                
-                async with aiofiles.open(f"./output/{question.text[:50]}_refined_iqnored_chunks.txt", 'a', encoding='utf-8') as f:
-                    await f.write(f"Chunk failed for LLM Model: {model}, prompt: {messages}, and chunk {chunk} The reason was: {e}\n\n")
-
-                return ModelAnswer(model=model, answer="error", content=chunk, ignore=True)
-            finally:
-                if(self._progress_reporter):
-                    self._progress_reporter.update(PipelineSteps.ANSWERING_QUESTIONS, 1)
+                if write_partial:
+                    await write_partial(final=True)
+                    if response.choices[0].finish_reason == "length":
+                        print(f"Answer of model {model} to question {question.text[:50]} was cut off at the output token cap")
+                    else:
+                        self._output_persistor.remove_partial(model, question.text, answer_id)
+            elif(not response_format):
+                response = await client.chat.completions.create(
+                    model=deployment.model,
+                    messages=messages,
+                    temperature=0,
+                    stream=False,
+                    **options
+                )
+            else:
+                response = await client.beta.chat.completions.parse(
+                    model=deployment.model,
+                    messages=messages,
+                    temperature=0,
+                    response_format=response_format,
+                    **options
+                )
+            
+            self._usage["requests"] += 1
+            if self._progress_reporter:
+                self._progress_reporter.increment("requests")
+            
+            if response.usage:
+                self._usage["prompt_tokens"] += response.usage.prompt_tokens
+                self._usage["completion_tokens"] += response.usage.completion_tokens
+                span.set(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+                if reservation:
+                    reservation.record_usage(response.usage.total_tokens)
+                if self._progress_reporter:
+                    self._progress_reporter.increment("tokens", response.usage.total_tokens)
+            
+            return response
+        
+    async def ask_chunk(self, question: Question, chunk, model: str) -> ModelAnswer:
+        with self._tracer.span("ask_chunk", model=model, question=question.text[:50], chunk=getattr(chunk, "id", None)) as span:
+            start_time = time.time()
+            # The chunk text is read once for the requests sending it together, it isn't kept by the answer
+            async with chunk.loaded() as chunk_text:
+                answer = await self._ask_chunk(question, chunk, chunk_text, model)
+            span.set(ignored=answer.ignore, error=answer.error)
+            await self._store_chunk_answers(question, [answer], start_time)
+            return answer
+    
+    async def _ask_chunk(self, question: Question, chunk, chunk_text: str, model: str) -> ModelAnswer:
+        system_prompt = self._system_prompt(question)
+        chunk_tokens = self._token_counter.count(chunk_text)
+        messages = None
+        
+        try:
+            journaled = self._journal.answer(question, model, chunk_text) if self._journal else None
+            if journaled:
+                return ModelAnswer(model=model, answer=journaled[0], content=chunk, ignore=journaled[1])
+            
+            if(chunk_tokens > await self.prompt_budget(question, model)):
+                print(f"Skipping chunk {getattr(chunk, 'source_files', chunk)} for model {model} as it exceeds the token limit")
+                return ModelAnswer(model=model, answer="skipped due to max token limit", content=chunk, ignore=True)
+            
+            messages = [
+                {"role": "system", "content": f"{system_prompt} \n```Content Structure: file_name, file_type, content```\n ```\nContext:\n" + chunk_text + "\n```"},
+                {"role": "user", "content": question.text}
+            ]
+            
+            ignore_answer = False
+            
+            cache_key = await self._cache_key("ask", question, model, system_prompt, chunk_text)
+            cached = await self._response_cache.get(cache_key) if cache_key else None
+            self._tracer.current().set(cache="off" if not cache_key else "hit" if cached else "miss")
+            
+            if cached:
+                answer, ignore_answer = cached
+                return self._checkpoint(question, model, chunk_text, ModelAnswer(model=model, answer=answer, content=chunk, ignore=ignore_answer))
             
+            prompt_tokens = self._token_counter.count(system_prompt) + self._token_counter.count(question.text) + chunk_tokens + PROMPT_OVERHEAD_TOKENS
+            response = await self._complete(question, model, messages, prompt_tokens)
             
+            parsed = response.choices[0].message.parsed if question.structured_output else None
+            
+            if(question.structured_output):
+                ignore_answer = not any(code_change.is_refactored for code_change in parsed.changes)
+            
+            answer = response.choices[0].message.content.strip()
+            
+            if cache_key:
+                await self._response_cache.set(cache_key, model, answer, ignore_answer)
+            
+            return self._checkpoint(question, model, chunk_text, ModelAnswer(model=model, answer=answer, content=chunk, ignore=ignore_answer, parsed=parsed))
+            
+        except Exception as e:
+            print(f"Question: {question.text} for model: {model}, had a skipped chunk due to {e}")
+            
+            async with aiofiles.open(self._failed_chunks_path(question), 'a', encoding='utf-8') as f:
+                await f.write(f"Chunk failed for LLM Model: {model}, prompt: {messages}, and chunk {chunk_text} The reason was: {e}\n\n")
+
+            return ModelAnswer(model=model, answer="error", content=chunk, ignore=True, error=True)
+        finally:
+            if(self._progress_reporter):
+                self._progress_reporter.update(PipelineSteps.ANSWERING_QUESTIONS, 1)
+
+    def _failed_chunks_path(self, question: Question) -> Path:
+        """The log of the chunks that failed, next to the answers of the run."""
+        output_dir = self._output_persistor.output_dir if self._output_persistor else Path("./output")
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return output_dir / f"{question.text[:50]}_refined_iqnored_chunks.txt"
+
+    async def _store_chunk_answers(self, question: Question, answers: List[ModelAnswer], start_time: float):
+        """Stores the chunk answers as they come, a run stopped halfway keeps the answers it got."""
+        if self._result_store and answers:
+            await self._result_store.add("chunk", question, answers, start_time, time.time())
+
+    def _checkpoint(self, question: Question, model: str, chunk_text: str, answer: ModelAnswer) -> ModelAnswer:
+        if self._journal:
+            self._journal.record_answer(question, model, chunk_text, answer)
+        return answer
+    
+    async def ask(self, question: Question, chunks) -> List[ModelAnswer]:
         tasks = []
 
         for chunk in chunks:
             for model in question.models:
-                tasks.append(get_response(chunk, model))
+                tasks.append(self.ask_chunk(question, chunk, model))
 
         if(self._progress_reporter):
-            self._progress_reporter.init_step(PipelineSteps.ANSWERING_QUESTIONS, len(tasks))
+            self._progress_reporter.add_tasks(PipelineSteps.ANSWERING_QUESTIONS, len(tasks))
             
         modelAnswers = await asyncio.gather(*tasks)
         return modelAnswers
 
-    async def refine_answer(self, answers: List[ModelAnswer], question: Question) -> List[ModelAnswer]:
-        system_prompt = question.system_prompt if question.system_prompt else self._default_system_prompt
+    def batch_groups(self, questions: List[Question]) -> List[List[Question]]:
+        """
+        Groups the questions that can be asked together against a chunk: the questions sharing a system prompt and
+        without a structured output of their own, at most max_batch_questions at a time. Without batching, each
+        question is a group of its own.
+        """
+        if not self._batch_questions:
+            return [[question] for question in questions]
+        
+        singles = []
+        shared_prompts = {}
+        
+        for question in questions:
+            if question.structured_output:
+                singles.append([question])
+            else:
+                shared_prompts.setdefault(self._system_prompt(question), []).append(question)
+        
+        return singles + [group[index:index + self._max_batch_questions] for group in shared_prompts.values() for index in range(0, len(group), self._max_batch_questions)]
+    
+    async def _ask_batched(self, questions: List[Question], chunk_text: str, model: str, system_prompt: str) -> dict[int, str]:
+        numbered_questions = "\n".join(f"{number}. {question.text}" for number, question in enumerate(questions, start=1))
+        messages = [
+            {"role": "system", "content": f"{system_prompt} \n```Content Structure: file_name, file_type, content```\n ```\nContext:\n" + chunk_text + "\n```"},
+            {"role": "user", "content": f"Answer each of the following questions separately, with one answer per question number:\n{numbered_questions}"}
+        ]
+        
+        prompt_tokens = self._token_counter.count(messages[0]["content"]) + self._token_counter.count(messages[1]["content"]) + PROMPT_OVERHEAD_TOKENS
+        if all(question.max_output_tokens for question in questions):
+            max_output_tokens = sum(question.max_output_tokens for question in questions)
+        else:
+            # A question without a cap of its own leaves the batch the output tokens its prompt budget was kept for, not the cap of the first question
+            model_config = await self._openai_client_factory.get_model_config(model)
+            max_output_tokens = model_config.max_output_tokens or DEFAULT_MAX_OUTPUT_TOKENS
+        response = await self._complete(questions[0], model, messages, prompt_tokens, response_format=BatchedAnswersResponseFormat, max_output_tokens=max_output_tokens)
+        
+        return {batched.question_number: batched.answer.strip() for batched in response.choices[0].message.parsed.answers if batched.answer.strip()}
+    
+    async def ask_chunk_batch(self, questions: List[Question], chunk, model: str) -> List[ModelAnswer]:
+        """
+        Asks a group of batch_groups questions against the chunk in one request and splits the structured response
+        back into one answer per question. The questions answered from the cache aren't asked again, and the ones
+        the batched request couldn't answer (error, missing answer, over budget) are asked on their own.
+        """
+        if len(questions) == 1:
+            return [await self.ask_chunk(questions[0], chunk, model)]
+        
+        with self._tracer.span("ask_batch", model=model, questions=len(questions), chunk=getattr(chunk, "id", None)):
+            async with chunk.loaded() as chunk_text:
+                return await self._ask_chunk_batch(questions, chunk, chunk_text, model)
+    
+    async def _ask_chunk_batch(self, questions: List[Question], chunk, chunk_text: str, model: str) -> List[ModelAnswer]:
+        start_time = time.time()
+        system_prompt = self._system_prompt(questions[0])
+        answers = {}
+        cache_keys = {}
+        
+        for question in questions:
+            journaled = self._journal.answer(question, model, chunk_text) if self._journal else None
+            if journaled:
+                answers[question] = ModelAnswer(model=model, answer=journaled[0], content=chunk, ignore=journaled[1])
+                continue
+            
+            # The answers of a batched request are cached apart, they aren't the answers the question gets asked alone
+            cache_keys[question] = await self._cache_key("ask_batched", question, model, system_prompt, chunk_text)
+            cached = await self._response_cache.get(cache_keys[question]) if cache_keys[question] else None
+            if cached:
+                answers[question] = self._checkpoint(question, model, chunk_text, ModelAnswer(model=model, answer=cached[0], content=chunk, ignore=cached[1]))
+        
+        pending = [question for question in questions if question not in answers]
+        self._tracer.current().set(cache_hits=len(answers), batched=len(pending))
+        budget = await self.prompt_budget(pending[0], model) + self._token_counter.count(pending[0].text) if pending else 0
+        
+        if len(pending) > 1 and self._token_counter.count(chunk_text) + sum(self._token_counter.count(question.text) + 4 for question in pending) <= budget:
+            try:
+                batched_answers = await self._ask_batched(pending, chunk_text, model, system_prompt)
+            except Exception as e:
+                print(f"Batched questions for model: {model} failed, asking them one by one due to {e}")
+                batched_answers = {}
+            
+            for number, question in enumerate(pending, start=1):
+                if number in batched_answers:
+                    answers[question] = self._checkpoint(question, model, chunk_text, ModelAnswer(model=model, answer=batched_answers[number], content=chunk, ignore=False))
+                    if cache_keys[question]:
+                        await self._response_cache.set(cache_keys[question], model, batched_answers[number], False)
+        
+        if(self._progress_reporter and answers):
+            self._progress_reporter.update(PipelineSteps.ANSWERING_QUESTIONS, len(answers))
         
+        for question, answer in answers.items():
+            await self._store_chunk_answers(question, [answer], start_time)
+        
+        # The questions asked on their own are stored by ask_chunk
+        unanswered = [question for question in questions if question not in answers]
+        for question, answer in zip(unanswered, await asyncio.gather(*[self.ask_chunk(question, chunk, model) for question in unanswered])):
+            answers[question] = answer
+        
+        return [answers[question] for question in questions]
+    
+    async def ask_questions(self, question_chunks: dict[Question, list]) -> dict[Question, List[ModelAnswer]]:
+        """
+        Answers each question against its chunks. With batching, the questions sharing a chunk and a model are asked
+        together (see batch_groups), so the chunk is sent once instead of once per question.
+        """
+        if not self._batch_questions:
+            answers = await asyncio.gather(*[self.ask(question, chunks) for question, chunks in question_chunks.items()])
+            return dict(zip(question_chunks.keys(), answers))
+        
+        chunk_questions = {}
+        
+        for question, chunks in question_chunks.items():
+            for chunk in chunks:
+                for model in question.models:
+                    chunk_questions.setdefault((chunk.id, model), (chunk, []))[1].append(question)
+        
+        tasks = []
+        
+        for (_, model), (chunk, questions) in chunk_questions.items():
+            for group in self.batch_groups(questions):
+                tasks.append((group, self.ask_chunk_batch(group, chunk, model)))
+        
+        if(self._progress_reporter):
+            self._progress_reporter.add_tasks(PipelineSteps.ANSWERING_QUESTIONS, sum(len(group) for group, _ in tasks))
+        
+        answers = {question: [] for question in question_chunks}
+        
+        for group, group_answers in zip([group for group, _ in tasks], await asyncio.gather(*[task for _, task in tasks])):
+            for question, answer in zip(group, group_answers):
+                answers[question].append(answer)
+        
+        print(f"Asked {sum(len(group) for group, _ in tasks)} chunk questions in {len(tasks)} batches")
+        return answers
+
+    async def refine_group(self, question: Question, model: str, answers: List[ModelAnswer]) -> ModelAnswer:
+        with self._tracer.span("refine_group", model=model, question=question.text[:50], answers=len(answers)):
+            refined = await self._refine_group(question, model, answers)
+        
+        if self._result_store:
+            await self._result_store.add("refine", question, [refined])
+        
+        return refined
+    
+    async def _refine_group(self, question: Question, model: str, answers: List[ModelAnswer]) -> ModelAnswer:
+        system_prompt = self._system_prompt(question)
+        combined_answers = "\n\n".join([answer.answer for answer in answers])
+        
+        token_count = self._token_counter.count(system_prompt) + self._token_counter.count(combined_answers) + self._token_counter.count(question.text) + PROMPT_OVERHEAD_TOKENS
+        print(f"Token count for deployment {model}: {token_count}")
+
+        try:
+            messages = [
+                {"role": "system", "content": f"{system_prompt} ```\nContext:\n" + combined_answers + "\n```"},
+                {"role": "user", "content": question.text}
+            ]
+            
+            cache_key = await self._cache_key("refine", question, model, system_prompt, combined_answers)
+            cached = await self._response_cache.get(cache_key) if cache_key else None
+            self._tracer.current().set(cache="off" if not cache_key else "hit" if cached else "miss")
+            
+            if cached:
+                return ModelAnswer(model=model, answer=cached[0], content=combined_answers, ignore=False)
+            
+            response = await self._complete(question, model, messages, token_count)
+            answer = response.choices[0].message.content.strip()
+            
+            if cache_key:
+                await self._response_cache.set(cache_key, model, answer, False)
+            
+            return ModelAnswer(model=model, answer=answer, content=combined_answers, ignore=False)
+        except Exception as e:
+            print(f"Error refining answer for model {model}: {e}")
+            raise e
+        finally:
+            if(self._progress_reporter):
+                self._progress_reporter.update(PipelineSteps.REFINING_ANSWERS, 1)
+
+    async def _reduce(self, question: Question, model: str, answers: List[ModelAnswer]) -> tuple[List[ModelAnswer], int, int]:
+        """Refines the answers level by level, in token-budgeted groups of at most refine_fan_in answers, until one answer is left."""
+        budget = await self.prompt_budget(question, model)
+        levels = 0
+        calls = 0
+        inputs_key = self._journal.inputs_key(answers) if self._journal else None
+        resumed = self._journal.refine_level(question, model, inputs_key) if self._journal else None
+        
+        if resumed:
+            levels, answers = resumed
+            print(f"Resuming the refine of model {model} at level {levels} with {len(answers)} answers")
+        
+        while levels == 0 or len(answers) > 1:
+            if levels == MAX_REFINE_LEVELS:
+                print(f"Refining the answers of model {model} stopped after {levels} levels with {len(answers)} answers left")
+                break
+            
+            groups = first_fit_decreasing(answers, lambda answer: self._token_counter.count(answer.answer) + 1, budget, max_items=self._refine_fan_in)
+            # A lone answer is carried to the next level as is, unless nothing can be grouped or it's the last one
+            carry = [group[0] for group in groups if len(group) == 1] if any(len(group) > 1 for group in groups) else []
+            groups = [group for group in groups if len(group) > 1] if carry else groups
+            
+            refined, retry_queue = await self._refine_groups(question, model, groups)
+            calls += len(groups)
+            
+            # A failed group is retried once its siblings are done, it never cancels them
+            for retry in range(self._refine_retries):
+                if not retry_queue:
+                    break
+                
+                print(f"Retrying {len(retry_queue)} failed refine groups of model {model}")
+                await asyncio.sleep(self._retry_policy.base_delay * 2 ** retry)
+                retried, retry_queue = await self._refine_groups(question, model, retry_queue)
+                refined += retried
+                calls += len(retried) + len(retry_queue)
+            
+            if retry_queue:
+                print(f"{len(retry_queue)} refine groups of model {model} failed, their answers are carried as is")
+                carry += [answer for group in retry_queue for answer in group]
+            
+            answers = carry + refined
+            levels += 1
+            
+            if self._journal:
+                self._journal.record_refine(question, model, inputs_key, levels, answers)
+            
+            if not refined:
+                break
+        
+        return answers, levels, calls
+    
+    async def _refine_groups(self, question: Question, model: str, groups: List[List[ModelAnswer]]) -> tuple[List[ModelAnswer], List[List[ModelAnswer]]]:
+        """Refines the groups, and returns the refined answers along with the groups that failed."""
+        if(self._progress_reporter):
+            self._progress_reporter.add_tasks(PipelineSteps.REFINING_ANSWERS, len(groups))
+        
+        results = await asyncio.gather(*[self.refine_group(question, model, group) for group in groups], return_exceptions=True)
+        refined = [result for result in results if not isinstance(result, BaseException)]
+        failed = [group for group, result in zip(groups, results) if isinstance(result, BaseException)]
+        
+        return refined, failed
+
+    async def refine_answer(self, answers: List[ModelAnswer], question: Question) -> List[ModelAnswer]:
         model_answers = {}
 
         for answer in answers:
@@ -94,73 +536,19 @@ class RepositoryCoPilot:
             
             model_answers[answer.model].append(answer)
 
-        tasks = []
-
-        async def refine(model, answers: List[ModelAnswer]) -> ModelAnswer:
-            combined_answers = "\n\n".join([answer.answer for answer in answers])
-            
-            max_completion_tokens = self._max_tokens - len(system_prompt.split()) - len(question.text.split())
+        models = [model for model, answers in model_answers.items() if answers]
+        reductions = await asyncio.gather(*[self._reduce(question, model, model_answers[model]) for model in models])
+        
+        refined_answers = []
+        
+        for model, (reduced_answers, levels, calls) in zip(models, reductions):
+            refined_answers.extend(reduced_answers)
+            # The former refine asked once per answer and once per 2000 characters bucket
+            previous_calls = len(model_answers[model]) + len(first_fit_decreasing(model_answers[model], lambda answer: len(answer.answer), 2000))
             
-            # Calculate the number of tokens needed
-            token_count = len(system_prompt.split()) + len(combined_answers.split()) + len(question.text.split())
-            print(f"Token count for deployment {model}: {token_count}")
-
-            try:
-                client = await self._openai_client_factory.get_client(model)
-                
-                if(not question.structured_output):
-                    response = await client.chat.completions.create(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": f"{system_prompt} ```\nContext:\n" + combined_answers + "\n```"},
-                            {"role": "user", "content": question.text}
-                        ],
-                        temperature=0,
-                        stream=False,
-                    )
-                else:
-                    response = await client.beta.chat.completions.parse(
-                        model=model,
-                        messages=[
-                            {"role": "system", "content": f"{system_prompt} ```\nContext:\n" + combined_answers + "\n```"},
-                            {"role": "user", "content": question.text}
-                        ],
-                        temperature=0,
-                        response_format=question.response_format,
-                    )
-                return ModelAnswer(model=model, answer=response.choices[0].message.content.strip(), content=combined_answers, ignore=False)
-            except Exception as e:
-                print(f"Error refining answer for model {model}: {e}")
-                raise e
-            finally:
-                if(self._progress_reporter):
-                    self._progress_reporter.update(PipelineSteps.REFINING_ANSWERS, 1)
-
-        for model, answers in model_answers.items():
-            # Split answers into smaller buckets with a max of 14k characters
-            bucket = []
-            bucket_length = 0
-            
-            for answer in answers:
-                tasks.append(refine(answer.model, [answer]))
-                answer_length = len(answer.answer)
-                if bucket_length + answer_length > 2000:
-                    task = refine(model, bucket)
-                    tasks.append(task)
-                    bucket = [answer]
-                    bucket_length = answer_length
-                else:
-                    bucket.append(answer)
-                    bucket_length += answer_length
-
-            if bucket:
-                task = refine(model, bucket)
-                tasks.append(task)
-                
-            # task = refine(model, answers)
-            # tasks.append(task)
-
-        if(self._progress_reporter):
-            self._progress_reporter.init_step(PipelineSteps.REFINING_ANSWERS, len(tasks))
+            print(f"Refined {len(model_answers[model])} answers of model {model} in {levels} levels and {calls} calls, {previous_calls - calls} calls saved")
             
-        return await asyncio.gather(*tasks)
+            if(self._progress_reporter):
+                self._progress_reporter.set_metric(f"Refine {model} {question.text[:30]!r}", f"{levels} levels, {calls} calls, {previous_calls - calls} calls saved")
+        
+        return refined_answers
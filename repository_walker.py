@@ -0,0 +1,182 @@
+import os
+import re
+import time
+from pathlib import Path
+from typing import Iterator, List
+
+"""
+A repository walker built on os.scandir. Ignored directories are pruned before they are entered, so trees like
+node_modules or .git are never listed.
+
+A path is ignored when:
+    - one of its directories is in folders_to_ignore, or its suffix is in files_to_ignore.
+    - it matches the .gitignore files of the repository (the root one and the nested ones) or .git/info/exclude.
+    - it's deeper than max_depth (the files of the root directory are at depth 0).
+    - it's bigger than max_file_size bytes.
+"""
+
+class GitIgnoreRule:
+    def __init__(self, pattern: str, base: str):
+        self.negate = pattern.startswith("!")
+        if self.negate:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        prefix = re.escape(base + "/") if base else ""
+        self.regex = re.compile(prefix + ("" if anchored else "(?:.*/)?") + self._translate(pattern))
+
+    @staticmethod
+    def _translate(pattern: str) -> str:
+        regex = ""
+        index = 0
+
+        while index < len(pattern):
+            if pattern.startswith("**/", index):
+                regex += "(?:.*/)?"
+                index += 3
+            elif pattern.startswith("/**", index) and index + 3 == len(pattern):
+                regex += "/.*"
+                index += 3
+            elif pattern.startswith("**", index):
+                regex += ".*"
+                index += 2
+            elif pattern[index] == "*":
+                regex += "[^/]*"
+                index += 1
+            elif pattern[index] == "?":
+                regex += "[^/]"
+                index += 1
+            elif pattern[index] == "[" and "]" in pattern[index + 1:]:
+                end = pattern.index("]", index + 2 if pattern[index + 1:index + 2] == "]" else index + 1)
+                char_class = pattern[index + 1:end].replace("\\", "\\\\")
+                regex += "[" + ("^" + char_class[1:] if char_class.startswith("!") else char_class) + "]"
+                index = end + 1
+            elif pattern[index] == "\\" and index + 1 < len(pattern):
+                regex += re.escape(pattern[index + 1])
+                index += 2
+            else:
+                regex += re.escape(pattern[index])
+                index += 1
+
+        return regex
+
+    def matches(self, relative_path: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        return self.regex.fullmatch(relative_path) is not None
+
+
+def read_ignore_file(path: Path, base: str) -> List[GitIgnoreRule]:
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    rules = []
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        rules.append(GitIgnoreRule(line, base))
+    return rules
+
+
+class WalkStats:
+    def __init__(self):
+        self.directories_walked = 0
+        self.directories_pruned = 0
+        self.files_found = 0
+        self.files_ignored = 0
+        self.files_too_large = 0
+        self.walk_time = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return f"WalkStats({', '.join(f'{key}={value}' for key, value in self.__dict__.items())})"
+
+
+class RepositoryWalker:
+    def __init__(self, directory, folders_to_ignore=(), files_to_ignore=(), max_depth: int = None, max_file_size: int = None, respect_gitignore: bool = True):
+        self.directory = Path(directory)
+        self.folders_to_ignore = set(folders_to_ignore)
+        self.files_to_ignore = set(files_to_ignore)
+        self.max_depth = max_depth
+        self.max_file_size = max_file_size
+        self.respect_gitignore = respect_gitignore
+        self.stats = WalkStats()
+
+    def _is_ignored(self, rules: List[GitIgnoreRule], relative_path: str, is_dir: bool) -> bool:
+        ignored = False
+        for rule in rules:
+            if rule.negate == ignored and rule.matches(relative_path, is_dir):
+                ignored = not rule.negate
+        return ignored
+
+    def walk(self) -> Iterator[Path]:
+        self.stats = WalkStats()
+        start_time = time.time()
+        root_rules = []
+
+        if self.respect_gitignore:
+            root_rules = read_ignore_file(self.directory / ".git" / "info" / "exclude", "")
+
+        stack = [(self.directory, "", 0, root_rules)]
+
+        while stack:
+            directory, relative_dir, depth, rules = stack.pop()
+            self.stats.directories_walked += 1
+
+            if self.respect_gitignore:
+                nested_rules = read_ignore_file(directory / ".gitignore", relative_dir)
+                if nested_rules:
+                    rules = rules + nested_rules
+
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                print(f"Error listing {directory}: {e}")
+                continue
+
+            for entry in entries:
+                relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if is_dir:
+                    if entry.name in self.folders_to_ignore or self._is_ignored(rules, relative_path, True):
+                        self.stats.directories_pruned += 1
+                    elif self.max_depth is not None and depth + 1 > self.max_depth:
+                        self.stats.directories_pruned += 1
+                    else:
+                        stack.append((Path(entry.path), relative_path, depth + 1, rules))
+                    continue
+
+                # Only the names with an extension are analysed, like the former rglob('*.*')
+                if "." not in entry.name or not entry.is_file():
+                    continue
+
+                self.stats.files_found += 1
+
+                if Path(entry.name).suffix in self.files_to_ignore or self._is_ignored(rules, relative_path, False):
+                    self.stats.files_ignored += 1
+                    continue
+
+                if self.max_file_size is not None and entry.stat().st_size > self.max_file_size:
+                    self.stats.files_too_large += 1
+                    continue
+
+                yield Path(entry.path)
+
+        self.stats.walk_time = time.time() - start_time
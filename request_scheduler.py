@@ -0,0 +1,287 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import List
+
+from openai_client_factory import Deployment, OpenAIClientFactory
+from resilience import CircuitOpenError
+
+"""
+A scheduler that sits between the RepositoryCoPilot and the OpenAIClientFactory. Every model call reserves a slot
+before it goes out, so the deployments are never hit by more requests than they can serve.
+
+The scheduler enforces:
+    - max_concurrency: in-flight requests per model/deployment.
+    - endpoint_max_concurrency: in-flight requests shared by all the models on the same endpoint.
+    - requests_per_minute / tokens_per_minute: the deployment quota, tracked over a sliding one minute window.
+Each deployment of a model has its own limits. A request is given room on the deployment with the least in-flight
+requests relative to its weight among the ones with room for it, and the OpenAIClientFactory routes it there. The
+deployments out of rotation (throttled, or with their circuit open) aren't given requests. When all of them are out,
+the requests wait in their queues, without taking a slot of the quotas, until the first one comes back.
+
+Waiting requests are queued per fairness key (the question text), and the queues are served round-robin, so one
+question with thousands of chunks cannot starve the other questions asked against the same model.
+"""
+
+WINDOW_SECONDS = 60
+
+
+class RateBudget:
+    def __init__(self, per_minute: int = None):
+        self.per_minute = per_minute
+        self._events = deque()
+        self._used = 0
+
+    def _expire(self, now: float):
+        while self._events and now - self._events[0][0] >= WINDOW_SECONDS:
+            _, units = self._events.popleft()
+            self._used -= units
+
+    def _cap(self, units: int) -> int:
+        # A single request bigger than the whole quota must still go out eventually
+        return max(0, min(units, self.per_minute))
+
+    def wait_time(self, units: int, now: float) -> float:
+        if not self.per_minute:
+            return 0
+
+        self._expire(now)
+        overflow = self._used + self._cap(units) - self.per_minute
+
+        if overflow <= 0:
+            return 0
+
+        for timestamp, used in self._events:
+            overflow -= used
+            if overflow <= 0:
+                return timestamp + WINDOW_SECONDS - now
+
+        return WINDOW_SECONDS
+
+    def consume(self, units: int, now: float) -> list:
+        if not self.per_minute:
+            return None
+
+        event = [now, self._cap(units)]
+        self._events.append(event)
+        self._used += event[1]
+        return event
+
+    def refund(self, event: list):
+        """Gives back the units of a request that wasn't sent."""
+        if not self.per_minute or event is None or event not in self._events:
+            return
+
+        self._events.remove(event)
+        self._used -= event[1]
+
+    def adjust(self, event: list, units: int):
+        if not self.per_minute or event is None or event not in self._events:
+            return
+
+        units = self._cap(units)
+        self._used += units - event[1]
+        event[1] = units
+
+
+class Reservation:
+    def __init__(self, budget: "_DeploymentBudget", request_event: list, token_event: list):
+        self._budget = budget
+        self._request_event = request_event
+        self._token_event = token_event
+
+    @property
+    def deployment(self) -> Deployment:
+        """The deployment the request was given room on, the one it's routed to."""
+        return self._budget.deployment
+
+    def record_usage(self, total_tokens: int):
+        """Replaces the estimated tokens with the tokens reported by the model once the response is back."""
+        if total_tokens is not None:
+            self._budget.tokens.adjust(self._token_event, total_tokens)
+
+    def refund(self):
+        self._budget.requests.refund(self._request_event)
+        self._budget.tokens.refund(self._token_event)
+
+
+class _DeploymentBudget:
+    """The limits of one deployment of a model, from its own configuration."""
+
+    def __init__(self, deployment: Deployment):
+        model_config = deployment.model_config
+        self.deployment = deployment
+        self.endpoint = model_config.endpoint
+        self.max_concurrency = model_config.max_concurrency
+        self.in_flight = 0
+        self.requests = RateBudget(model_config.requests_per_minute)
+        self.tokens = RateBudget(model_config.tokens_per_minute)
+
+    def has_capacity(self) -> bool:
+        return not self.max_concurrency or self.in_flight < self.max_concurrency
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def load(self) -> float:
+        return (self.in_flight + 1) / self.deployment.weight
+
+
+class _ModelLane:
+    def __init__(self, deployments: List[Deployment]):
+        self.budgets = [_DeploymentBudget(deployment) for deployment in deployments]
+        self.endpoints = {budget.endpoint for budget in self.budgets}
+        self.waiters: dict[str, deque] = {}
+        self.turns = deque()
+        self.timer: asyncio.TimerHandle = None
+
+    @property
+    def in_flight(self) -> int:
+        return sum(budget.in_flight for budget in self.budgets)
+
+    def next_waiter(self):
+        while self.turns:
+            key = self.turns[0]
+            queue = self.waiters[key]
+
+            while queue and queue[0][0].done():
+                queue.popleft()
+
+            if queue:
+                return key, queue[0]
+
+            self.turns.popleft()
+            del self.waiters[key]
+
+        return None, None
+
+    def take_turn(self, key: str):
+        queue = self.waiters[key]
+        queue.popleft()
+        self.turns.popleft()
+
+        if queue:
+            self.turns.append(key)
+        else:
+            del self.waiters[key]
+
+
+class RequestScheduler:
+    def __init__(self, openai_client_factory: OpenAIClientFactory):
+        self._openai_client_factory = openai_client_factory
+        self._lanes: dict[str, _ModelLane] = {}
+        self._endpoint_in_flight: dict[str, int] = {}
+        self._endpoint_limits: dict[str, int] = {}
+
+    async def _get_lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+
+        if lane is None:
+            deployments = await self._openai_client_factory.get_deployments(model)
+            lane = self._lanes.setdefault(model, _ModelLane(deployments))
+
+            for deployment in deployments:
+                endpoint, endpoint_max_concurrency = deployment.model_config.endpoint, deployment.model_config.endpoint_max_concurrency
+                if endpoint_max_concurrency:
+                    current_limit = self._endpoint_limits.get(endpoint)
+                    self._endpoint_limits[endpoint] = min(current_limit, endpoint_max_concurrency) if current_limit else endpoint_max_concurrency
+
+        return lane
+
+    def _endpoint_has_capacity(self, endpoint: str) -> bool:
+        limit = self._endpoint_limits.get(endpoint)
+        return not limit or self._endpoint_in_flight.get(endpoint, 0) < limit
+
+    def _dispatch(self, lane: _ModelLane):
+        if lane.timer:
+            lane.timer.cancel()
+            lane.timer = None
+
+        while True:
+            key, waiter = lane.next_waiter()
+
+            if waiter is None:
+                return
+
+            future, tokens = waiter
+            now = time.monotonic()
+            available = [budget for budget in lane.budgets if budget.deployment.available(now)]
+
+            # The requests stay queued without taking a slot until a deployment comes back
+            if not available:
+                wait = min(budget.deployment.available_in(now) for budget in lane.budgets)
+                lane.timer = asyncio.get_running_loop().call_later(max(wait, 0.01), self._dispatch, lane)
+                return
+
+            budgets = [budget for budget in available if budget.has_capacity() and self._endpoint_has_capacity(budget.endpoint)]
+
+            if not budgets:
+                return
+
+            waits = [budget.wait_time(tokens, now) for budget in budgets]
+            ready = [budget for budget, wait in zip(budgets, waits) if wait <= 0]
+
+            if not ready:
+                lane.timer = asyncio.get_running_loop().call_later(min(waits), self._dispatch, lane)
+                return
+
+            budget = min(ready, key=lambda budget: budget.load())
+            lane.take_turn(key)
+            request_event = budget.requests.consume(1, now)
+            token_event = budget.tokens.consume(tokens, now)
+            budget.in_flight += 1
+            self._endpoint_in_flight[budget.endpoint] = self._endpoint_in_flight.get(budget.endpoint, 0) + 1
+            future.set_result(Reservation(budget, request_event, token_event))
+
+    def _release(self, lane: _ModelLane, budget: _DeploymentBudget):
+        budget.in_flight -= 1
+        self._endpoint_in_flight[budget.endpoint] -= 1
+
+        self._dispatch(lane)
+
+        for other in self._lanes.values():
+            if other is not lane and budget.endpoint in other.endpoints:
+                self._dispatch(other)
+
+    @asynccontextmanager
+    async def reserve(self, model: str, tokens: int = 0, fairness_key: str = ""):
+        """Waits for room on one of the deployments of the model, the reservation tells which one the request goes to."""
+        lane = await self._get_lane(model)
+        future = asyncio.get_running_loop().create_future()
+
+        if fairness_key not in lane.waiters:
+            lane.waiters[fairness_key] = deque()
+            lane.turns.append(fairness_key)
+
+        lane.waiters[fairness_key].append((future, tokens))
+        self._dispatch(lane)
+
+        try:
+            reservation = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(lane, future.result()._budget)
+            else:
+                future.cancel()
+            raise
+
+        try:
+            yield reservation
+        except CircuitOpenError:
+            # The deployment went out of rotation before the request was sent to it
+            reservation.refund()
+            raise
+        finally:
+            self._release(lane, reservation._budget)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            model: {
+                "in_flight": lane.in_flight,
+                "waiting": sum(len(queue) for queue in lane.waiters.values()),
+                "deployments": [{"endpoint": budget.endpoint, "deployment": budget.deployment.model, "in_flight": budget.in_flight,
+                                 "endpoint_in_flight": self._endpoint_in_flight.get(budget.endpoint, 0)} for budget in lane.budgets],
+            }
+            for model, lane in self._lanes.items()
+        }
@@ -0,0 +1,147 @@
+from email.utils import parsedate_to_datetime
+from enum import StrEnum
+import random
+import time
+
+from openai import APIConnectionError
+
+"""
+The failure handling around the model calls.
+
+RetryPolicy decides whether and when a failed call is retried: throttling (429), timeouts, server errors and
+connection errors are retried with a jittered exponential backoff, or after the delay of the Retry-After headers
+when the service sends them.
+
+CircuitBreaker stops sending requests to an endpoint that keeps failing. After failure_threshold consecutive
+failures the circuit opens and the requests fail fast for reset_timeout seconds, then a single trial request is let
+through (half-open): its success closes the circuit, its failure opens it again.
+"""
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_after(error: Exception) -> float:
+    """The delay asked by the Retry-After headers of the error response, or None."""
+    if isinstance(error, CircuitOpenError):
+        return error.retry_after
+
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+
+    try:
+        return float(headers.get("retry-after-ms")) / 1000
+    except (TypeError, ValueError):
+        pass
+
+    value = headers.get("retry-after")
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_failure(error: Exception) -> bool:
+    """Whether the error means the endpoint is unhealthy (as opposed to throttled or a bad request)."""
+    status_code = getattr(error, "status_code", None)
+    return isinstance(error, APIConnectionError) or (status_code is not None and status_code >= 500)
+
+
+def is_retryable(error: Exception) -> bool:
+    return isinstance(error, CircuitOpenError) or getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES or is_failure(error)
+
+
+class RetryPolicy:
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, error: Exception, max_retries: int = None) -> float:
+        """The seconds to wait before retrying the failed attempt (counted from 0), or None when it's not retried."""
+        max_retries = self.max_retries if max_retries is None else max_retries
+
+        if attempt >= max_retries or not is_retryable(error):
+            return None
+
+        requested = retry_after(error)
+
+        if requested is not None:
+            # A little jitter, so the requests waiting for the same Retry-After don't all come back at once
+            return min(requested, self.max_delay) + random.uniform(0, self.base_delay)
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def unavailable_delay(self, error: CircuitOpenError) -> float:
+        """The seconds to wait for a deployment to come back, the request wasn't sent so it isn't a retry."""
+        return min(error.retry_after, self.max_delay) + random.uniform(0, self.base_delay)
+
+
+class CircuitState(StrEnum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    def retry_in(self, now: float) -> float:
+        if self.state == CircuitState.HALF_OPEN:
+            # The trial request is in flight, its answer decides if the circuit closes
+            return 1.0 if self._trial_in_flight else 0.0
+        if self.state == CircuitState.OPEN:
+            return max(0.0, self._opened_at + self.reset_timeout - now)
+        return 0.0
+
+    def can_pass(self, now: float) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            return now - self._opened_at >= self.reset_timeout
+        return not self._trial_in_flight
+
+    def acquire(self, now: float):
+        """Lets a request through, the first one after the reset timeout being the trial request."""
+        if self.state == CircuitState.OPEN and now - self._opened_at >= self.reset_timeout:
+            self.state = CircuitState.HALF_OPEN
+            self._trial_in_flight = False
+
+        if self.state == CircuitState.HALF_OPEN:
+            self._trial_in_flight = True
+
+    def cancel_trial(self):
+        """Lets another trial request through when the trial one was cancelled before it got an answer."""
+        self._trial_in_flight = False
+
+    def record_success(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self, now: float):
+        self.failures += 1
+
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = CircuitState.OPEN
+            self.opened += 1
+            self.failures = 0
+            self._opened_at = now
+            self._trial_in_flight = False
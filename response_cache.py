@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+"""
+A persistent, content-addressed cache for the model answers. The key is a hash of everything that can change an
+answer: the model, its deployment version, the system prompt, the question, the response format schema and the
+content sent as context. Re-running the same questions over an unchanged repository is then served from disk.
+
+Attributes
+----------
+path : str
+    The SQLite database file. Default is ./output/response_cache.sqlite.
+max_entries : int
+    The max number of cached answers, the least recently used answers are evicted first.
+max_bytes : int
+    The max total size of the cached answers, the least recently used answers are evicted first.
+max_age_seconds : int
+    The max age of a cached answer, older answers are evicted.
+bypass : bool
+    When set, lookups always miss but fresh answers are still written, which refreshes the cache.
+"""
+
+EVICT_EVERY_WRITES = 100
+
+
+class ResponseCache:
+    def __init__(self, path="./output/response_cache.sqlite", max_entries: int = None, max_bytes: int = None, max_age_seconds: int = None, bypass: bool = False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                ignore INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._connection.commit()
+        self._evict()
+
+    @staticmethod
+    def _schema(response_format: Any) -> Optional[str]:
+        if response_format is None:
+            return None
+        if hasattr(response_format, "model_json_schema"):
+            return json.dumps(response_format.model_json_schema(), sort_keys=True)
+        return repr(response_format)
+
+    def key(self, kind: str, model: str, version: Optional[str], system_prompt: str, question_text: str, response_format: Any, content: str) -> str:
+        digest = hashlib.sha256()
+        for part in (kind, model, version, system_prompt, question_text, self._schema(response_format), content):
+            encoded = ("" if part is None else str(part)).encode("utf-8")
+            # Length-prefix every part so different splits of the same bytes never collide
+            digest.update(len(encoded).to_bytes(8, "big"))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def _get(self, key: str) -> Optional[Tuple[str, bool]]:
+        with self._lock:
+            row = self._connection.execute("SELECT answer, ignore, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row and self.max_age_seconds and time.time() - row[2] > self.max_age_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                self.evictions += 1
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            self.hits += 1
+            return row[0], bool(row[1])
+
+    def _set(self, key: str, model: str, answer: str, ignore: bool):
+        with self._lock:
+            now = time.time()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, answer, ignore, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, answer, int(ignore), len(answer.encode("utf-8")), now, now),
+            )
+            self._connection.commit()
+            self.writes += 1
+
+        if self.writes % EVICT_EVERY_WRITES == 0:
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            evicted = 0
+
+            if self.max_age_seconds:
+                evicted += self._connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,)).rowcount
+
+            if self.max_entries:
+                evicted += self._connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                ).rowcount
+
+            if self.max_bytes:
+                total_bytes = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total_bytes > self.max_bytes:
+                    cursor = self._connection.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC")
+                    keys = []
+                    for key, size in cursor:
+                        if total_bytes <= self.max_bytes:
+                            break
+                        keys.append((key,))
+                        total_bytes -= size
+                    evicted += self._connection.executemany("DELETE FROM responses WHERE key = ?", keys).rowcount
+
+            self._connection.commit()
+            self.evictions += max(evicted, 0)
+
+    async def get(self, key: str) -> Optional[Tuple[str, bool]]:
+        if self.bypass:
+            self.misses += 1
+            return None
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, model: str, answer: str, ignore: bool):
+        await asyncio.to_thread(self._set, key, model, answer, ignore)
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes, "evictions": self.evictions}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,9 @@
+from typing import List
+from pydantic import BaseModel
+
+class BatchedAnswer(BaseModel):
+    question_number: int
+    answer: str
+
+class BatchedAnswersResponseFormat(BaseModel):
+    answers: List[BatchedAnswer]
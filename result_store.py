@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List
+
+from common_models import ModelAnswer, Question
+
+"""
+An append-only store of every answer of a run: the chunk answers, the answers of each refine group and the final
+answers, with their model, question, source files and timings. The answers are added as they are produced, buffered,
+and written in batches of one transaction each, so the pipeline never waits on a write per answer.
+
+The runs can be queried afterwards with answers() or from the command line:
+
+    python result_store.py --kind final
+    python result_store.py --run <run id> --model gpt-4o --question "cloud services"
+
+Attributes
+----------
+path : str
+    The SQLite database file. Default is ./output/results.sqlite.
+batch_size : int
+    The number of buffered answers that triggers a write.
+flush_interval : float
+    The max seconds an answer stays buffered, it's written with the next answer added after that.
+synchronous : str
+    The SQLite synchronous mode, which sets when the writes are fsynced: NORMAL syncs the write-ahead log at the
+    checkpoints only (the last written batches can be lost on a power failure, not on a crash of the process),
+    FULL syncs every batch, OFF leaves it to the operating system.
+"""
+
+COLUMNS = ('run_id', 'kind', 'model', 'question', 'answer', 'ignored', 'error', 'chunk_id', 'source_files', 'start_time', 'end_time', 'created_at')
+
+
+def query_runs(connection: sqlite3.Connection) -> List[dict]:
+    rows = connection.execute(
+        "SELECT runs.run_id, started_at, finished_at, COUNT(answers.id) FROM runs LEFT JOIN answers ON answers.run_id = runs.run_id GROUP BY runs.run_id ORDER BY started_at"
+    ).fetchall()
+    return [{"run_id": run_id, "started_at": started_at, "finished_at": finished_at, "answers": answers} for run_id, started_at, finished_at, answers in rows]
+
+
+def query_answers(connection: sqlite3.Connection, run_id: str = None, kind: str = None, model: str = None, question: str = None, after_id: int = None) -> List[dict]:
+    """
+    The stored answers in the order they were produced, question matches the questions containing it. after_id skips
+    the answers up to that id, to read the answers stored since a previous query.
+    """
+    filters = [("run_id = ?", run_id), ("kind = ?", kind), ("model = ?", model), ("question LIKE ?", f"%{question}%" if question else None), ("id > ?", after_id)]
+    conditions = [condition for condition, value in filters if value is not None]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = connection.execute(f"SELECT id, {', '.join(COLUMNS)} FROM answers {where} ORDER BY id", [value for _, value in filters if value is not None]).fetchall()
+
+    results = []
+    for row in rows:
+        result = dict(zip(("id",) + COLUMNS, row))
+        result["ignored"] = bool(result["ignored"])
+        result["error"] = bool(result["error"])
+        result["source_files"] = json.loads(result["source_files"]) if result["source_files"] else None
+        results.append(result)
+    return results
+
+
+class ResultStore:
+    def __init__(self, path="./output/results.sqlite", batch_size: int = 256, flush_interval: float = 1.0, synchronous: str = "NORMAL"):
+        if synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Unknown synchronous mode {synchronous}")
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.run_id = uuid.uuid4().hex[:12]
+        self.written = 0
+        self.batches = 0
+        self._buffer: list[tuple] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"PRAGMA synchronous={synchronous.upper()}")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                started_at REAL NOT NULL,
+                finished_at REAL
+            )"""
+        )
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                question TEXT NOT NULL,
+                answer TEXT,
+                ignored INTEGER NOT NULL,
+                error INTEGER NOT NULL,
+                chunk_id TEXT,
+                source_files TEXT,
+                start_time REAL,
+                end_time REAL,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS answers_run_question ON answers (run_id, question, model)")
+        self._connection.execute("INSERT INTO runs (run_id, started_at) VALUES (?, ?)", (self.run_id, time.time()))
+        self._connection.commit()
+
+    def _row(self, kind: str, question: Question, answer: ModelAnswer, start_time: float, end_time: float) -> tuple:
+        source_files = getattr(answer.content, "source_files", None)
+        return (self.run_id, kind, answer.model, question.text, answer.answer, int(bool(answer.ignore)), int(bool(answer.error)),
+                getattr(answer.content, "id", None), json.dumps(list(source_files)) if source_files is not None else None,
+                start_time, end_time, time.time())
+
+    async def add(self, kind: str, question: Question, answers: List[ModelAnswer], start_time: float = None, end_time: float = None):
+        """Buffers the answers, kind is one of chunk, duplicate (a chunk answer fanned out to a copy of its file), refine and final."""
+        self._buffer.extend(self._row(kind, question, answer, start_time, end_time) for answer in answers)
+
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            await self.flush()
+
+    def _write(self, rows: list[tuple]):
+        with self._lock:
+            self._connection.executemany(f"INSERT INTO answers ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+            self._connection.commit()
+            self.written += len(rows)
+            self.batches += 1
+
+    async def flush(self):
+        rows, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+
+        if rows:
+            await asyncio.to_thread(self._write, rows)
+
+    def runs(self) -> List[dict]:
+        with self._lock:
+            return query_runs(self._connection)
+
+    def answers(self, run_id: str = None, kind: str = None, model: str = None, question: str = None, after_id: int = None) -> List[dict]:
+        with self._lock:
+            return query_answers(self._connection, run_id, kind, model, question, after_id)
+
+    def stats(self) -> dict:
+        return {"run_id": self.run_id, "written": self.written, "batches": self.batches, "buffered": len(self._buffer)}
+
+    def close(self):
+        rows, self._buffer = self._buffer, []
+        if rows:
+            self._write(rows)
+
+        with self._lock:
+            self._connection.execute("UPDATE runs SET finished_at = ? WHERE run_id = ?", (time.time(), self.run_id))
+            self._connection.commit()
+            self._connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prints the stored answers as JSON lines")
+    parser.add_argument("--path", default="./output/results.sqlite")
+    parser.add_argument("--run", default="latest", help="A run id, latest or all")
+    parser.add_argument("--kind", choices=["chunk", "duplicate", "refine", "final"])
+    parser.add_argument("--model")
+    parser.add_argument("--question", help="Matches the questions containing it")
+    parser.add_argument("--runs", action="store_true", help="Lists the runs instead")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.path)
+    try:
+        if args.runs:
+            records = query_runs(connection)
+        else:
+            run_id = None if args.run == "all" else args.run
+            if args.run == "latest":
+                latest = connection.execute("SELECT run_id FROM runs ORDER BY started_at DESC LIMIT 1").fetchone()
+                run_id = latest[0] if latest else ""
+            records = query_answers(connection, run_id, args.kind, args.model, args.question)
+    finally:
+        connection.close()
+
+    for record in records:
+        print(json.dumps(record))
+
+
+if __name__ == "__main__":
+    main()
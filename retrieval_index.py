@@ -0,0 +1,156 @@
+import asyncio
+from collections import Counter
+import hashlib
+import math
+from pathlib import Path
+import re
+import sqlite3
+import threading
+from typing import List, Tuple
+
+from common_models import Chunk, Question, RetrievalMode
+
+"""
+A local BM25 index over the chunks, used to send a question only the chunks that are relevant to it.
+
+The index is stored in SQLite next to the output and updated incrementally: a chunk is only re-indexed when the
+hash of its text changed since the last run. Identifiers are indexed whole and split on camelCase/snake_case, so
+"S3Client" or "aws_region" match a question about "S3" or "AWS".
+"""
+
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "code", "do", "does", "for", "from", "how", "i", "in",
+    "is", "it", "of", "on", "or", "project", "that", "the", "this", "to", "used", "what", "which", "with", "you",
+}
+
+WORD = re.compile(r"[A-Za-z0-9_]+")
+SUB_WORD = re.compile(r"[A-Z]?[a-z]+|[A-Z0-9]+(?![a-z])")
+
+
+def tokenize(text: str) -> List[str]:
+    terms = []
+    for word in WORD.findall(text):
+        lowered = word.lower()
+        parts = [part.lower() for part in SUB_WORD.findall(word)]
+        if len(parts) > 1 or (parts and parts[0] != lowered):
+            terms.extend(part for part in parts if len(part) > 1 and part not in STOP_WORDS)
+        if len(lowered) > 1 and lowered not in STOP_WORDS:
+            terms.append(lowered)
+    return terms
+
+
+class BM25Index:
+    def __init__(self, path="./output/retrieval_index.sqlite", k1=1.5, b=0.75):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, hash TEXT NOT NULL, length INTEGER NOT NULL)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, document_id TEXT NOT NULL, frequency INTEGER NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS postings_term ON postings (term)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS postings_document_id ON postings (document_id)")
+        self._connection.commit()
+        self._load_lengths()
+
+    def _load_lengths(self):
+        self._lengths = dict(self._connection.execute("SELECT id, length FROM documents").fetchall())
+        self._average_length = sum(self._lengths.values()) / len(self._lengths) if self._lengths else 0
+
+    def _remove(self, document_id: str):
+        self._connection.execute("DELETE FROM postings WHERE document_id = ?", (document_id,))
+        self._connection.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+    def _update(self, chunks: List[Chunk], prune: bool) -> dict[str, int]:
+        with self._lock:
+            hashes = dict(self._connection.execute("SELECT id, hash FROM documents").fetchall())
+            stats = {"added": 0, "updated": 0, "unchanged": 0, "removed": 0}
+            seen = set()
+
+            for chunk in chunks:
+                document_id = chunk.id
+                if document_id in seen:
+                    continue
+                seen.add(document_id)
+
+                text = chunk.text
+                text_hash = hashlib.sha256(text.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+                if hashes.get(document_id) == text_hash:
+                    stats["unchanged"] += 1
+                    continue
+
+                stats["updated" if document_id in hashes else "added"] += 1
+                self._remove(document_id)
+
+                terms = tokenize(text)
+                self._connection.execute("INSERT INTO documents (id, hash, length) VALUES (?, ?, ?)", (document_id, text_hash, len(terms)))
+                self._connection.executemany("INSERT INTO postings (term, document_id, frequency) VALUES (?, ?, ?)",
+                                             [(term, document_id, frequency) for term, frequency in Counter(terms).items()])
+
+            if prune:
+                for document_id in hashes.keys() - seen:
+                    self._remove(document_id)
+                    stats["removed"] += 1
+
+            self._connection.commit()
+            self._load_lengths()
+            return stats
+
+    async def update(self, chunks: List[Chunk], prune: bool = True) -> dict[str, int]:
+        """Indexes the new and changed chunks, and with prune, drops the chunks that aren't in the list anymore."""
+        stats = await asyncio.to_thread(self._update, chunks, prune)
+        print(f"Retrieval index updated: {stats}")
+        return stats
+
+    def _search(self, query: str, document_ids: set[str] = None) -> List[Tuple[str, float]]:
+        terms = set(tokenize(query))
+        if not terms or not self._lengths:
+            return []
+
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT term, document_id, frequency FROM postings WHERE term IN ({', '.join('?' * len(terms))})", tuple(terms)
+            ).fetchall()
+
+        postings: dict[str, list[tuple[str, int]]] = {}
+        for term, document_id, frequency in rows:
+            postings.setdefault(term, []).append((document_id, frequency))
+
+        documents = len(self._lengths)
+        scores: dict[str, float] = {}
+
+        for term, term_postings in postings.items():
+            idf = math.log((documents - len(term_postings) + 0.5) / (len(term_postings) + 0.5) + 1)
+            for document_id, frequency in term_postings:
+                if document_ids is not None and document_id not in document_ids:
+                    continue
+                length_norm = 1 - self.b + self.b * self._lengths.get(document_id, 0) / (self._average_length or 1)
+                scores[document_id] = scores.get(document_id, 0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+
+        return sorted(scores.items(), key=lambda score: score[1], reverse=True)
+
+    async def search(self, query: str, document_ids: set[str] = None) -> List[Tuple[str, float]]:
+        return await asyncio.to_thread(self._search, query, document_ids)
+
+    async def select(self, question: Question, chunks: List[Chunk]) -> List[Chunk]:
+        """Returns the chunks matching the question according to its retrieval mode."""
+        if question.retrieval_mode == RetrievalMode.ALL:
+            return chunks
+
+        chunks_by_id = {chunk.id: chunk for chunk in chunks}
+        scores = await self.search(question.retrieval_query or question.text, set(chunks_by_id.keys()))
+
+        if question.retrieval_mode == RetrievalMode.TOP_K:
+            scores = scores[:question.retrieval_top_k]
+        elif question.retrieval_mode == RetrievalMode.THRESHOLD:
+            scores = [(document_id, score) for document_id, score in scores if score >= question.retrieval_score_threshold]
+
+        print(f"Question: {question.text[:50]} retrieved {len(scores)} of {len(chunks)} chunks")
+        return [chunks_by_id[document_id] for document_id, _ in scores]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+import types
+
+from batch_code_saver import BatchCodeSaver, merge_changes
+from chunker import MaxSizeChunker
+from code_saver import SaveStrategy
+from common_models import Chunk, ChunkPiece, FileType, QuestionAnswer
+from file_processor import FileContent
+from response_formats.code_refactoring import CodeChange
+from token_counter import HeuristicTokenCounter
+
+ORIGINAL = "".join(f"line {index}\n" for index in range(10))
+
+
+class _RecordingStrategy(SaveStrategy):
+    def __init__(self):
+        self.saved = {}
+
+    async def save(self, file_path: str, code_content: str, original_content: str = None):
+        self.saved[file_path] = code_content
+
+
+def _change(source_file: str, code: str) -> CodeChange:
+    return CodeChange(source_file=source_file, code=code, is_refactored=True, generated_unit_tests="", can_generate_unit_tests=False)
+
+
+def test_merge_keeps_the_changes_to_different_lines():
+    current = ORIGINAL.replace("line 1\n", "line 1 changed\n")
+    incoming = ORIGINAL.replace("line 8\n", "line 8 changed\n")
+
+    merged, conflicts = merge_changes(ORIGINAL, current, incoming)
+
+    assert conflicts == 0
+    assert merged == ORIGINAL.replace("line 1\n", "line 1 changed\n").replace("line 8\n", "line 8 changed\n")
+
+
+def test_merge_marks_the_changes_to_the_same_lines():
+    current = ORIGINAL.replace("line 4\n", "line 4 by a\n")
+    incoming = ORIGINAL.replace("line 4\n", "line 4 by b\n")
+
+    merged, conflicts = merge_changes(ORIGINAL, current, incoming, label="model-b")
+
+    assert conflicts == 1
+    assert "<<<<<<< current\nline 4 by a\n=======\nline 4 by b\n>>>>>>> model-b\n" in merged
+    assert merged.startswith("line 0\n") and merged.endswith("line 9\n")
+
+
+def test_merge_keeps_the_first_change_of_a_conflict():
+    current = ORIGINAL.replace("line 4\n", "line 4 by a\n")
+    incoming = ORIGINAL.replace("line 4\n", "line 4 by b\n").replace("line 9\n", "line 9 by b\n")
+
+    merged, conflicts = merge_changes(ORIGINAL, current, incoming, conflict_policy="keep-first")
+
+    assert conflicts == 1
+    assert merged == ORIGINAL.replace("line 4\n", "line 4 by a\n").replace("line 9\n", "line 9 by b\n")
+
+
+def test_the_code_of_a_part_is_saved_in_place_of_the_part(tmp_path):
+    path = tmp_path / "module.py"
+    path.write_text(ORIGINAL, encoding="utf-8")
+    file_path = str(path)
+    first_part_end = ORIGINAL.index("line 5\n")
+
+    class _File:
+        filepath = file_path
+
+    saver = BatchCodeSaver(_RecordingStrategy())
+    first = saver._part(Chunk([ChunkPiece(_File(), 0, first_part_end)]), file_path)
+    second = saver._part(Chunk([ChunkPiece(_File(), first_part_end, None)]), file_path)
+
+    asyncio.run(saver._save_file(file_path, [
+        ("model-a", _change(file_path, "line 0\nline 1 changed\nline 2\nline 3\nline 4\n"), first),
+        ("model-b", _change(file_path, "line 5\nline 6\nline 7 changed\nline 8\nline 9\n"), second),
+    ]))
+
+    assert saver.save_strategy.saved[file_path] == ORIGINAL.replace("line 1\n", "line 1 changed\n").replace("line 7\n", "line 7 changed\n")
+    assert saver.conflicts == []
+
+
+def _answer(chunk: Chunk, source_file: str, code: str) -> QuestionAnswer:
+    return QuestionAnswer("model-a", "Refactor?", "", 0, 0, 0, chunk, parsed=types.SimpleNamespace(changes=[_change(source_file, code)]))
+
+
+def test_the_parts_chunked_together_are_saved_in_place_or_reported(tmp_path):
+    generator = random.Random(3)
+    original = "".join(f"def function_{index}(x):\n" + "".join(f"    x = x + {line}\n" for line in range(generator.choice([1, 2, 3, 30, 60]))) + "    return x\n\n\n"
+                       for index in range(40))
+    path = tmp_path / "module.py"
+    path.write_text(original, encoding="utf-8")
+    chunker = MaxSizeChunker(max_chunk_size=400, token_counter=HeuristicTokenCounter())
+    chunks = chunker.chunk_files({FileType.CODE: [FileContent(path, path.name, FileType.CODE, content=original)]})[FileType.CODE]
+
+    assert any(len(chunk.pieces) > 1 for chunk in chunks)
+    # The answers give the code of their parts back unchanged, with the path of the file written another way
+    source_file = os.path.relpath(path)
+    saver = BatchCodeSaver(_RecordingStrategy())
+    asyncio.run(saver.save([[_answer(chunk, source_file, "".join(original[piece.start:piece.end] for piece in chunk.pieces)) for chunk in chunks]]))
+
+    assert saver.save_strategy.saved[source_file] == original
+    assert saver.conflicts == []
+    # The parts that don't follow each other in the file can't be put back
+    starts = [sorted(piece.start for piece in chunk.pieces) for chunk in chunks]
+    ends = [sorted(piece.end or len(original) for piece in chunk.pieces) for chunk in chunks]
+    assert len(saver.unsaved) == sum(1 for chunk_starts, chunk_ends in zip(starts, ends) if chunk_starts[1:] != chunk_ends[:-1]) > 0
+
+
+def test_the_code_of_a_part_never_replaces_another_file(tmp_path):
+    path = tmp_path / "module.py"
+    path.write_text(ORIGINAL, encoding="utf-8")
+    other = tmp_path / "other.py"
+
+    class _File:
+        filepath = str(path)
+
+    saver = BatchCodeSaver(_RecordingStrategy())
+    asyncio.run(saver.save([[_answer(Chunk([ChunkPiece(_File(), 0, 14)]), str(other), "line 0\nline 1\n")]]))
+
+    assert saver.save_strategy.saved == {}
+    assert saver.unsaved[0]["file"] == str(other)
@@ -0,0 +1,68 @@
+from code_splitter import split_source
+
+
+def _count(text: str) -> int:
+    return len(text.split())
+
+
+def _python_source() -> str:
+    methods = "".join(f"    def method_{index}(self, value):\n        return value + {index}\n\n" for index in range(12))
+    functions = "".join(f"def function_{index}(value):\n    return value * {index}\n\n\n" for index in range(12))
+    return f"import os\n\n\nclass Service:\n{methods}\n{functions}"
+
+
+def test_a_part_is_given_the_context_of_all_its_lines():
+    text = _python_source()
+    parts = split_source(text, ".py", _count, 60)
+
+    assert len(parts) > 1
+    for part in parts:
+        part_text = text[part.start:part.end]
+        # The methods of a part are read in the class, either in its context or in the part itself
+        if "    def method_" in part_text:
+            assert "class Service:" in part.context or "class Service:" in part_text
+        # And the top level functions aren't read as methods of the class
+        if "\ndef function_" in f"\n{part_text}" and "class Service:" not in part_text:
+            assert "class Service:" not in part.context
+
+
+def _java_source() -> str:
+    methods = "".join(f"    public int method{index}(int value) {{\n        // a brace in a comment }}\n        return value + {index};\n    }}\n\n" for index in range(15))
+    return f"package com.example;\n\nimport java.util.List;\n\npublic class Service {{\n{methods}}}\n"
+
+
+def _assert_covers(text: str, parts) -> None:
+    # The parts follow each other from the start to the end of the text, none of it is left out or repeated
+    assert parts[0].start == 0
+    assert parts[-1].end == len(text)
+    for part, following in zip(parts, parts[1:]):
+        assert part.end == following.start
+        assert part.end_line + 1 == following.start_line
+
+
+def test_the_parts_of_a_python_file_cover_it_within_the_budget():
+    text = _python_source()
+    parts = split_source(text, ".py", _count, 60)
+
+    _assert_covers(text, parts)
+    for part in parts:
+        assert _count(text[part.start:part.end]) + _count(part.context) <= 60
+
+
+def test_the_parts_of_a_java_file_cover_it_and_are_read_in_the_class():
+    text = _java_source()
+    parts = split_source(text, ".java", _count, 50)
+
+    _assert_covers(text, parts)
+    assert len(parts) > 1
+    for part in parts[1:]:
+        assert part.context.startswith("package com.example;\nimport java.util.List;")
+        assert "public class Service {" in part.context
+
+
+def test_a_file_that_cant_be_parsed_is_split_by_lines():
+    text = "def broken(:\n" + "".join(f"    value_{index} = {index}\n" for index in range(40))
+    parts = split_source(text, ".py", _count, 20)
+
+    _assert_covers(text, parts)
+    assert all(part.context == "" for part in parts)
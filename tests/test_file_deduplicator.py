@@ -0,0 +1,76 @@
+import asyncio
+import random
+
+from common_models import Chunk, FileType, ModelAnswer, Question
+from file_deduplicator import FileDeduplicator
+from file_processor import FileContent
+
+
+def _text(seed: int, words: int = 2000) -> str:
+    generator = random.Random(seed)
+    return " ".join(f"w{generator.randrange(300)}" for _ in range(words))
+
+
+def _file(path: str, content: str, filetype: FileType = FileType.CODE) -> FileContent:
+    return FileContent(path, path, filetype, content=content)
+
+
+def _near_copy(text: str) -> str:
+    return text[:1000] + " changed words here " + text[1000:]
+
+
+def test_exact_copy_of_a_near_copy_joins_the_representative():
+    original = _text(1)
+    deduplicator = FileDeduplicator()
+
+    assert deduplicator.add(_file("a.py", original)) is None
+    assert deduplicator.add(_file("b.py", _near_copy(original))) == "a.py"
+    assert deduplicator.add(_file("c.py", _near_copy(original))) == "a.py"
+
+    assert [duplicate["path"] for duplicate in deduplicator.clusters()["a.py"]] == ["b.py", "c.py"]
+    assert deduplicator.stats()["clusters"] == 1
+
+
+def test_calls_saved_counts_the_copies_per_question_and_model():
+    deduplicator = FileDeduplicator(near_duplicates=False)
+    for path in ("a.py", "b.py", "c.py"):
+        deduplicator.add(_file(path, "the same content"))
+    deduplicator.add(_file("d.md", "the same content", FileType.TEXT))
+
+    question = Question("What?", enabled=True, models=["m1", "m2"], allowed_file_types=[FileType.CODE])
+    answers = [
+        ModelAnswer(model="m1", answer="answer", content=Chunk.from_source_files(["a.py"]), ignore=False),
+        ModelAnswer(model="m2", answer="skipped due to max token limit", content=Chunk.from_source_files(["a.py"]), ignore=True),
+    ]
+    copies = deduplicator.fan_out(question, answers)
+
+    assert sorted(copy.content.source_files[0] for copy in copies) == ["b.py", "c.py"]
+    assert deduplicator.stats()["calls_saved"] == 2 * 2
+
+
+def test_files_are_grouped_by_content_and_type():
+    deduplicator = FileDeduplicator()
+    files = {
+        FileType.CODE: [_file("a.py", _text(1)), _file("b.py", _text(1)), _file("c.py", _text(2)), _file("d.py", _near_copy(_text(2)))],
+        # The same content as a.py, but not the same type of file
+        FileType.TEXT: [_file("a.md", _text(1), FileType.TEXT)],
+    }
+
+    kept = asyncio.run(deduplicator.deduplicate(files))
+
+    assert {file_type: [file_content.filepath for file_content in type_files] for file_type, type_files in kept.items()} == {FileType.CODE: ["a.py", "c.py"], FileType.TEXT: ["a.md"]}
+    clusters = deduplicator.clusters()
+    assert {representative: [duplicate["path"] for duplicate in duplicates] for representative, duplicates in clusters.items()} == {"a.py": ["b.py"], "c.py": ["d.py"]}
+    assert clusters["a.py"][0]["similarity"] == 1.0
+    assert clusters["c.py"][0]["similarity"] >= deduplicator.threshold
+    assert deduplicator.stats()["exact_duplicates"] == 1 and deduplicator.stats()["near_duplicates"] == 1
+
+
+def test_unrelated_and_small_files_are_not_grouped():
+    deduplicator = FileDeduplicator()
+
+    assert deduplicator.add(_file("a.py", _text(1))) is None
+    assert deduplicator.add(_file("b.py", _text(2))) is None
+    assert deduplicator.add(_file("c.py", "x = 1")) is None
+    assert deduplicator.add(_file("d.py", "x = 2")) is None
+    assert deduplicator.clusters() == {}
@@ -0,0 +1,109 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
+import math
+import re
+from typing import Callable, List, TypeVar
+
+"""
+Token counting for the prompt budgets and the token-budgeted packing of chunks and answers.
+
+TiktokenCounter uses the model encodings through tiktoken. tiktoken reads the encoding files from TIKTOKEN_CACHE_DIR,
+so pointing it to a directory that ships the encodings keeps the counting fully offline. When tiktoken or its
+encodings aren't available, create_token_counter falls back to the HeuristicTokenCounter which needs nothing but
+the standard library and over-estimates rather than under-estimates on code.
+
+The counts are cached per text (by digest), so a chunk is only counted once no matter how many questions and models
+it is sent to.
+"""
+
+T = TypeVar("T")
+
+DEFAULT_ENCODING = "o200k_base"
+
+
+class TokenCounter(ABC):
+    def __init__(self, cache_size=65536):
+        self._cache_size = cache_size
+        self._cache: OrderedDict[bytes, int] = OrderedDict()
+
+    @abstractmethod
+    def _count(self, text: str) -> int:
+        pass
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+
+        key = hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+        tokens = self._cache.get(key)
+
+        if tokens is None:
+            tokens = self._count(text)
+            self._cache[key] = tokens
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+
+        return tokens
+
+
+class HeuristicTokenCounter(TokenCounter):
+    # Words are split like identifiers (camelCase, snake_case), numbers in groups of 3, every symbol is a token
+    _pieces = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+|\s+|[^\w\s]|_")
+
+    def _count(self, text: str) -> int:
+        tokens = 0
+        for piece in self._pieces.findall(text):
+            first = piece[0]
+            if first.isspace():
+                tokens += 1
+            elif first.isdigit():
+                tokens += math.ceil(len(piece) / 3)
+            elif first.isalpha():
+                tokens += math.ceil(len(piece) / 4)
+            else:
+                tokens += 1
+        # Letters outside of the ASCII ranges (e.g. CJK) aren't matched by the word pattern
+        return max(tokens, math.ceil(len(text) / 4))
+
+
+class TiktokenCounter(TokenCounter):
+    def __init__(self, encoding_name=DEFAULT_ENCODING, cache_size=65536):
+        super().__init__(cache_size)
+        import tiktoken
+        self._encoding = tiktoken.get_encoding(encoding_name)
+
+    def _count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+def create_token_counter(encoding_name=DEFAULT_ENCODING) -> TokenCounter:
+    try:
+        return TiktokenCounter(encoding_name)
+    except Exception as e:
+        print(f"Using the heuristic token counter, tiktoken encoding {encoding_name} is not available: {e}")
+        return HeuristicTokenCounter()
+
+
+def first_fit_decreasing(items: List[T], size: Callable[[T], int], capacity: int, max_items: int = None) -> List[List[T]]:
+    """
+    Packs the items into as few bins of the given capacity as possible. The items are placed from the biggest to
+    the smallest, each one in the first bin it fits in. An item bigger than the capacity gets a bin of its own.
+    When max_items is set, a bin holds at most max_items items.
+    """
+    bins: List[List[T]] = []
+    remaining: List[int] = []
+
+    for item, item_size in sorted(((item, size(item)) for item in items), key=lambda pair: pair[1], reverse=True):
+        for index, space in enumerate(remaining):
+            if item_size <= space and (max_items is None or len(bins[index]) < max_items):
+                bins[index].append(item)
+                remaining[index] -= item_size
+                break
+        else:
+            bins.append([item])
+            remaining.append(capacity - item_size)
+
+    return bins
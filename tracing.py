@@ -0,0 +1,238 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import json
+import math
+import os
+from pathlib import Path
+import queue
+import threading
+import time
+import uuid
+
+"""
+Spans for the pipeline stages and the model calls, exported as JSON lines to a trace file.
+
+A span is opened with `with tracer.span(name, **attributes) as span:` and its attributes can be added while it runs
+with span.set(...). The span opened in the current task is the parent of the spans opened under it, including the
+ones of the tasks it gathers, so a trace reads as: question > ask_chunk > llm_call.
+
+At the end of the run, summary() returns the latency histogram of each span name and the token totals of each model
+(from the prompt_tokens and completion_tokens attributes of the llm_call spans). The histograms count the durations in
+buckets, the percentiles are read from buckets PRECISION_RATIO apart, so they take the same memory however many spans
+are recorded. The spans are written to the trace file by a writer thread, the tasks only queue them. A disabled
+tracer hands out a shared span that records nothing.
+"""
+
+LATENCY_BUCKETS_MS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+# The percentiles are within 5% of the actual durations
+PRECISION_RATIO = 1.05
+
+_current_span: ContextVar["Span"] = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'duration_ms', 'status', 'error', 'attributes')
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.duration_ms = None
+        self.status = "ok"
+        self.error = None
+        self.attributes = attributes or {}
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def increment(self, name: str, value: int = 1):
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class _NoopSpan(Span):
+    """The span of a disabled tracer, shared by all its callers."""
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__("noop", None)
+
+    def set(self, **attributes):
+        pass
+
+    def increment(self, name: str, value: int = 1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        # The count of the durations in each bucket PRECISION_RATIO apart, by bucket index
+        self.fine_counts: dict[int, int] = {}
+        self.count = 0
+        self.errors = 0
+        self.max_ms = None
+
+    def add(self, duration_ms: float, error: bool):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, duration_ms)] += 1
+        index = math.ceil(math.log(duration_ms, PRECISION_RATIO)) if duration_ms > 1 else 0
+        self.fine_counts[index] = self.fine_counts.get(index, 0) + 1
+        self.count += 1
+        self.errors += int(error)
+        self.max_ms = duration_ms if self.max_ms is None else max(self.max_ms, duration_ms)
+
+    def percentile(self, percent: float) -> float:
+        if not self.count:
+            return None
+
+        rank = min(self.count - 1, int(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.fine_counts):
+            seen += self.fine_counts[index]
+            if seen > rank:
+                # The upper bound of the bucket, the slowest duration it can hold
+                return round(min(PRECISION_RATIO ** index, self.max_ms), 1)
+
+    def as_dict(self) -> dict:
+        labels = [f"<={bucket}ms" for bucket in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "max_ms": round(self.max_ms, 1) if self.max_ms is not None else None,
+            "buckets": {label: count for label, count in zip(labels, self.counts) if count},
+        }
+
+
+class Tracer:
+    def __init__(self, path="./output/trace.jsonl", enabled: bool = True, flush_every: int = 256):
+        self.path = Path(path)
+        self.enabled = enabled
+        self.flush_every = flush_every
+        self.trace_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._histograms: dict[str, LatencyHistogram] = {}
+        self._tokens: dict[str, dict[str, int]] = {}
+        # The spans to write, and the events set once the spans queued before them are written
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: threading.Thread = None
+
+        if self.enabled:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def current(self) -> Span:
+        """The span opened in the current task, or a no-op one when there is none, so it can always be set."""
+        span = _current_span.get()
+        return span if span is not None else _NOOP_SPAN
+
+    def span(self, name: str, **attributes):
+        if not self.enabled:
+            return _NOOP_SPAN
+        return self._span(name, attributes)
+
+    @contextmanager
+    def _span(self, name: str, attributes: dict):
+        parent = _current_span.get()
+        span = Span(name, self.trace_id, parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        started = time.perf_counter()
+
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration_ms = round((time.perf_counter() - started) * 1000, 3)
+            _current_span.reset(token)
+            self._record(span)
+
+    def _record(self, span: Span):
+        with self._lock:
+            self._histograms.setdefault(span.name, LatencyHistogram()).add(span.duration_ms, span.status == "error")
+
+            model = span.attributes.get("model")
+            if span.name == "llm_call" and model:
+                tokens = self._tokens.setdefault(model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "retries": 0})
+                tokens["calls"] += 1
+                tokens["prompt_tokens"] += span.attributes.get("prompt_tokens") or 0
+                tokens["completion_tokens"] += span.attributes.get("completion_tokens") or 0
+                tokens["retries"] += span.attributes.get("retries") or 0
+
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="trace-writer", daemon=True)
+                self._writer.start()
+
+        self._queue.put(span)
+
+    def _write(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.flush_every:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            spans = [item for item in items if isinstance(item, Span)]
+            try:
+                if spans:
+                    with open(self.path, 'a', encoding='utf-8') as f:
+                        f.write("".join(json.dumps(span.as_dict(), default=str) + "\n" for span in spans))
+            except OSError as e:
+                # The spans are dropped, the writer keeps going so the next ones and the flushes aren't lost with them
+                print(f"Failed to write {len(spans)} spans to {self.path}: {e}")
+            finally:
+                for item in items:
+                    if isinstance(item, threading.Event):
+                        item.set()
+
+    def flush(self):
+        """Waits for the spans recorded so far to be written."""
+        if self._writer is None:
+            return
+        written = threading.Event()
+        self._queue.put(written)
+        # Nothing sets the event once the writer is gone
+        while not written.wait(timeout=1.0):
+            if not self._writer.is_alive():
+                return
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "latency": {name: histogram.as_dict() for name, histogram in self._histograms.items()},
+                "tokens": {model: dict(tokens) for model, tokens in self._tokens.items()},
+            }
+
+    def print_summary(self):
+        summary = self.summary()
+
+        print(f"{'span':<24}{'count':>8}{'errors':>8}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}")
+        for name, latency in summary["latency"].items():
+            print(f"{name:<24}{latency['count']:>8}{latency['errors']:>8}{str(latency['p50_ms']):>12}{str(latency['p95_ms']):>12}{str(latency['max_ms']):>12}")
+            print(f"{'':<24}{latency['buckets']}")
+
+        for model, tokens in summary["tokens"].items():
+            print(f"Model {model}: {tokens['calls']} calls, {tokens['prompt_tokens']} prompt tokens, {tokens['completion_tokens']} completion tokens, {tokens['retries']} retries")
+
+    def close(self):
+        if self.enabled:
+            self.flush()
+            print(f"Trace written to {os.path.abspath(self.path)}")